@@ -1,5 +1,6 @@
 import contextlib
 import datetime
+import functools
 import logging
 import math
 import re
@@ -8,6 +9,7 @@ import sys
 
 import jsonobject
 import numpy as np
+import pandas as pd
 import unidecode
 from ruamel.yaml import YAML
 
@@ -56,13 +58,39 @@ def run_command(cmd):
         die(f"Running {cmd!r} returned {r.returncode}")  # ":\n{r.stderr}\n{r.stdout}")
 
 
+@functools.lru_cache(maxsize=1 << 16)
+def _n_str(s):
+    return unidecode.unidecode(s).replace("-", " ").lower()
+
+
 def _n(s):
-    return unidecode.unidecode(str(s)).replace("-", " ").lower()
+    "Normalize a name for matching (memoized, see `_n_cache_info`)"
+    return _n_str(str(s))
+
+
+def _n_many(values):
+    """
+    Normalize a pandas Series, array or list of names, normalizing every distinct
+    value only once. Returns a Series with the same index for a Series, otherwise
+    a numpy object array.
+    """
+    strs = np.asarray(values, dtype=object).astype(str)
+    uniques, inverse = np.unique(strs, return_inverse=True)
+    res = np.array([_n_str(u) for u in uniques], dtype=object)[inverse.reshape(-1)]
+    res = res.reshape(strs.shape)
+    if isinstance(values, pd.Series):
+        return pd.Series(res, index=values.index, name=values.name)
+    return res
+
+
+def _n_cache_info():
+    "Return the `_n` memo cache statistics (hits, misses, maxsize, currsize)"
+    return _n_str.cache_info()
 
 
 def _ncol(df, *cols):
     for col in cols:
-        df[col] = df[col].map(_n)
+        df[col] = _n_many(df[col])
 
 
 def _e(o):
@@ -1,10 +1,11 @@
 import datetime
+import functools
 import getpass
 import json
 import logging
 import re
 import socket
-from copy import copy, deepcopy
+from copy import deepcopy
 from pathlib import Path
 import pandas as pd
 
@@ -13,12 +14,14 @@ import jsonobject as jo
 import numpy as np
 import plotly.graph_objects as go
 import tqdm
-from scipy.stats import lognorm, norm
+from scipy.special import ndtri
+from scipy.stats import lognorm
 
 from ..common import IgnoredProperty, die, mix_html_colors, yaml
-from ..data.export import ExportDoc, ExportRegion
+from ..data.export import ExportDocWriter, ExportRegion
+from ..gleam.aggregation import GLEAM_LEVELS
 from ..gleam.simulation import Simulation
-from ..regions import Region, Regions
+from ..regions import EstimateStore, Region, Regions
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +31,111 @@ DEFAULT_LINE_STYLE = {
     "width": 2,
 }
 
+# Standard normal quantiles for the q05/q95 stats
+NORM_Q05, NORM_Q95 = ndtri(0.05), ndtri(0.95)
+
+
+# Interpolation coefficients between neighbouring scenarios
+INTERPOLATION_QS = [0.33, 0.66]
+
+
+@functools.lru_cache(maxsize=None)
+def mix_color_pair(color1, color2, q):
+    """Cached `mix_html_colors` of two colors with weights `q` and `1 - q`."""
+    return mix_html_colors((color1, q), (color2, 1.0 - q))
+
+
+def normal_stats(data, axis=-1):
+    """
+    Fit normal distributions along `axis` of `data` (ignoring NaNs) and return
+    `{"mean": .., "q05": .., "q95": ..}` arrays multiplied by 1000.
+
+    Equivalent to `scipy.stats.norm.fit` and the frozen distribution `ppf`,
+    with minimal stdev of 3e-5 and the quantiles clipped to [0, 1].
+    """
+    data = np.asarray(data, dtype=float)
+    m = np.nanmean(data, axis=axis)
+    v = np.maximum(np.nanstd(data, axis=axis), 3e-5)
+    return {
+        "mean": m * 1000,
+        "q05": np.maximum(m + v * NORM_Q05, 0.0) * 1000,
+        "q95": np.minimum(m + v * NORM_Q95, 1.0) * 1000,
+    }
+
+
+def lttb_indices(ys, n_out):
+    """
+    Select `n_out` points of every row of `ys` (trace, point) by
+    largest-triangle-three-buckets, returns the indices as array (trace, n_out).
+
+    The first and last points are always kept, the inner points are split into
+    `n_out - 2` buckets, from each the point forming the largest triangle with
+    the previous selected point and the mean of the next bucket is selected.
+    All the traces are processed at once. Returns all the indices if `n_out`
+    is not smaller than the number of points (or below 3).
+    """
+    ys = np.asarray(ys, dtype=float)
+    t, n = ys.shape
+    if n_out >= n or n_out < 3:
+        return np.tile(np.arange(n), (t, 1))
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(int)
+    edges = np.append(edges, n)
+    res = np.empty((t, n_out), dtype=int)
+    res[:, 0], res[:, -1] = 0, n - 1
+    rows = np.arange(t)
+    a = np.zeros(t, dtype=int)
+    for b in range(n_out - 2):
+        lo, hi, nhi = edges[b], edges[b + 1], edges[b + 2]
+        # Mean of the next bucket (just the last point for the last bucket)
+        cx = (hi + nhi - 1) / 2.0
+        cy = ys[:, hi:nhi].mean(axis=1)
+        ax, ay = a[:, None], ys[rows, a][:, None]
+        bx, by = np.arange(lo, hi)[None, :], ys[:, lo:hi]
+        area = np.abs((ax - cx) * (by - ay) - (ax - bx) * (cy[:, None] - ay))
+        a = lo + np.argmax(area, axis=1)
+        res[:, b + 1] = a
+    return res
+
+
+class EstimatesTable:
+    """
+    CSSE history data as an array of shape (region, date, metric).
+
+    Built once per export from the history DataFrame with `{metric}_{YYYYMMDD}`
+    columns; missing columns are zeros.
+    """
+
+    # (Exported name, column prefix)
+    METRICS = [
+        ("JH_Deaths", "deaths"),
+        ("JH_Confirmed", "confirmed"),
+        ("JH_Recovered", "recovered"),
+        ("JH_Infected", "active"),
+    ]
+
+    def __init__(self, df):
+        dates = sorted(set(col.split("_")[1] for col in df.columns))
+        self.dates = [datetime.datetime.strptime(d, "%Y%m%d").date() for d in dates]
+        self.iso_dates = [d.isoformat() for d in self.dates]
+        self.index = {k: i for i, k in enumerate(df.index)}
+        cols = [f"{prefix}_{d}" for d in dates for _name, prefix in self.METRICS]
+        self.values = (
+            df.reindex(columns=cols, fill_value=0)
+            .to_numpy(dtype=float)
+            .reshape((len(df), len(dates), len(self.METRICS)))
+        )
+
+    def get(self, key):
+        "Return array (date, metric) for region key, or None."
+        i = self.index.get(key)
+        if i is None:
+            return None
+        return self.values[i]
+
+
+# Simulation definitions (and local results) in the batch dir
+SIM_DEF_DIR = "simulation-defs"
+
 
 class SimInfo(jo.JsonObject):
     id = jo.StringProperty(required=True)
@@ -43,6 +151,9 @@ class Batch(jo.JsonObject):
     BATCH_FILE_NAME = "batch.yaml"
     DATA_FILE_NAME = "data-CHANNEL-v3.json"
     HIST_FILE_NAME = "csse_history_data.h5"
+    ESTIMATES_FILE_NAME = "estimates.npz"
+    # Number of regions to generate traces for at once
+    EXPORT_CHUNK = 32
 
     config = jo.DictProperty()
     comment = jo.StringProperty()
@@ -51,6 +162,10 @@ class Batch(jo.JsonObject):
     name = jo.StringProperty(required=True)
     # Map {region_key: {region estimates etc}}
     region_data = jo.DictProperty()
+    # Optional BasinAggregator for regions without GLEAM-level results
+    aggregator = IgnoredProperty()
+    # Optional series cache {(sim_id, region_key): array}, see `get_seq`
+    seq_cache = IgnoredProperty()
 
     @classmethod
     def new(cls, config, suffix=None):
@@ -124,6 +239,17 @@ class Batch(jo.JsonObject):
         bs.sim = sim
         self.sims.append(bs)
 
+    def set_aggregator(self, aggregator):
+        """
+        Use a `BasinAggregator` for regions without GLEAM results.
+
+        Its cache is grown to hold all the batch sims, as the exports go through
+        all of them for every region.
+        """
+        if aggregator is not None:
+            aggregator.cache_size = max(aggregator.cache_size, len(self.sims))
+        self.aggregator = aggregator
+
     def load_sims(self, allow_unfinished=False, sims_dir=None):
         """Load simulation all batch simulations (optionally failing if any uncomputed)"""
         if sims_dir is None:
@@ -140,6 +266,15 @@ class Batch(jo.JsonObject):
             f"Loaded {len(self.sims)} simulations, {with_res} of that have results"
         )
 
+    def repack_sims(self):
+        """Repack results of all loaded sims for faster access, see `Simulation.repack`."""
+        n = 0
+        for bs in self.sims:
+            if bs.sim is not None and bs.sim.has_result():
+                bs.sim.repack()
+                n += 1
+        log.info(f"Repacked {n} simulation results")
+
     def save_sim_defs_to_gleam(self, sims_dir=None):
         """Create and save the definitions of all sontained simulations into gleam sim dir."""
         if sims_dir is None:
@@ -153,54 +288,161 @@ class Batch(jo.JsonObject):
             bs.sim.definition.save(p / "definition.xml")
         log.info(f"Saved {len(self.sims)} simulation definitions to {sims_dir}")
 
+    def get_seq(self, bs, region):
+        """
+        Get the (compartment, day) series of a region from sim info `bs`.
+
+        Uses GLEAM-computed results where available, otherwise aggregates the basins
+        with `self.aggregator` (if set). The series are memoized in `self.seq_cache`
+        if it is set to a dict.
+        """
+        if self.seq_cache is not None:
+            k = (bs.id, region.key)
+            if k not in self.seq_cache:
+                self.seq_cache[k] = self._get_seq(bs, region)
+            return self.seq_cache[k]
+        return self._get_seq(bs, region)
+
+    def _get_seq(self, bs, region):
+        if region.gleam_id is not None and region.kind in ("city", *GLEAM_LEVELS):
+            return bs.sim.get_seq(region.gleam_id, region.kind)
+        if self.aggregator is None:
+            die(f"No GLEAM results for {region!r} and no aggregator set")
+        return self.aggregator.get_seq(bs.sim, region)
+
     def generate_simgroup_traces(self, region, sims, initial_number, skip_days=0):
-        def trace_for_seqs(bs1, bs2=None, *, q=1.0, name=None, vis=1.0):
-            if bs2 is None:
-                bs2 = bs1
-            sq1 = bs1.sim.get_seq(region.gleam_id, region.kind)
-            y1 = sq1[2, :] - sq1[3, :] + initial_number
-            sq2 = bs2.sim.get_seq(region.gleam_id, region.kind)
-            y2 = sq2[2, :] - sq2[3, :] + initial_number
-            # NOTE: mult by 1000 to go to *_per_1000
-            y = ((q * y1 + (1.0 - q) * y2) * 1000).tolist()
-            y = y[skip_days:]
-            start = datetime.date.fromordinal(
-                sims[0].sim.definition.get_start_date().toordinal() + skip_days
+        if not sims:
+            return []
+        # Series of shape (sim, day)
+        ys = np.array([self._active_series(bs, region, initial_number) for bs in sims])
+        return self._simgroup_traces_from_series(sims, ys, skip_days=skip_days)
+
+    def generate_regions_traces(self, regions, initial_numbers=None, skip_days=2):
+        """
+        Generate {region_key: {group: [plotly_traces]}} for a list of Regions.
+
+        Same as `generate_region_traces` for every region, but the interpolated
+        series of every group are computed for all the regions at once.
+        """
+        if initial_numbers is None:
+            initial_numbers = [self.get_initial_number(r) for r in regions]
+        res = {r.key: {} for r in regions}
+        for gname in set(bs.group for bs in self.sims):
+            sims = [bs for bs in self.sims if bs.group == gname and bs.sim.has_result()]
+            if not sims:
+                for r in regions:
+                    res[r.key][gname] = []
+                continue
+            # Series of shape (region, sim, day)
+            ys = np.array(
+                [
+                    [self._active_series(bs, r, inum) for bs in sims]
+                    for r, inum in zip(regions, initial_numbers)
+                ]
             )
-            x = [start.isoformat()]  # Saving space, day sequence is filled by JS
-            style = copy(bs1.line_style)
-            style.color = mix_html_colors(
-                (bs1.line_style["color"], q), (bs2.line_style["color"], (1 - q)),
+            interps = self._interpolate_series(sims, ys)
+            for ri, r in enumerate(regions):
+                res[r.key][gname] = self._simgroup_traces_from_series(
+                    sims, ys[ri], interps[ri], skip_days=skip_days
+                )
+        return res
+
+    def _active_series(self, bs, region, initial_number):
+        sq = self.get_seq(bs, region)
+        return sq[2, :] - sq[3, :] + initial_number
+
+    @staticmethod
+    def _interpolation_pairs(sims):
+        """
+        Return the list of sim index pairs to interpolate between.
+
+        Sims are grouped by air traffic and interpolated between neighbours
+        ordered by seasonality.
+        """
+        at_sims = {}
+        for i, bs in enumerate(sims):
+            at_sims.setdefault(
+                bs.sim.definition.get_traffic_occupancy(), list()
+            ).append(i)
+        pairs = []
+        for simseq in at_sims.values():
+            simseq.sort(key=lambda i: sims[i].sim.definition.get_seasonality())
+            pairs.extend(zip(simseq[:-1], simseq[1:]))
+        return pairs
+
+    def _interpolate_series(self, sims, ys):
+        """
+        Interpolate series `ys` of shape (..., sim, day) into (..., interpolation, day).
+
+        The interpolations are ordered by sim pairs, then by `INTERPOLATION_QS`.
+        NOTE: mult by 1000 to go to *_per_1000
+        """
+        pairs = self._interpolation_pairs(sims)
+        i1 = np.array([p[0] for p in pairs], dtype=int)
+        i2 = np.array([p[1] for p in pairs], dtype=int)
+        interps = np.stack(
+            [
+                (q * ys[..., i1, :] + (1.0 - q) * ys[..., i2, :]) * 1000
+                for q in INTERPOLATION_QS
+            ],
+            axis=-2,
+        )
+        return interps.reshape(ys.shape[:-2] + (-1, ys.shape[-1]))
+
+    def _simgroup_traces_from_series(self, sims, ys, interps=None, skip_days=0):
+        """Plotly traces for the series `ys` (sim, day) and their interpolations."""
+        if interps is None:
+            interps = self._interpolate_series(sims, ys)
+        start = datetime.date.fromordinal(
+            sims[0].sim.definition.get_start_date().toordinal() + skip_days
+        )
+        # Interpolations, then the full traces
+        all_ys = np.concatenate([interps, ys * 1000])[:, skip_days:]
+        n_points = self.config.get("trace_points")
+        if n_points and n_points < all_ys.shape[1]:
+            # Downsampled, with explicit days
+            idx = lttb_indices(all_ys, n_points)
+            days = np.array(
+                [
+                    (start + datetime.timedelta(days=i)).isoformat()
+                    for i in range(all_ys.shape[1])
+                ]
             )
+            xs = days[idx].tolist()
+            all_ys = np.take_along_axis(all_ys, idx, axis=1)
+        else:
+            # Saving space, day sequence is filled by JS
+            xs = [[start.isoformat()]] * len(all_ys)
+
+        def trace(x, y, style, name=None, vis=1.0):
             kws = {"opacity": vis}
             if name is None:
                 kws["showlegend"] = False
                 kws["hoverinfo"] = "skip"
             return go.Scatter(
-                name=name, line=style, hoverlabel=dict(namelength=-1), x=x, y=y, **kws,
+                name=name,
+                line=style,
+                hoverlabel=dict(namelength=-1),
+                x=x,
+                y=y.tolist(),
+                **kws,
             ).to_plotly_json()
 
-        if not sims:
-            return []
         traces = []
-
-        # group by air traffic
-        at_sims = {}
-        for bs in sims:
-            at_sims.setdefault(
-                bs.sim.definition.get_traffic_occupancy(), list()
-            ).append(bs)
-
         # Add 2 interpolations
-        for simseq in at_sims.values():
-            simseq.sort(key=lambda bs: bs.sim.definition.get_seasonality())
-            for bs1, bs2 in zip(simseq[:-1], simseq[1:]):
-                for q in [0.33, 0.66]:
-                    traces.append(trace_for_seqs(bs1, bs2, q=q, vis=0.35))
+        pairs = self._interpolation_pairs(sims)
+        qs = [(i1, i2, q) for i1, i2 in pairs for q in INTERPOLATION_QS]
+        for x, y, (i1, i2, q) in zip(xs, all_ys, qs):
+            style = dict(sims[i1].line_style)
+            style["color"] = mix_color_pair(
+                sims[i1].line_style["color"], sims[i2].line_style["color"], q
+            )
+            traces.append(trace(x, y, style, vis=0.35))
 
         # Add the full trace
-        for bs in sims:
-            traces.append(trace_for_seqs(bs, name=bs.name))
+        n = len(qs)
+        for bs, x, y in zip(sims, xs[n:], all_ys[n:]):
+            traces.append(trace(x, y, dict(bs.line_style), name=bs.name))
 
         return traces
 
@@ -208,7 +450,7 @@ class Batch(jo.JsonObject):
         tot_infected = []
         max_active_infected = []
         for bs in sims:
-            sq = bs.sim.get_seq(region.gleam_id, region.kind)
+            sq = self.get_seq(bs, region)
             tot_infected.append(sq[2, -1] + initial_number)
             max_active_infected.append(np.max(sq[2, :] - sq[3, :] + initial_number))
         stats = {}
@@ -216,25 +458,57 @@ class Batch(jo.JsonObject):
             (tot_infected, "TotalInfected"),
             (max_active_infected, "MaxActiveInfected"),
         ]:
-            m, v = norm.fit(data)
-            v = max(v, 3e-5)
-            dist = norm(m, v)
-            stats[f"{name}_per1000_mean"] = dist.mean() * 1000
-            stats[f"{name}_per1000_q05"] = max(dist.ppf(0.05), 0.0) * 1000
-            stats[f"{name}_per1000_q95"] = min(dist.ppf(0.95), 1.0) * 1000
+            for k, v in normal_stats(data).items():
+                stats[f"{name}_per1000_{k}"] = float(v)
         return stats
 
-    def generate_region_traces_and_stats(self, region: Region):
-        """
-        Generate {group: [plotly_traces]} and {group: {stats}} for a Region.
+    def generate_regions_stats(self, regions, initial_numbers=None):
         """
+        Generate {region_key: {group: {stats}}} for a list of Regions.
 
-        groups = set(bs.group for bs in self.sims)
+        Same as `generate_simgroup_stats` for every region and group, but with
+        the statistics computed as one array reduction over regions x groups x sims.
+        """
+        if initial_numbers is None:
+            initial_numbers = [self.get_initial_number(r) for r in regions]
+        groups = sorted(set(bs.group for bs in self.sims))
+        group_sims = [
+            [bs for bs in self.sims if bs.group == g and bs.sim.has_result()]
+            for g in groups
+        ]
+        n = max((len(sims) for sims in group_sims), default=0)
+        # Padded with NaNs for groups with fewer sims
+        tot_infected = np.full((len(regions), len(groups), n), np.nan)
+        max_active_infected = np.full((len(regions), len(groups), n), np.nan)
+        for ri, (region, initial_number) in enumerate(zip(regions, initial_numbers)):
+            for gi, sims in enumerate(group_sims):
+                for si, bs in enumerate(sims):
+                    sq = self.get_seq(bs, region)
+                    tot_infected[ri, gi, si] = sq[2, -1] + initial_number
+                    max_active_infected[ri, gi, si] = (
+                        np.max(sq[2, :] - sq[3, :]) + initial_number
+                    )
+        stats = {}
+        for data, name in [
+            (tot_infected, "TotalInfected"),
+            (max_active_infected, "MaxActiveInfected"),
+        ]:
+            for k, v in normal_stats(data).items():
+                stats[f"{name}_per1000_{k}"] = v
+        return {
+            region.key: {
+                g: {k: float(v[ri, gi]) for k, v in stats.items()}
+                for gi, g in enumerate(groups)
+            }
+            for ri, region in enumerate(regions)
+        }
 
+    def get_initial_number(self, region: Region):
+        """Minimal initial number of infected making all the sim sequences non-negative."""
         min_number = 0.0
         for bs in self.sims:
             if bs.sim.has_result():
-                sq = bs.sim.get_seq(region.gleam_id, region.kind)
+                sq = self.get_seq(bs, region)
                 min_number = max(min_number, -np.min(sq[2, :] - sq[3, :]))
 
         # TODO: add initial estimates from and into region_data
@@ -243,99 +517,160 @@ class Batch(jo.JsonObject):
         # print(min_number, sim_number)
         # initial_number = max(min_number, sim_number, 0.0)
 
-        initial_number = max(min_number, 0.0)
+        return max(min_number, 0.0)
+
+    def generate_region_traces(self, region: Region, initial_number=None):
+        """
+        Generate {group: [plotly_traces]} for a Region.
+        """
+        if initial_number is None:
+            initial_number = self.get_initial_number(region)
+        groups = set(bs.group for bs in self.sims)
 
         groups_traces = {}
-        groups_stats = {}
         for gname in groups:
             sims = [bs for bs in self.sims if bs.group == gname and bs.sim.has_result()]
             groups_traces[gname] = self.generate_simgroup_traces(
                 region, sims, initial_number, skip_days=2,  # Skip 2 days to hide "bump"
             )
+        return groups_traces
+
+    def generate_region_traces_and_stats(self, region: Region):
+        """
+        Generate {group: [plotly_traces]} and {group: {stats}} for a Region.
+        """
+
+        groups = set(bs.group for bs in self.sims)
+        initial_number = self.get_initial_number(region)
+
+        groups_stats = {}
+        for gname in groups:
+            sims = [bs for bs in self.sims if bs.group == gname and bs.sim.has_result()]
             groups_stats[gname] = self.generate_simgroup_stats(
                 region, sims, initial_number
             )
-        return groups_traces, groups_stats
+        return self.generate_region_traces(region, initial_number), groups_stats
+
+    def export_region_traces(
+        self, er: ExportRegion, out_dir: Path, traces=None, stats=None
+    ):
+        """
+        Write the region traces file and set the region data.
 
-    def export_region_traces(self, er: ExportRegion, out_dir: Path):
+        Optional `traces` and `stats` are the precomputed `{group: [plotly_traces]}`
+        and `{group: {stats}}` for the region.
+        """
         # Plots and sim summaries
-        if (er.gleam_id is None) or (er.kind is None):
+        if ((er.gleam_id is None) and (self.aggregator is None)) or (er.kind is None):
             die(f"Missing gleam_id or kind for {er.region!r}")
-        gt, gs = self.generate_region_traces_and_stats(er.region)
+        if traces is None or stats is None:
+            gt, gs = self.generate_region_traces_and_stats(er.region)
+        else:
+            gt, gs = traces, stats
         rel_url = (
             f"{out_dir.parts[-1]}/lines-traces-{er.region.key.replace(' ', '-')}.json"
         )
-        with open(out_dir.parent / rel_url, "wt") as f:
+        # Written atomically, the export dir may be read while updated (watch mode)
+        path = out_dir.parent / rel_url
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, "wt") as f:
             json.dump(gt, f)
+        tmp.replace(path)
         er.data["infected_per_1000"] = {
             "traces_url": rel_url,
         }
         er.data["mitigation_stats"] = gs
 
-    def export_region_estimates(self, er: ExportRegion, df):
+    def export_region_estimates(self, er: ExportRegion, table):
+        """
+        Set the region CSSE estimates by date.
 
-        columns_list = sorted(set([date.split("_")[1] for date in df.columns]))
-        days = {}
+        `table` is an `EstimatesTable` (or the history DataFrame to build it from).
+        """
+        if isinstance(table, pd.DataFrame):
+            table = EstimatesTable(table)
+        vals = table.get(er.region.key)
+        if vals is None:
+            logging.warning(
+                f"Region not in CSSE data {er.region.key!r}, assuming zeros."
+            )
+            vals = np.zeros((len(table.dates), len(table.METRICS)))
+        vals = vals.tolist()
+        names = [name for name, _prefix in table.METRICS]
 
-        try:
-            row = df.loc[er.region.key]
-        except KeyError as ex:
-            logging.warning(f"Region not in CSSE data {ex}, assuming zeros.")
-            row = {}
-        # Stats
-        for date in columns_list:
-            parsed_date = datetime.datetime.strptime(date, "%Y%m%d").date()
-
-            ests = {
-                "JH_Deaths": row.get(f"deaths_{date}", 0),
-                "JH_Confirmed": row.get(f"confirmed_{date}", 0),
-                "JH_Recovered": row.get(f"recovered_{date}", 0),
-                "JH_Infected": row.get(f"active_{date}", 0),
-            }
+        days = {}
+        for date, iso_date, row in zip(table.dates, table.iso_dates, vals):
+            ests = dict(zip(names, row))
             # Only put the estimated data to the current date
-            if parsed_date == self.config["start_date"]:
+            if date == self.config["start_date"]:
                 ests["FT_Infected"] = self.region_data.get(er.region.key, {}).get(
                     "FT_Infected"
                 )
-
-            output_date = parsed_date.isoformat()
-            days[output_date] = ests
+            days[iso_date] = ests
 
         er.data["estimates"] = {"days": days}
 
-    def write_export_data(self, regions: Regions):
+    def write_export_data(self, regions: Regions, compress=()):
         """
         High-level function that writes a Plotly traces as a JSON file for each
         country into the batch directory.
+
+        The main data file is streamed region by region, optionally with
+        precompressed siblings (see `ExportDocWriter`).
         """
 
         out_dir = self.generate_export_dir()
         out_json = out_dir / self.DATA_FILE_NAME
-        ed = ExportDoc(comment=f"{self.name}")
 
         out_conf_dir = self.get_out_dir()
         in_hist = out_conf_dir / self.HIST_FILE_NAME
 
-        df = pd.read_hdf(in_hist)
+        table = EstimatesTable(pd.read_hdf(in_hist))
 
-        for rkey in tqdm.tqdm(self.config["regions"], desc="Exporting regions"):
-            r = regions[rkey]
-            er = ed.add_region(r)
-            self.export_region_estimates(er, df)
-            self.export_region_traces(er, out_dir=out_dir)
+        rlist = [regions[k] for k in self.config["regions"]]
+        initial_numbers = [self.get_initial_number(r) for r in rlist]
+        stats = self.generate_regions_stats(rlist, initial_numbers)
+
+        with ExportDocWriter(
+            out_json, comment=f"{self.name}", compress=compress
+        ) as ed, tqdm.tqdm(total=len(rlist), desc="Exporting regions") as progress:
+            # Traces are generated in chunks of regions to bound the memory use
+            for c in range(0, len(rlist), self.EXPORT_CHUNK):
+                chunk = rlist[c : c + self.EXPORT_CHUNK]
+                traces = self.generate_regions_traces(
+                    chunk, initial_numbers[c : c + self.EXPORT_CHUNK]
+                )
+                for r in chunk:
+                    er = ed.add_region(r)
+                    self.export_region_estimates(er, table)
+                    self.export_region_traces(
+                        er, out_dir=out_dir, traces=traces[r.key], stats=stats[r.key]
+                    )
+                    ed.write_region(er, toweb=True)
+                    progress.update()
 
         log.info(f"Wrote {len(self.config['regions'])} single-region gleam trace files")
-        with open(out_json, "wt") as f:
-            json.dump(ed.to_json(toweb=True), f)
         log.info(f"Wrote gleam chart data into {out_json}")
         return out_dir
 
     def store_region_estimates(self, regions: Regions, est_key, reg_data_key):
         """
         Transfer values from `Region.est[est_key]` to `self.region_data[reg_key][reg_data_key]`
-        for regions selected in the config.
+        for regions selected in the config (None for missing values).
         """
-        for rk in self.config["regions"]:
-            r = regions[rk]
+        keys = self.config["regions"]
+        for rk, v in zip(keys, regions.estimates.column(est_key, keys)):
             self.region_data.setdefault(rk, dict())
-            self.region_data[rk][reg_data_key] = float(r.est.get(est_key))
+            self.region_data[rk][reg_data_key] = None if np.isnan(v) else float(v)
+
+    def save_estimates(self, regions: Regions):
+        "Save a snapshot of all the region estimates to the batch directory"
+        path = self.get_out_dir() / self.ESTIMATES_FILE_NAME
+        EstimateStore.save_snapshot(regions.estimates.snapshot(), path)
+        log.info(f"Saved estimates snapshot to {path}")
+
+    def load_estimates(self):
+        "Load the snapshot saved by `save_estimates`, e.g. for `EstimateStore.diff`"
+        return EstimateStore.load_snapshot(
+            self.get_out_dir() / self.ESTIMATES_FILE_NAME
+        )
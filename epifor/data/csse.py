@@ -7,7 +7,7 @@ import numpy as np
 import pandas as pd
 import datetime
 
-from ..common import SKIP, UNABBREV, _n
+from ..common import SKIP, UNABBREV, _n, _n_many
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +28,7 @@ class CSSEData:
     def __init__(self):
         self.df = None
         self.hist_df = None
+        self.dates = None
 
     @staticmethod
     def convert_date(string):
@@ -78,12 +79,20 @@ class CSSEData:
 
         self.hist_df = pd.DataFrame(columns=columns_list)
         self.df = d
-
-    def apply_to_regions(self, regions):
-        """Add estimates to the regions. Note: adds to existing numbers!"""
-        d = self.hist_df
-        for _i, r in self.df.iterrows():
-            province, country = _n(r["Province/State"]), _n(r["Country/Region"])
+        # Dates with all the data (`YYYYMMDD`)
+        self.dates = shortest_list_dcs
+
+    def match_rows(self, regions):
+        """
+        Yield `(row, Region, province, country)` for the CSSE rows matching a Region.
+
+        Rows that are skipped or do not match exactly one Region are logged.
+        """
+        # Normalize the names of all rows at once
+        provinces = _n_many(self.df["Province/State"]).values
+        countries = _n_many(self.df["Country/Region"]).values
+        for i, (_i, r) in enumerate(self.df.iterrows()):
+            province, country = provinces[i], countries[i]
             if _n(province) in SKIP or _n(country) in SKIP:
                 continue
             name = country if province == "nan" else province
@@ -107,8 +116,10 @@ class CSSEData:
 
             regs = regions.find_names(name, kind)
             if len(regs) < 1:
+                closest = regions.find_names_fuzzy(name, kind, limit=3)
                 log.warning(
                     f"CSSE region {name!r} [{kind}, from {country}/{province}] not found in Regions, skipping"
+                    f" (closest: {[r.key for _s, r in closest]!r})"
                 )
                 continue
             if len(regs) > 1:
@@ -119,7 +130,24 @@ class CSSEData:
                     regs,
                 )
                 continue
-            reg = regs[0]
+            yield r, regs[0], province, country
+
+    def active_by_date(self, regions, date):
+        """
+        Return `{region_key: active}` for the loaded date nearest to `date`.
+
+        Accumulated over rows as in `apply_to_regions`, without modifying the regions.
+        """
+        col = f"active_{self.nearest_date(self.dates, date.strftime('%Y%m%d'))}"
+        res = {}
+        for r, reg, _province, _country in self.match_rows(regions):
+            res[reg.key] = res.get(reg.key, 0.0) + r[col]
+        return res
+
+    def apply_to_regions(self, regions):
+        """Add estimates to the regions. Note: adds to existing numbers!"""
+        d = self.hist_df
+        for r, reg, province, country in self.match_rows(regions):
 
             # Accumulation used in US counties/cities etc.
             def app(name, col):
@@ -0,0 +1,191 @@
+import datetime
+import logging
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from ..gleam.aggregation import GLEAM_LEVELS
+from ..gleam.simulation import Simulation
+from .batch import SIM_DEF_DIR, Batch
+
+log = logging.getLogger(__name__)
+
+
+class SimPool:
+    """
+    Loaded Simulations by directory, shared by several batches.
+
+    Every result file is opened only once, `close` closes all of them.
+    """
+
+    def __init__(self):
+        # {resolved dir: Simulation or None}
+        self.sims = {}
+
+    def get(self, path):
+        "Return the Simulation with results in `path`, or None"
+        path = Path(path).expanduser().resolve()
+        if path not in self.sims:
+            sim = None
+            if (path / Simulation.RESULT_FILE_NAME).exists():
+                sim = Simulation.load_dir(path)
+            self.sims[path] = sim
+        return self.sims[path]
+
+    def close(self):
+        for sim in self.sims.values():
+            if sim is not None:
+                for f in (sim.hdf, sim.repacked):
+                    if f is not None:
+                        f.close()
+        self.sims = {}
+
+
+class BatchEnsemble:
+    """
+    Several batches (e.g. all the daily batches in `output_dir`) analysed together.
+
+    The batches share one `SimPool` and one series cache (`Batch.seq_cache`).
+    `load_series` reads the series of many regions with one dataset read per
+    simulation and level. `active` aligns the batches by calendar day into arrays
+    of shape (batch, group, scenario, region, day), see also `deltas` and
+    `consensus`.
+    """
+
+    def __init__(self, batches, dirs=None, sims_dir=None, aggregator=None):
+        order = sorted(range(len(batches)), key=lambda i: batches[i].created)
+        self.batches = [batches[i] for i in order]
+        # Batch directories (default: from the batch config)
+        if dirs is None:
+            self.dirs = [b.get_out_dir(create=False) for b in self.batches]
+        else:
+            self.dirs = [Path(dirs[i]) for i in order]
+        self.sims_dir = sims_dir
+        self.pool = SimPool()
+        self.seq_cache = {}
+        for b in self.batches:
+            b.seq_cache = self.seq_cache
+            b.set_aggregator(aggregator)
+        self.groups = _unique(bs.group for b in self.batches for bs in b.sims)
+        self.scenarios = _unique(bs.name for b in self.batches for bs in b.sims)
+
+    @classmethod
+    def index(cls, output_dir, sims_dir=None, aggregator=None):
+        "All the batches in the subdirectories of `output_dir`"
+        # Files named `Batch.BATCH_FILE_NAME` (a property at class level)
+        paths = sorted(Path(output_dir).expanduser().glob("*/batch.yaml"))
+        batches = [Batch.load(p) for p in paths]
+        log.info(f"Indexed {len(batches)} batches in {output_dir}")
+        return cls(batches, [p.parent for p in paths], sims_dir, aggregator)
+
+    def _sim_dirs(self, bi):
+        "Candidate sims dirs of a batch, in order of preference"
+        if self.sims_dir is not None:
+            return [Path(self.sims_dir)]
+        b = self.batches[bi]
+        gleam = Path(b.config["gleamviz_dir"]).expanduser() / "data" / "sims"
+        return [gleam, self.dirs[bi] / SIM_DEF_DIR]
+
+    def load_sims(self):
+        "Load the sims with results of all the batches (others get `bs.sim = None`)"
+        n, n_res = 0, 0
+        for bi, b in enumerate(self.batches):
+            for bs in b.sims:
+                bs.sim = None
+                for d in self._sim_dirs(bi):
+                    bs.sim = self.pool.get(d / f"{bs.id}.gvh5")
+                    if bs.sim is not None:
+                        n_res += 1
+                        break
+                n += 1
+        log.info(f"Loaded {n_res} of {n} simulations of {len(self.batches)} batches")
+
+    def load_series(self, regions):
+        "Read the series of the regions with GLEAM results into the series cache"
+        by_kind = {}
+        for r in regions:
+            if r.gleam_id is not None and r.kind in ("city", *GLEAM_LEVELS):
+                by_kind.setdefault(r.kind, []).append(r)
+        for b in self.batches:
+            for bs in b.sims:
+                if bs.sim is None:
+                    continue
+                for kind, regs in by_kind.items():
+                    regs = [r for r in regs if (bs.id, r.key) not in self.seq_cache]
+                    if not regs:
+                        continue
+                    seqs = bs.sim.get_seqs([r.gleam_id for r in regs], kind)
+                    for r, sq in zip(regs, seqs):
+                        self.seq_cache[(bs.id, r.key)] = sq
+
+    def active(self, regions):
+        """
+        Return `(days, values)` with the active infected per 1000 of the regions.
+
+        `values` has shape (batch, group, scenario, region, day) over the calendar
+        `days` of all the batches, NaN where missing. As in the exported traces,
+        the series are shifted by the `Batch.get_initial_number` of the batch.
+        """
+        self.load_series(regions)
+        # [(batch, group, scenario, start_date, array (region, day))]
+        series = []
+        for bi, b in enumerate(self.batches):
+            sims = [bs for bs in b.sims if bs.sim is not None]
+            if not sims:
+                continue
+            # (sim, region, compartment, day)
+            sqs = np.array([[b.get_seq(bs, r) for r in regions] for bs in sims])
+            act = sqs[:, :, 2, :] - sqs[:, :, 3, :]
+            initial = np.maximum(-np.min(act, axis=(0, 2)), 0.0)
+            for bs, a in zip(sims, act):
+                start = bs.sim.definition.get_start_date().date()
+                series.append(
+                    (
+                        bi,
+                        self.groups.index(bs.group),
+                        self.scenarios.index(bs.name),
+                        start,
+                        (a + initial[:, None]) * 1000,
+                    )
+                )
+        if not series:
+            return [], np.zeros((len(self.batches), 0, 0, len(regions), 0))
+        first = min(s[3] for s in series)
+        n_days = max((s[3] - first).days + s[4].shape[1] for s in series)
+        days = [first + datetime.timedelta(days=i) for i in range(n_days)]
+        values = np.full(
+            (
+                len(self.batches),
+                len(self.groups),
+                len(self.scenarios),
+                len(regions),
+                n_days,
+            ),
+            np.nan,
+        )
+        for bi, gi, si, start, a in series:
+            d0 = (start - first).days
+            values[bi, gi, si, :, d0 : d0 + a.shape[1]] = a
+        return days, values
+
+    @staticmethod
+    def deltas(values):
+        "Changes between consecutive batches, shape (batch - 1, ...)"
+        return values[1:] - values[:-1]
+
+    @staticmethod
+    def consensus(values, qs=(0.05, 0.5, 0.95)):
+        "Quantiles over the batches (ignoring NaNs), shape (quantile, ...)"
+        with warnings.catch_warnings():
+            # All-NaN slices (days not covered by any batch)
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanquantile(values, qs, axis=0)
+
+    def close(self):
+        self.pool.close()
+
+
+def _unique(items):
+    "Unique items in order of first appearance"
+    return list(dict.fromkeys(items))
@@ -1,11 +1,67 @@
 import datetime
 import getpass
+import gzip
 import json
+import logging
 import socket
+from pathlib import Path
 
-from ..common import _fs
+import numpy as np
+
+from ..common import _e, _fs
 from ..regions import Region
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    r = _e(o)
+    if r is o:
+        raise TypeError(f"Object of type {type(o)} is not JSON serializable")
+    return r
+
+
+def json_dumps_bytes(obj):
+    "Encode `obj` as JSON bytes, using `orjson` when available."
+    if orjson is not None:
+        return orjson.dumps(
+            obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY
+        )
+    return json.dumps(obj, default=_json_default).encode("utf8")
+
+
+def json_loads_bytes(data):
+    "Decode JSON bytes, using `orjson` when available."
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def read_bytes(path):
+    "Read a file, decompressing `.gz` and `.br` files (as written by `ExportDocWriter`)"
+    path = Path(path)
+    if path.suffix == ".gz":
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    data = path.read_bytes()
+    if path.suffix == ".br":
+        if brotli is None:
+            raise ImportError(f"Module brotli needed to read {path}")
+        return brotli.decompress(data)
+    return data
+
 
 class ExportDoc:
     def __init__(self, comment=None):
@@ -13,6 +69,8 @@ class ExportDoc:
         self.created_by = f"{getpass.getuser()}@{socket.gethostname()}"
         self.comment = comment
         self.regions = {}
+        # The file of a loaded (or written) document
+        self.path = None
 
     def to_json(self, toweb=False):
         return _fs(
@@ -26,7 +84,32 @@ class ExportDoc:
 
     @classmethod
     def from_json(cls, data):
-        pass  # TODO
+        ed = cls(comment=data.get("comment"))
+        if data.get("created") is not None:
+            ed.created = datetime.datetime.fromisoformat(data["created"])
+        ed.created_by = data.get("created_by")
+        for k, d in data["regions"].items():
+            ed.regions[k] = ExportRegion.from_json(d, key=k)
+        return ed
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an exported document (optionally `.gz` or `.br` compressed).
+
+        The traces files are not read, see `load_traces`.
+        """
+        ed = cls.from_json(json_loads_bytes(read_bytes(path)))
+        ed.path = Path(path)
+        return ed
+
+    def load_traces(self, key):
+        "Load the `{group: [plotly_traces]}` of a region of a loaded document, or None"
+        url = self[key].data.get("infected_per_1000", {}).get("traces_url")
+        if url is None:
+            return None
+        # The URLs are relative to the parent of the export dir
+        return json_loads_bytes(read_bytes(self.path.parent.parent / url))
 
     def __getitem__(self, o):
         if isinstance(o, str):
@@ -43,6 +126,103 @@ class ExportDoc:
         return er
 
 
+class ExportDocWriter(ExportDoc):
+    """
+    Streaming variant of `ExportDoc` writing the document directly into a file.
+
+    Regions are written by `write_region` as soon as they are finished and are not
+    kept in memory. Optionally also writes precompressed siblings of the file
+    (`compress` may contain `"gz"` and `"br"`, the latter needs `brotli`).
+    Use as a context manager. The files are written under temporary names and
+    renamed on `close`, on an exception they are removed (see `abort`).
+    """
+
+    def __init__(self, path, comment=None, compress=()):
+        super().__init__(comment=comment)
+        self.path = Path(path)
+        self.written = 0
+        # [(temporary path, final path)]
+        self._files = [(_tmp_path(self.path), self.path)]
+        self._sinks = [open(self._files[0][0], "wb")]
+        self._brotli = None
+        for c in compress:
+            if c not in ("gz", "br"):
+                self.abort()
+                raise ValueError(f"Unknown compression {c!r}")
+            if c == "br" and brotli is None:
+                log.warning(f"Module brotli not available, not writing {c!r}")
+                continue
+            final = Path(f"{self.path}.{c}")
+            self._files.append((_tmp_path(final), final))
+            if c == "gz":
+                self._sinks.append(gzip.open(self._files[-1][0], "wb"))
+            else:
+                self._brotli = (brotli.Compressor(), open(self._files[-1][0], "wb"))
+        head = json_dumps_bytes(self.to_json())
+        assert head.endswith(b"{}}")
+        self._write(head[:-2])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write(self, data):
+        for s in self._sinks:
+            s.write(data)
+        if self._brotli is not None:
+            self._brotli[1].write(self._brotli[0].process(data))
+
+    def add_region(self, region):
+        assert isinstance(region, Region)
+        return ExportRegion(region)
+
+    def write_region(self, er, toweb=False):
+        "Write a finished ExportRegion into the document"
+        sep = b"," if self.written else b""
+        self._write(
+            sep + json_dumps_bytes({er.region.key: er.to_json(toweb=toweb)})[1:-1]
+        )
+        self.written += 1
+
+    def _close_sinks(self, finish):
+        for s in self._sinks:
+            s.close()
+        if self._brotli is not None:
+            comp, f = self._brotli
+            if finish:
+                f.write(comp.finish())
+            f.close()
+        self._sinks = None
+
+    def close(self):
+        "Finish the document and rename the files to their final names"
+        if self._sinks is None:
+            return
+        self._write(b"}}")
+        self._close_sinks(True)
+        for tmp, final in self._files:
+            tmp.replace(final)
+
+    def abort(self):
+        "Close and remove the unfinished files (the final files are not touched)"
+        if self._sinks is None:
+            return
+        self._close_sinks(False)
+        for tmp, _final in self._files:
+            if tmp.exists():
+                tmp.unlink()
+
+
+def _tmp_path(path):
+    "Temporary sibling of `path` for writing it atomically"
+    return path.with_name(f".{path.name}.tmp")
+
+
 class ExportRegion:
     def __init__(self, region):
         assert isinstance(region, Region)
@@ -69,5 +249,20 @@ class ExportRegion:
         )
 
     @classmethod
-    def from_json(cls, data):
-        pass  # TODO
+    def from_json(cls, data, key=None):
+        "Create an ExportRegion with a new (detached) Region"
+        fields = {
+            f: data.get(f)
+            for f in (
+                "kind",
+                "lat",
+                "lon",
+                "population",
+                "gleam_id",
+                "iso_alpha_3",
+                "max_percentage_of_infected_to_fill_icu_beds",
+            )
+        }
+        er = cls(Region(data["name"], key=key, **fields))
+        er.data = data.get("data", {})
+        return er
@@ -0,0 +1,135 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .export import ExportDoc
+
+log = logging.getLogger(__name__)
+
+# Default outlier thresholds {kind: (relative, absolute)}, both must be exceeded
+DIFF_THRESHOLDS = {"estimates": (0.25, 10.0), "mitigation_stats": (0.25, 1e-3)}
+
+
+class ExportDiff:
+    """
+    Aligned arrays of the estimates and `mitigation_stats` of two `ExportDoc`s.
+
+    Regions in both documents are aligned by key (`keys`), the estimates by day
+    (`days`, present in both) into arrays `old_est` and `new_est` of shape
+    (region, day, metric), the stats into `old_stats` and `new_stats` of shape
+    (region, group, stat), NaN for missing values. `added` and `removed` are the
+    keys in only one of the documents.
+    """
+
+    def __init__(self, old: ExportDoc, new: ExportDoc):
+        self.keys = [k for k in old.regions if k in new.regions]
+        self.added = [k for k in new.regions if k not in old.regions]
+        self.removed = [k for k in old.regions if k not in new.regions]
+
+        def est_days(doc):
+            return [doc[k].data.get("estimates", {}).get("days", {}) for k in self.keys]
+
+        def stats(doc):
+            return [doc[k].data.get("mitigation_stats", {}) for k in self.keys]
+
+        old_days, new_days = est_days(old), est_days(new)
+        days_o = set(d for ds in old_days for d in ds)
+        days_n = set(d for ds in new_days for d in ds)
+        self.days = sorted(days_o & days_n)
+        self.metrics = _keys2(old_days + new_days)
+        self.old_est = _array(old_days, self.days, self.metrics)
+        self.new_est = _array(new_days, self.days, self.metrics)
+
+        old_stats, new_stats = stats(old), stats(new)
+        self.groups = sorted(set(g for s in old_stats + new_stats for g in s))
+        self.stats = _keys2(old_stats + new_stats)
+        self.old_stats = _array(old_stats, self.groups, self.stats)
+        self.new_stats = _array(new_stats, self.groups, self.stats)
+
+    @classmethod
+    def load(cls, old_path, new_path):
+        return cls(ExportDoc.load(old_path), ExportDoc.load(new_path))
+
+    @staticmethod
+    def relative_change(old, new):
+        """
+        Return `|new - old| / |old|` (inf for nonzero change from zero, or for
+        values that became missing, NaN where both are missing or new values).
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rel = np.abs(new - old) / np.abs(old)
+        rel[(old == new)] = 0.0
+        rel[~np.isnan(old) & np.isnan(new)] = np.inf
+        return rel
+
+    @property
+    def rel_est(self):
+        return self.relative_change(self.old_est, self.new_est)
+
+    @property
+    def rel_stats(self):
+        return self.relative_change(self.old_stats, self.new_stats)
+
+    def outliers(self, thresholds=None):
+        """
+        Return a DataFrame of the changes exceeding both the relative and the absolute
+        threshold (see `DIFF_THRESHOLDS`), including the added and removed regions.
+
+        Columns are `kind`, `key`, `index` (day or group), `name` (metric or
+        stat), `old`, `new` and `rel`, sorted by decreasing `rel`.
+        """
+        thresholds = dict(DIFF_THRESHOLDS, **(thresholds or {}))
+        parts = []
+        arrays = {
+            "estimates": (self.old_est, self.new_est, self.days, self.metrics),
+            "mitigation_stats": (
+                self.old_stats,
+                self.new_stats,
+                self.groups,
+                self.stats,
+            ),
+        }
+        for kind, (old, new, index, names) in arrays.items():
+            rtol, atol = thresholds[kind]
+            rel = self.relative_change(old, new)
+            with np.errstate(invalid="ignore"):
+                absd = np.where(np.isnan(new), np.inf, np.abs(new - old))
+                bad = (rel > rtol) & (absd > atol)
+            ri, ii, ni = np.nonzero(bad)
+            parts.append(
+                pd.DataFrame(
+                    {
+                        "kind": kind,
+                        "key": np.array(self.keys, dtype=object)[ri],
+                        "index": np.array(index, dtype=object)[ii],
+                        "name": np.array(names, dtype=object)[ni],
+                        "old": old[bad],
+                        "new": new[bad],
+                        "rel": rel[bad],
+                    }
+                )
+            )
+        for kind, keys in [("added", self.added), ("removed", self.removed)]:
+            parts.append(pd.DataFrame({"kind": kind, "key": keys, "rel": np.inf}))
+        res = pd.concat(parts, ignore_index=True)
+        return res.sort_values("rel", ascending=False, kind="stable").reset_index(
+            drop=True
+        )
+
+
+def _keys2(dicts):
+    "Sorted union of the keys of the nested dicts `[{a: {b: v}}]`"
+    return sorted(set(k for d in dicts for d2 in d.values() for k in d2))
+
+
+def _array(dicts, index, names):
+    "Array of shape (len(dicts), index, names) from `[{index: {name: v}}]`"
+    res = np.full((len(dicts), len(index), len(names)), np.nan)
+    ni = {n: i for i, n in enumerate(names)}
+    for r, d in enumerate(dicts):
+        for i, x in enumerate(index):
+            for n, v in d.get(x, {}).items():
+                if v is not None:
+                    res[r, i, ni[n]] = v
+    return res
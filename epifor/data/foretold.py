@@ -71,6 +71,8 @@ class FTData:
         self.predictions = []
         # entire loaded json file
         self._loaded = None
+        # region_key -> FTPrediction applied by `apply_to_regions`
+        self.applied = {}
 
     def last_before(self, date):
         res = {}
@@ -108,6 +110,41 @@ class FTData:
         """
         return pd.concat(prediction.to_dataframe() for prediction in self.predictions)
 
+    def match_predictions(self, regions, predictions):
+        """
+        Yield `(FTPrediction, Region)` for the given predictions matching a Region.
+
+        Predictions that do not match exactly one Region are logged.
+        """
+        for p in predictions:
+            if _n(p.name) in SKIP:
+                continue
+            kinds = SELECT_KINDS.get(_n(p.name))
+            regs = regions.find_names(p.name, kinds=kinds)
+            if len(regs) < 1:
+                closest = regions.find_names_fuzzy(p.name, kinds=kinds, limit=3)
+                log.warning(
+                    "Foretold region %r not found in Regions, skipping (closest: %r)",
+                    p.name,
+                    [r.key for _s, r in closest],
+                )
+                continue
+            if len(regs) > 1:
+                log.warning(
+                    "Foretold region %r matches several Regions: %r, skipping",
+                    p.name,
+                    regs,
+                )
+                continue
+            yield p, regs[0]
+
+    def means_before(self, regions, before):
+        """Return `{region_key: mean}` of the last predictions before a date."""
+        d = self.last_before(before)
+        return {
+            reg.key: p.mean for p, reg in self.match_predictions(regions, d.values())
+        }
+
     def apply_to_regions(self, regions, before=None):
         if before:
             d = self.last_before(before)
@@ -121,20 +158,7 @@ class FTData:
                 len(d), ", ".join(dlist)
             )
         )
-        for p in d.values():
-            if _n(p.name) in SKIP:
-                continue
-            regs = regions.find_names(p.name, kinds=SELECT_KINDS.get(_n(p.name)))
-            if len(regs) < 1:
-                log.warning("Foretold region %r not found in Regions, skipping", p.name)
-                continue
-            if len(regs) > 1:
-                log.warning(
-                    "Foretold region %r matches several Regions: %r, skipping",
-                    p.name,
-                    regs,
-                )
-                continue
-            reg = regs[0]
+        for p, reg in self.match_predictions(regions, d.values()):
             reg.est["ft_mean"] = p.mean
             reg.est["ft_var"] = p.var
+            self.applied[reg.key] = p
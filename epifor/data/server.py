@@ -0,0 +1,217 @@
+import asyncio
+import concurrent.futures
+import gzip
+import logging
+import urllib.parse
+from collections import OrderedDict
+
+from ..gleam.aggregation import GLEAM_LEVELS
+from .batch import Batch, EstimatesTable
+from .export import ExportRegion, json_dumps_bytes
+
+log = logging.getLogger(__name__)
+
+
+class RegionServer:
+    """
+    Local HTTP server computing region traces, stats and estimates of a `Batch` on demand.
+
+    Serves `GET /regions` (the list of regions) and `GET /regions/KEY` (the region
+    as in the export, with the traces inline in `data.infected_per_1000.traces`).
+    The payloads are computed in a worker thread (the loop keeps serving cached
+    regions), concurrent requests for a region share one computation and the
+    encoded (and gzipped) payloads are kept in an LRU cache of `cache_size`
+    regions. After every request the subregions and siblings of the region are
+    prefetched (up to `prefetch` of them) while there are no other requests.
+    """
+
+    def __init__(self, batch: Batch, regions, table=None, cache_size=256, prefetch=8):
+        self.batch = batch
+        self.regions = regions
+        if table is not None and not isinstance(table, EstimatesTable):
+            table = EstimatesTable(table)
+        self.table = table
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        # {key: (json_bytes, gzip_bytes)}
+        self.cache = OrderedDict()
+        # {key: Future} of the payloads being computed
+        self._pending = {}
+        self._requests = 0
+        self._queue = None
+        # h5py is not thread-safe, so a single worker
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._index = None
+
+    def has_results(self, region):
+        return self.batch.aggregator is not None or (
+            region.gleam_id is not None and region.kind in ("city", *GLEAM_LEVELS)
+        )
+
+    def region_payload(self, key):
+        "Compute the JSON-like region payload (blocking)"
+        region = self.regions[key]
+        er = ExportRegion(region)
+        if self.table is not None:
+            self.batch.export_region_estimates(er, self.table)
+        traces, stats = self.batch.generate_region_traces_and_stats(region)
+        er.data["infected_per_1000"] = {"traces": traces}
+        er.data["mitigation_stats"] = stats
+        return dict(er.to_json(toweb=True), key=key)
+
+    def _encode(self, payload):
+        data = json_dumps_bytes(payload)
+        return data, gzip.compress(data, compresslevel=5)
+
+    async def get_region(self, key):
+        "Return the encoded region payload `(json_bytes, gzip_bytes)`"
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[key] = loop.run_in_executor(
+                self._executor, lambda: self._encode(self.region_payload(key))
+            )
+        fut = self._pending[key]
+        try:
+            res = await asyncio.shield(fut)
+        finally:
+            if fut.done():
+                self._pending.pop(key, None)
+        self.cache[key] = res
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return res
+
+    def regions_index(self):
+        "Encoded list of the regions with results (computed once)"
+        if self._index is None:
+            config_regions = set(self.batch.config.get("regions", ()))
+            self._index = self._encode(
+                [
+                    {
+                        "key": r.key,
+                        "name": r.name,
+                        "kind": r.kind,
+                        "parent": r.parent.key if r.parent is not None else None,
+                        "exported": r.key in config_regions,
+                    }
+                    for r in self.regions.regions
+                    if self.has_results(r)
+                ]
+            )
+        return self._index
+
+    def _neighbours(self, key):
+        "Regions to prefetch after `key`: subregions, then siblings"
+        r = self.regions[key]
+        res = list(r.sub)
+        if r.parent is not None:
+            res.extend(s for s in r.parent.sub if s is not r)
+        return [s.key for s in res if self.has_results(s)][: self.prefetch]
+
+    async def _prefetcher(self):
+        while True:
+            key = await self._queue.get()
+            while self._requests > 0:
+                await asyncio.sleep(0.05)
+            if key in self.cache or key in self._pending:
+                continue
+            try:
+                await self.get_region(key)
+                log.debug(f"Prefetched {key!r}")
+            except Exception:
+                log.exception(f"Prefetching {key!r} failed")
+
+    async def handle(self, reader, writer):
+        self._requests += 1
+        headers = {}
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin1").split("\r\n")
+            method, target = lines[0].split(" ")[:2]
+            for l in lines[1:]:
+                if ":" in l:
+                    k, v = l.split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+            status, body = await self._route(method, target)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status, body = 400, self._encode({"error": "Bad request"})
+        finally:
+            self._requests -= 1
+        gz = "gzip" in headers.get("accept-encoding", "")
+        data = body[1] if gz else body[0]
+        resp = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(data)}",
+            "Access-Control-Allow-Origin: *",
+            "Connection: close",
+        ]
+        if gz:
+            resp.append("Content-Encoding: gzip")
+        writer.write(("\r\n".join(resp) + "\r\n\r\n").encode("latin1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, target):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path).rstrip("/")
+        if method != "GET":
+            return 405, self._encode({"error": f"Method {method} not allowed"})
+        if path == "/regions":
+            return 200, self.regions_index()
+        if path.startswith("/regions/"):
+            key = path[len("/regions/") :]
+            if key not in self.regions or not self.has_results(self.regions[key]):
+                return 404, self._encode({"error": f"Region {key!r} not available"})
+            try:
+                body = await self.get_region(key)
+            except Exception as e:
+                log.exception(f"Computing region {key!r} failed")
+                return 500, self._encode({"error": str(e)})
+            for k in self._neighbours(key):
+                self._queue.put_nowait(k)
+            return 200, body
+        return 404, self._encode({"error": f"Unknown path {path!r}"})
+
+    async def start(self, host="127.0.0.1", port=8000):
+        "Start serving, returns the `asyncio.Server`"
+        self._queue = asyncio.Queue()
+        self._prefetch_task = asyncio.ensure_future(self._prefetcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        for s in server.sockets:
+            log.info(f"Serving regions of {self.batch.name} on {s.getsockname()}")
+        return server
+
+    async def stop(self, server):
+        server.close()
+        await server.wait_closed()
+        self._prefetch_task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def run(self, host="127.0.0.1", port=8000):
+        "Serve until interrupted"
+
+        async def main():
+            server = await self.start(host, port)
+            try:
+                await server.serve_forever()
+            finally:
+                await self.stop(server)
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            log.info("Stopped")
+
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
@@ -0,0 +1,145 @@
+import logging
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from ..gleam.gleamdef import GleamDef
+from ..gleam.simulation import Simulation
+from .batch import Batch, EstimatesTable
+from .export import ExportDocWriter, ExportRegion
+
+log = logging.getLogger(__name__)
+
+
+class BatchWatcher:
+    """
+    Incrementally export a batch as its simulations finish.
+
+    The simulation directories are polled with `stat` only; a `results.h5` is
+    considered complete when its size and mtime did not change between two polls.
+    On every update only the traces and stats of the groups with new results are
+    recomputed (all groups of a region if its initial number changed), the series
+    of the already loaded sims come from the batch series cache.
+    """
+
+    def __init__(self, batch: Batch, regions, sims_dir=None, compress=()):
+        self.batch = batch
+        self.regions = [regions[k] for k in batch.config["regions"]]
+        if sims_dir is None:
+            self.sims_dir = batch.get_data_sims_dir()
+        else:
+            self.sims_dir = Path(sims_dir)
+        self.compress = compress
+        self.batch.seq_cache = {}
+        # Only the definitions, results are opened once `poll` finds them complete
+        for bs in self.batch.sims:
+            d = self.sims_dir / f"{bs.id}.gvh5"
+            bs.sim = Simulation(GleamDef(d / "definition.xml"), None, d)
+
+        self.out_dir = batch.generate_export_dir()
+        table = EstimatesTable(pd.read_hdf(batch.get_out_dir() / batch.HIST_FILE_NAME))
+        # {region_key: ExportRegion} with estimates filled in
+        self.export_regions = {}
+        for r in self.regions:
+            er = ExportRegion(r)
+            batch.export_region_estimates(er, table)
+            self.export_regions[r.key] = er
+
+        # {sim_id: (mtime, size)} from the last poll
+        self._signatures = {}
+        # Ids of sims with complete results
+        self.done = set()
+        # {region_key: initial_number}
+        self.initial_numbers = {}
+        # {region_key: {group: traces or stats}}
+        self.traces = {r.key: {} for r in self.regions}
+        self.stats = {r.key: {} for r in self.regions}
+
+    def result_path(self, bs):
+        return self.sims_dir / f"{bs.id}.gvh5" / Simulation.RESULT_FILE_NAME
+
+    def poll(self):
+        """Return the SimInfos with newly completed results since the last poll."""
+        new = []
+        for bs in self.batch.sims:
+            if bs.id in self.done:
+                continue
+            try:
+                st = self.result_path(bs).stat()
+            except FileNotFoundError:
+                continue
+            sig = (st.st_mtime_ns, st.st_size)
+            if self._signatures.get(bs.id) == sig:
+                new.append(bs)
+            self._signatures[bs.id] = sig
+        return new
+
+    def finished(self):
+        return len(self.done) == len(self.batch.sims)
+
+    def update(self, new_sims):
+        """Load the new sims (if not loaded), update the traces and the export."""
+        loaded = []
+        for bs in new_sims:
+            if bs.sim is None or not bs.sim.has_result():
+                try:
+                    bs.sim = Simulation.load_dir(self.result_path(bs).parent)
+                except OSError as e:
+                    log.warning(f"Failed to open results of {bs.name!r}, retrying: {e}")
+                    continue
+            self.done.add(bs.id)
+            loaded.append(bs)
+        if not loaded:
+            return
+        new_groups = set(bs.group for bs in loaded)
+        all_groups = set(bs.group for bs in self.batch.sims)
+
+        for r in self.regions:
+            inum = self.batch.get_initial_number(r)
+            if inum != self.initial_numbers.get(r.key):
+                groups = all_groups
+            else:
+                groups = new_groups
+            self.initial_numbers[r.key] = inum
+            for g in groups:
+                sims = [
+                    bs for bs in self.batch.sims if bs.group == g and bs.id in self.done
+                ]
+                self.traces[r.key][g] = self.batch.generate_simgroup_traces(
+                    r, sims, inum, skip_days=2
+                )
+                if sims:
+                    self.stats[r.key][g] = self.batch.generate_simgroup_stats(
+                        r, sims, inum
+                    )
+            self.batch.export_region_traces(
+                self.export_regions[r.key],
+                out_dir=self.out_dir,
+                traces=self.traces[r.key],
+                stats=self.stats[r.key],
+            )
+        self.write_data()
+        log.info(
+            f"Updated {len(self.regions)} regions with {len(loaded)} new simulations"
+            f" ({len(self.done)}/{len(self.batch.sims)} done)"
+        )
+
+    def write_data(self):
+        "Write the data document (atomically, see `ExportDocWriter`)"
+        out_json = self.out_dir / self.batch.DATA_FILE_NAME
+        with ExportDocWriter(
+            out_json, comment=f"{self.batch.name}", compress=self.compress
+        ) as ed:
+            for er in self.export_regions.values():
+                ed.write_region(er, toweb=True)
+
+    def run(self, interval=30.0):
+        """Poll and update until all simulations are done, return the export dir."""
+        # Results present at startup are also only read once they are unchanged
+        self.poll()
+        while not self.finished():
+            time.sleep(interval)
+            self.update(self.poll())
+        log.info(f"All {len(self.batch.sims)} simulations done")
+        return self.out_dir
@@ -0,0 +1,84 @@
+import logging
+
+import numpy as np
+import scipy.sparse
+
+from .common import _n_many
+
+log = logging.getLogger(__name__)
+
+
+def trigrams(name):
+    "Set of character trigrams of a normalized name (padded with spaces)"
+    s = f"  {name} "
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+class TrigramIndex:
+    """
+    Fuzzy name lookup over the normalized names of Regions.
+
+    Names are indexed as a sparse 0/1 (name, trigram) matrix and candidates are
+    ranked by the Jaccard similarity of their trigram sets, computed for many
+    queries at once as a sparse matrix product.
+    """
+
+    def __init__(self, regions):
+        # Normalized names and their regions, as in `Regions.all_names_index`
+        self.names = list(regions.all_names_index.keys())
+        self.name_regions = [tuple(regions.all_names_index[n]) for n in self.names]
+        self.vocab = {}
+        self.matrix = self._matrix(self.names, grow=True)
+        self.sizes = np.asarray(self.matrix.sum(axis=1)).reshape(-1)
+
+    def _matrix(self, names, grow=False):
+        rows, cols = [], []
+        for i, n in enumerate(names):
+            for t in trigrams(n):
+                j = self.vocab.get(t)
+                if j is None:
+                    if not grow:
+                        continue
+                    j = self.vocab[t] = len(self.vocab)
+                rows.append(i)
+                cols.append(j)
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(names), len(self.vocab)),
+        )
+
+    def lookup_many(self, names, kinds=None, limit=5, min_score=0.3):
+        """
+        Ranked fuzzy lookup of many names at once.
+
+        Returns a list (one per name) of lists of `(score, Region)`, best first,
+        with scores in [0, 1] and only Regions of `kinds` (if given).
+        """
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        qnames = list(_n_many(list(names)))
+        q = self._matrix(qnames)
+        qsizes = np.array([len(trigrams(n)) for n in qnames], dtype=np.float32)
+        inter = (q @ self.matrix.T).tocsr()
+        res = []
+        for i in range(len(qnames)):
+            lo, hi = inter.indptr[i], inter.indptr[i + 1]
+            cand, common = inter.indices[lo:hi], inter.data[lo:hi]
+            scores = common / (qsizes[i] + self.sizes[cand] - common)
+            order = np.argsort(-scores, kind="stable")
+            found = []
+            seen = set()
+            for j in order:
+                if scores[j] < min_score or len(found) >= limit:
+                    break
+                for r in self.name_regions[cand[j]]:
+                    if (kinds is None or r.kind in kinds) and r.key not in seen:
+                        seen.add(r.key)
+                        found.append((float(scores[j]), r))
+            res.append(found[:limit])
+        return res
+
+    def lookup(self, name, kinds=None, limit=5, min_score=0.3):
+        "Ranked fuzzy lookup of a single name, see `lookup_many`."
+        res = self.lookup_many([name], kinds=kinds, limit=limit, min_score=min_score)
+        return res[0]
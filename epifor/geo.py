@@ -0,0 +1,159 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+log = logging.getLogger(__name__)
+
+# Same as `common.geo_dist`
+EARTH_RADIUS_KM = 6373.0
+
+AIRPORTS_PATH = Path(__file__).parents[1] / "data" / "airports" / "airports.dat"
+AIRPORTS_COLUMNS = [
+    "airport_id",
+    "name",
+    "city",
+    "country",
+    "iata",
+    "icao",
+    "lat",
+    "lon",
+    "altitude",
+    "utc_offset",
+    "dst",
+    "tz",
+    "type",
+    "source",
+]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km between points given in degrees.
+
+    Vectorized version of `common.geo_dist`, the arguments are broadcast.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat1 - lat2) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon1 - lon2) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def pairwise_distances(lat1, lon1, lat2=None, lon2=None):
+    """
+    Matrix of great-circle distances in km between two point sets (or within one).
+    """
+    if lat2 is None:
+        lat2, lon2 = lat1, lon1
+    lat1, lon1 = np.asarray(lat1, dtype=float), np.asarray(lon1, dtype=float)
+    lat2, lon2 = np.asarray(lat2, dtype=float), np.asarray(lon2, dtype=float)
+    return haversine(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+
+def unit_vectors(lat, lon):
+    "Points in degrees as an array (point, 3) of unit vectors"
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(
+        np.asarray(lon, dtype=float)
+    )
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+def _chord_to_km(c):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(c / 2, 0.0, 1.0))
+
+
+def _km_to_chord(d):
+    return 2 * np.sin(np.clip(d / EARTH_RADIUS_KM, 0.0, np.pi) / 2)
+
+
+def load_airports(path=AIRPORTS_PATH):
+    "Load OpenFlights airports.dat as a DataFrame (missing values as NaN)"
+    return pd.read_csv(path, header=None, names=AIRPORTS_COLUMNS, na_values=["\\N"])
+
+
+class SpatialIndex:
+    """
+    Nearest-neighbour and radius queries over points on the Earth.
+
+    The points are indexed as unit vectors in a KD-tree, where the chord distance
+    is monotone in the great-circle distance, so the queries are exact.
+    `items` are the objects corresponding to the points (e.g. Regions).
+    """
+
+    def __init__(self, lat, lon, items=None):
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        assert lat.shape == lon.shape and lat.ndim == 1
+        self.lat = lat
+        self.lon = lon
+        self.items = items if items is not None else np.arange(len(lat))
+        assert len(self.items) == len(lat)
+        self.tree = cKDTree(unit_vectors(lat, lon))
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_regions(cls, regions, kinds=None):
+        "Index Regions (optionally of given kinds) with known coordinates"
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        regs = [
+            r
+            for r in regions.regions
+            if r.lat is not None
+            and r.lon is not None
+            and (kinds is None or r.kind in kinds)
+        ]
+        return cls([r.lat for r in regs], [r.lon for r in regs], items=regs)
+
+    @classmethod
+    def from_airports(cls, airports=None):
+        "Index airports (DataFrame as from `load_airports`), items are the row labels"
+        if airports is None:
+            airports = load_airports()
+        airports = airports[airports["lat"].notna() & airports["lon"].notna()]
+        return cls(airports["lat"].values, airports["lon"].values, items=airports.index)
+
+    def query(self, lat, lon, k=1):
+        """
+        Find `k` nearest points to the given coordinates (scalars or arrays).
+
+        Returns `(distances_km, indices)` shaped as `cKDTree.query`.
+        """
+        c, idx = self.tree.query(unit_vectors(lat, lon), k=k)
+        return _chord_to_km(c), idx
+
+    def nearest(self, lat, lon, k=1):
+        "Return list of `(distance_km, item)` of the `k` nearest points to one location"
+        d, idx = self.query(lat, lon, k=k)
+        d, idx = np.atleast_1d(d), np.atleast_1d(idx)
+        return [(float(di), self.items[i]) for di, i in zip(d, idx) if i < len(self)]
+
+    def query_radius(self, lat, lon, radius_km):
+        """
+        Find all points within `radius_km` of the given coordinates.
+
+        Returns a sorted index list for a single location, or an object array of
+        sorted index lists for an array of locations.
+        """
+        res = self.tree.query_ball_point(
+            unit_vectors(lat, lon), _km_to_chord(radius_km)
+        )
+        # Sorted here, `return_sorted` needs scipy 1.6
+        if isinstance(res, list):
+            return sorted(res)
+        for i in np.ndindex(res.shape):
+            res[i] = sorted(res[i])
+        return res
+
+    def distances_from(self, lat, lon):
+        "Great-circle distances in km of all the indexed points from a location"
+        return haversine(lat, lon, self.lat, self.lon)
@@ -1,2 +1,5 @@
+from .aggregation import BasinAggregator
+from .basins import BasinTable
 from .gleamdef import GleamDef
+from .metapop import MetapopSimulator
 from .simulation import SimSet, Simulation
@@ -0,0 +1,96 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+from .basins import BasinTable
+
+log = logging.getLogger(__name__)
+
+# Region kinds with a GLEAM aggregation level: {kind: md_cities.tsv column}
+GLEAM_LEVELS = {"country": "Country ID", "continent": "Continent ID"}
+
+
+class BasinAggregator:
+    """
+    Aggregates per-basin simulation results to all the nodes of a region tree.
+
+    The membership is a sparse (region, basin) 0/1 matrix: a city contains its own
+    basin, a country or continent with `gleam_id` all the basins GLEAM assigns to it
+    in `md_cities.tsv` (see `BasinTable`), and every node also contains all the basins of its subtree.
+    Aggregating a simulation is then a single sparse x dense product.
+    The aggregates of the last `cache_size` simulations are kept (LRU).
+    """
+
+    def __init__(self, regions, table: BasinTable = None, cache_size=16):
+        if table is None:
+            table = BasinTable.load()
+        self.n_basins = len(table)
+
+        # Pre-order list of regions, row index by key
+        self.keys = []
+        self.index = {}
+        rows, cols = [], []
+
+        def rec(reg):
+            i = len(self.keys)
+            self.keys.append(reg.key)
+            self.index[reg.key] = i
+            basins = set()
+            if reg.gleam_id is not None:
+                if reg.kind == "city":
+                    if not 0 <= reg.gleam_id < self.n_basins:
+                        log.warning(f"Unknown GLEAM basin of {reg!r}, ignoring")
+                    else:
+                        basins.add(reg.gleam_id)
+                elif reg.kind in GLEAM_LEVELS:
+                    basins.update(table.rows_of(reg.kind, reg.gleam_id).tolist())
+            for r in reg.sub:
+                basins.update(rec(r))
+            rows.extend([i] * len(basins))
+            cols.extend(basins)
+            return basins
+
+        rec(regions.root)
+        self.matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(self.keys), self.n_basins)
+        )
+        # {(sim id, cumulative, sub): array (region, compartment, day)}
+        self._cache = OrderedDict()
+        self.cache_size = cache_size
+        log.debug(
+            f"Built basin aggregation for {len(self.keys)} regions ({len(rows)} memberships)"
+        )
+
+    def __contains__(self, region):
+        key = getattr(region, "key", region)
+        return key in self.index
+
+    def aggregate(self, data):
+        """
+        Aggregate array of shape (basin, ...) into array of shape (region, ...).
+
+        Rows are ordered as `self.keys`.
+        """
+        data = np.asarray(data)
+        assert data.shape[0] == self.n_basins
+        r = self.matrix @ data.reshape((self.n_basins, -1))
+        return r.reshape((len(self.keys),) + data.shape[1:])
+
+    def aggregate_sim(self, sim, cumulative=True, sub="median"):
+        """Return the cached (region, compartment, day) aggregate of a simulation."""
+        k = (sim.definition.get_id(), cumulative, sub)
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            return self._cache[k]
+        res = self.aggregate(sim.get_basin_seqs(cumulative=cumulative, sub=sub))
+        self._cache[k] = res
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return res
+
+    def get_seq(self, sim, region, cumulative=True, sub="median"):
+        """Return (compartment, day) series for a Region, as `Simulation.get_seq`."""
+        key = getattr(region, "key", region)
+        return self.aggregate_sim(sim, cumulative=cumulative, sub=sub)[self.index[key]]
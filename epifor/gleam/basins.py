@@ -0,0 +1,136 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ..geo import AIRPORTS_PATH, load_airports
+
+log = logging.getLogger(__name__)
+
+MD_CITIES_PATH = Path(__file__).parents[2] / "data" / "gleam" / "md_cities.tsv"
+
+# md_cities.tsv columns of the basin hierarchy: {level: column}
+BASIN_LEVELS = {
+    "country": "Country ID",
+    "region": "Region ID",
+    "continent": "Continent ID",
+    "hemisphere": "Hemisphere ID",
+}
+
+
+class BasinTable:
+    """
+    GLEAM basins (`md_cities.tsv`) joined with their airports (`airports.dat`).
+
+    The columns are arrays indexed by basin row (`COLUMNS`), rows are in basin order
+    (row == gleam_id for the GLEAM data). Lookups by gleam_id, IATA code and the
+    hierarchy levels of `BASIN_LEVELS` (-1 for unknown) are dict-based. Use `load` to cache the
+    compiled table in a `StageCache` as a single `.npz` file.
+    """
+
+    COLUMNS = (
+        "gleam_id",
+        "name",
+        "iata",
+        "lat",
+        "lon",
+        "tz",
+        "utc_offset",
+        "country_name",
+        *BASIN_LEVELS,
+    )
+
+    def __init__(self, columns):
+        for c in self.COLUMNS:
+            setattr(self, c, np.asarray(columns[c]))
+        self._rows = {int(g): i for i, g in enumerate(self.gleam_id)}
+        self._iata = {c: i for i, c in enumerate(self.iata) if c}
+        # {level: {id: rows}}
+        self._levels = {}
+        for level in BASIN_LEVELS:
+            ids = getattr(self, level)
+            order = np.argsort(ids, kind="stable")
+            uniq, starts = np.unique(ids[order], return_index=True)
+            self._levels[level] = dict(zip(uniq.tolist(), np.split(order, starts[1:])))
+
+    def __len__(self):
+        return len(self.gleam_id)
+
+    @classmethod
+    def from_sources(cls, md_cities_path=MD_CITIES_PATH, airports_path=AIRPORTS_PATH):
+        "Parse and join the source files"
+        md = pd.read_csv(md_cities_path, sep="\t")
+        airports = load_airports(airports_path)
+        airports = airports.dropna(subset=["iata"]).drop_duplicates("iata")
+        df = md.merge(
+            airports[["iata", "lat", "lon", "tz", "utc_offset"]],
+            how="left",
+            left_on="Airport code",
+            right_on="iata",
+        )
+        missing = df["iata"].isna()
+        if missing.any():
+            log.debug(f"{missing.sum()} GLEAM basin airports not in {airports_path}")
+        return cls(
+            {
+                "gleam_id": df["City ID"].values.astype(np.int32),
+                "name": df["City Name"].to_numpy(dtype=str),
+                "iata": df["Airport code"].fillna("").to_numpy(dtype=str),
+                "lat": df["lat"].values.astype(float),
+                "lon": df["lon"].values.astype(float),
+                "tz": df["tz"].fillna("").to_numpy(dtype=str),
+                "utc_offset": df["utc_offset"].values.astype(float),
+                "country_name": df["Country name"].to_numpy(dtype=str),
+                **{
+                    k: df[col].fillna(-1).to_numpy(dtype=np.int32)
+                    for k, col in BASIN_LEVELS.items()
+                },
+            }
+        )
+
+    @classmethod
+    def load(
+        cls, cache=None, md_cities_path=MD_CITIES_PATH, airports_path=AIRPORTS_PATH
+    ):
+        "Load the table, using the compiled version from `StageCache` if available"
+        if cache is None:
+            return cls.from_sources(md_cities_path, airports_path)
+        key = cache.stage_key("basins", files=[md_cities_path, airports_path])
+        d = cache.get("basins", key)
+        if d is not None:
+            return cls.load_npz(d / "basins.npz")
+        t = cls.from_sources(md_cities_path, airports_path)
+        with cache.store("basins", key) as d:
+            t.save_npz(d / "basins.npz")
+        return t
+
+    def save_npz(self, path):
+        np.savez(path, **{c: getattr(self, c) for c in self.COLUMNS})
+
+    @classmethod
+    def load_npz(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls({c: f[c] for c in cls.COLUMNS})
+
+    def row(self, gleam_id):
+        "Row of a basin by gleam_id (KeyError if unknown)"
+        return self._rows[gleam_id]
+
+    def by_iata(self, code):
+        "Row of a basin by its airport IATA code, or None"
+        return self._iata.get(code.upper())
+
+    def rows_of(self, level, id):
+        "Array of basin rows in a country, region, continent or hemisphere (by id)"
+        return self._levels[level].get(id, np.zeros(0, dtype=int))
+
+    def by_country(self, country_id):
+        return self.rows_of("country", country_id)
+
+    def to_dataframe(self):
+        "The table as a DataFrame indexed by gleam_id"
+        return pd.DataFrame(
+            {c: getattr(self, c) for c in self.COLUMNS if c != "gleam_id"},
+            index=pd.Index(self.gleam_id, name="basin"),
+        )
@@ -0,0 +1,379 @@
+import datetime
+import logging
+from pathlib import Path
+
+import h5py
+import numpy as np
+import scipy.sparse
+
+from ..common import die
+from ..geo import SpatialIndex, haversine
+from .basins import BASIN_LEVELS, BasinTable
+from .gleamdef import GleamDef
+from .simulation import Simulation
+
+log = logging.getLogger(__name__)
+
+# Hemisphere IDs of md_hemispheres.tsv
+NORTHERN, TROPICAL, SOUTHERN = 0, 1, 2
+
+# Day of year of the seasonality maximum (GLEAM: January 15th / July 15th)
+SEASONALITY_MAX_DAY = {NORTHERN: 15, SOUTHERN: 196}
+
+# Daily fraction of basin population travelling at 100% occupancy rate
+TRAVEL_FRACTION = 0.005
+
+# Attributes of the GleamDef exceptions listing the ids of each level
+EXCEPTION_ATTRS = {
+    "basin": "basins",
+    "country": "countries",
+    "region": "regions",
+    "continent": "continents",
+    "hemisphere": "hemispheres",
+}
+
+
+def load_basins(regions=None, table: BasinTable = None):
+    """
+    Load GLEAM basins as a DataFrame indexed by basin (gleam_id).
+
+    Has the columns of `BasinTable` and population from the cities of `regions`
+    (if given, NaN otherwise). Basins with an unknown airport use the city
+    coordinates from `regions` or the mean location of their country.
+    """
+    if table is None:
+        table = BasinTable.load()
+    df = table.to_dataframe()
+    df["pop"] = np.nan
+    if regions is not None:
+        for r in regions.regions:
+            if r.kind == "city" and r.gleam_id in df.index:
+                if r.pop is not None:
+                    df.loc[r.gleam_id, "pop"] = r.pop
+                if np.isnan(df.loc[r.gleam_id, "lat"]) and r.lat is not None:
+                    df.loc[r.gleam_id, ["lat", "lon"]] = r.lat, r.lon
+    # Fall back to the mean location of the country basins
+    for c in ("lat", "lon"):
+        df[c] = df[c].fillna(df.groupby("country")[c].transform("mean"))
+    missing = df["lat"].isna() | df["lon"].isna()
+    if missing.any():
+        log.warning(
+            f"{missing.sum()} basins without location: {list(df['name'][missing])}"
+        )
+    return df
+
+
+def mobility_matrix(basins, neighbours=20, hubs=200, gamma=2.0):
+    """
+    Gravity-model stand-in for the GLEAM air traffic as a sparse (basin, basin) matrix.
+
+    Every basin is linked to its nearest `neighbours` basins and the `hubs` most
+    populous basins are all linked together (long-distance traffic). The link
+    weights are `pop_i * pop_j / dist_ij ** gamma`, normalized per source basin.
+    The result is the symmetric number of daily travellers when everybody travels,
+    `min(pop_i * w_ij, pop_j * w_ji)`, so the traffic keeps basin populations.
+    """
+    lat, lon, pop = (basins[c].values for c in ("lat", "lon", "pop"))
+    n = len(basins)
+    # Basins without location stay unconnected
+    valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    k = min(neighbours + 1, len(valid))
+    _d, nn = SpatialIndex(lat[valid], lon[valid]).query(lat[valid], lon[valid], k=k)
+    hub = valid[np.argsort(-pop[valid])[:hubs]]
+    hi, hj = np.meshgrid(hub, hub)
+    i = np.concatenate([np.repeat(valid, k), hi.ravel()])
+    j = np.concatenate([valid[nn.ravel()], hj.ravel()])
+    # Both directions of every link, once
+    i, j = np.unique(np.stack([np.r_[i, j], np.r_[j, i]]), axis=1)
+    sel = i != j
+    i, j = i[sel], j[sel]
+    dist = np.maximum(haversine(lat[i], lon[i], lat[j], lon[j]), 50.0)
+    w = pop[i] * pop[j] / dist**gamma
+    w = w / np.bincount(i, weights=w, minlength=n)[i]
+    m = scipy.sparse.csr_matrix((pop[i] * w, (i, j)), shape=(n, n))
+    return m.minimum(m.T).tocsr()
+
+
+class CompartmentModel:
+    """
+    Compartmental model, parameters and seeds of a GleamDef.
+
+    Supports ratio transitions, infections (with any number of infectors),
+    initial compartment fractions, seeds, seasonality and variable exceptions.
+    """
+
+    def __init__(self, gv):
+        q = "./gv:definition/gv:compartmentalModel/gv:"
+        self.name = gv.get_name()
+        self.compartments = [
+            c.get("id") for c in gv.fa(q + "compartments/gv:compartment")
+        ]
+        self.travellers = [
+            c.get("isTraveller") == "true"
+            for c in gv.fa(q + "compartments/gv:compartment")
+        ]
+        self.transitions = [
+            (t.get("source"), t.get("target"), t.get("ratio"))
+            for t in gv.fa(q + "ratioTransitions/gv:ratioTransition")
+        ]
+        self.infections = [
+            (
+                i.get("source"),
+                i.get("target"),
+                [
+                    (f.get("source"), f.get("ratio"))
+                    for f in i.findall("gv:infector", gv.ns)
+                ],
+            )
+            for i in gv.fa(q + "infections/gv:infection")
+        ]
+        self.variables = {
+            v.get("name"): float(v.get("value"))
+            for v in gv.fa(q + "variables/gv:variable")
+        }
+
+        p = gv.f1("./gv:definition/gv:parameters")
+        self.start_date = gv.get_start_date().date()
+        self.duration = int(p.get("duration"))
+        self.seasonality = (
+            gv.get_seasonality() if p.get("seasonalityEnabled") == "true" else None
+        )
+        self.occupancy = gv.get_traffic_occupancy()
+        self.initial = {
+            c.get("compartment"): float(c.get("fraction")) / 100.0
+            for c in gv.fa(
+                "./gv:definition/gv:initialCompartments/gv:initialCompartment"
+            )
+        }
+        self.seeds = [
+            (int(s.get("city")), s.get("compartment"), float(s.get("number")))
+            for s in gv.fa("./gv:definition/gv:seeds/gv:seed")
+        ]
+        self.results = [
+            e.text for e in gv.fa("./gv:definition/gv:resultCompartments/gv:id")
+        ]
+        self.exceptions = []
+        for e in gv.fa("./gv:definition/gv:exceptions/gv:exception"):
+            sel = {
+                k: [int(x) for x in e.get(EXCEPTION_ATTRS[k], "").split()]
+                for k in ("basin", *BASIN_LEVELS)
+            }
+            self.exceptions.append(
+                (
+                    datetime.date.fromisoformat(e.get("from")),
+                    datetime.date.fromisoformat(e.get("till")),
+                    sel,
+                    {
+                        v.get("name"): float(v.get("value"))
+                        for v in e.findall("gv:variable", gv.ns)
+                    },
+                )
+            )
+
+    def structure(self):
+        "The part of the model that must be shared by batched scenarios"
+        return (
+            self.compartments,
+            self.transitions,
+            [(s, t, [f[0] for f in fs]) for s, t, fs in self.infections],
+            self.results,
+        )
+
+
+class MetapopSimulator:
+    """
+    Deterministic metapopulation simulator as a quick local stand-in for GLEAM.
+
+    Simulates a batch of GleamDefs with the same compartment structure at once; the
+    state is an array (scenario, compartment, basin) integrated in `steps_per_day`
+    steps per day. Travelling compartments move along `mobility` (see `mobility_matrix`)
+    once a day.
+    Results are written in the GLEAM `results.h5` layout (see `Simulation`).
+    """
+
+    def __init__(self, basins, mobility=None, steps_per_day=4):
+        self.basins = basins
+        self.n_basins = len(basins)
+        pop = basins["pop"].values.astype(float)
+        missing = np.isnan(pop)
+        if missing.any():
+            log.warning(f"{missing.sum()} basins without population, using median")
+            pop = np.where(missing, np.nanmedian(pop), pop)
+        self.pop = np.maximum(pop, 1.0)
+        if mobility is None:
+            mobility = mobility_matrix(basins.assign(pop=self.pop))
+        self.mobility = mobility
+        # Daily fractions of basin population travelling (basin, basin) and in total
+        self.travel = (scipy.sparse.diags(1.0 / self.pop) @ mobility).tocsr()
+        self.travel_out = np.asarray(self.travel.sum(axis=1)).ravel()
+        self.steps_per_day = steps_per_day
+        self.levels = {k: basins[k].values for k in BASIN_LEVELS}
+
+    def _selection(self, sel):
+        "Basin mask of an exception selection, warns about ids matching no basin"
+        mask = np.zeros(self.n_basins, dtype=bool)
+        unknown = [f"basin {b}" for b in sel["basin"] if not 0 <= b < self.n_basins]
+        mask[[b for b in sel["basin"] if 0 <= b < self.n_basins]] = True
+        for k, ids in sel.items():
+            if k != "basin" and ids:
+                mask |= np.isin(self.levels[k], ids)
+                unknown.extend(f"{k} {i}" for i in np.setdiff1d(ids, self.levels[k]))
+        if unknown:
+            log.warning(f"Exception ids matching no basin: {unknown}")
+        return mask
+
+    def _seasonality(self, alpha_min, date):
+        "Seasonality multiplier per basin"
+        res = np.ones(self.n_basins)
+        if alpha_min is None:
+            return res
+        doy = date.timetuple().tm_yday
+        for hemi, tmax in SEASONALITY_MAX_DAY.items():
+            s = np.sin(2 * np.pi / 365.0 * (doy - tmax) + np.pi / 2)
+            res[self.levels["hemisphere"] == hemi] = 0.5 * (
+                (1.0 - alpha_min) * s + 1.0 + alpha_min
+            )
+        return res
+
+    def _variables(self, models, masks, day):
+        "Variable values (scenario, basin) for the given day"
+        res = {}
+        for name in models[0].variables:
+            v = np.array([m.variables.get(name, 0.0) for m in models])
+            res[name] = np.repeat(v[:, None], self.n_basins, axis=1)
+        for s, m in enumerate(models):
+            date = m.start_date + datetime.timedelta(days=day)
+            for (fr, till, _sel, vs), mask in zip(m.exceptions, masks[s]):
+                if fr <= date <= till:
+                    for name, v in vs.items():
+                        res[name][s, mask] = v
+        return res
+
+    def initial_state(self, models):
+        "Initial state array (scenario, compartment, basin)"
+        comps = models[0].compartments
+        x = np.zeros((len(models), len(comps), self.n_basins))
+        for s, m in enumerate(models):
+            for c, f in m.initial.items():
+                x[s, comps.index(c)] = self.pop * f
+            # Seeds are added to their compartment and taken from the susceptible ones
+            susc = [comps.index(src) for src, _t, _f in m.infections]
+            for city, c, n in m.seeds:
+                if not 0 <= city < self.n_basins:
+                    log.warning(f"Seed in unknown basin {city} of {m.name!r}, skipping")
+                    continue
+                x[s, comps.index(c), city] += n
+                for si in susc:
+                    x[s, si, city] = max(x[s, si, city] - n, 0.0)
+        return x
+
+    def run(self, gleamdefs):
+        """
+        Simulate all the GleamDefs at once.
+
+        Returns an array of daily new (incoming) people of shape
+        (scenario, result compartment, basin, day), with the maximal duration.
+        """
+        models = [CompartmentModel(gv) for gv in gleamdefs]
+        if any(m.structure() != models[0].structure() for m in models):
+            die("Batched simulations must have the same compartmental model")
+        comps = models[0].compartments
+        ci = {c: i for i, c in enumerate(comps)}
+        travel = np.flatnonzero(models[0].travellers)
+        results = [ci[c] for c in models[0].results]
+        days = max(m.duration for m in models)
+        occupancy = np.array([m.occupancy / 100.0 for m in models])[:, None, None]
+        masks = [[self._selection(e[2]) for e in m.exceptions] for m in models]
+        dt = 1.0 / self.steps_per_day
+        S = len(models)
+
+        x = self.initial_state(models)
+        new = np.zeros((S, len(results), self.n_basins, days), dtype=np.float32)
+        log.info(
+            f"Simulating {S} scenarios, {len(comps)} compartments, {self.n_basins} basins, {days} days ..."
+        )
+        for day in range(days):
+            vs = self._variables(models, masks, day)
+            seas = np.stack(
+                [
+                    self._seasonality(
+                        m.seasonality, m.start_date + datetime.timedelta(days=day)
+                    )
+                    for m in models
+                ]
+            )
+            inflow = np.zeros_like(x)
+            for _step in range(self.steps_per_day):
+                n = np.maximum(x.sum(axis=1), 1.0)
+                # Total out-rate and per-target rates (scenario, basin) of each source
+                rates = {}
+                for src, tgt, ratio in models[0].transitions:
+                    rates.setdefault(ci[src], []).append((ci[tgt], vs[ratio]))
+                for src, tgt, infectors in models[0].infections:
+                    lam = sum(vs[r] * x[:, ci[f]] / n for f, r in infectors) * seas
+                    rates.setdefault(ci[src], []).append((ci[tgt], lam))
+                dx = np.zeros_like(x)
+                for src, rs in rates.items():
+                    tot = sum(r for _t, r in rs)
+                    out = x[:, src] * -np.expm1(-tot * dt)
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        share = np.where(tot > 0, out / tot, 0.0)
+                    for tgt, r in rs:
+                        f = share * r
+                        dx[:, src] -= f
+                        dx[:, tgt] += f
+                        inflow[:, tgt] += f
+                x = x + dx
+            # Daily travel of travelling compartments
+            if len(travel):
+                xt = x[:, travel] * (occupancy * TRAVEL_FRACTION)
+                moved = self.travel.T @ xt.reshape(-1, self.n_basins).T
+                x[:, travel] += moved.T.reshape(xt.shape) - xt * self.travel_out
+            new[:, :, :, day] = inflow[:, results]
+        return new
+
+    def _level_matrix(self, level):
+        ids = self.levels[level]
+        n = ids.max() + 1
+        return scipy.sparse.csr_matrix(
+            (np.ones(self.n_basins), (ids, np.arange(self.n_basins))),
+            shape=(n, self.n_basins),
+        )
+
+    def write_results(self, path, new, duration=None, compression="gzip"):
+        """
+        Write the daily new people (result compartment, basin, day) of one scenario
+        as a GLEAM `results.h5` (fractions of the population, one run).
+        """
+        if duration is not None:
+            new = new[:, :, :duration]
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        levels = {"basin": scipy.sparse.identity(self.n_basins, format="csr")}
+        for level in ("country", "continent"):
+            levels[level] = self._level_matrix(level)
+        with h5py.File(tmp, "w") as f:
+            for level, m in levels.items():
+                pops = np.maximum(m @ self.pop, 1.0)
+                counts = np.stack([m @ new[c] for c in range(new.shape[0])])
+                frac = counts / pops[None, :, None]
+                for kind, data in [("new", frac), ("cumulative", frac.cumsum(axis=2))]:
+                    f.create_dataset(
+                        f"population/{kind}/{level}/median/dset",
+                        data=data[:, None].astype(np.float32),
+                        compression=compression,
+                    )
+        tmp.replace(path)
+        log.info(f"Written simulation results to {path}")
+
+    def simulate_dirs(self, sim_dirs):
+        """
+        Simulate GLEAM simulation directories (with `definition.xml`) as one batch.
+
+        Writes `results.h5` into each directory.
+        """
+        gvs = [GleamDef(Path(d) / "definition.xml") for d in sim_dirs]
+        new = self.run(gvs)
+        for gv, d, res in zip(gvs, sim_dirs, new):
+            duration = CompartmentModel(gv).duration
+            self.write_results(Path(d) / Simulation.RESULT_FILE_NAME, res, duration)
@@ -2,6 +2,7 @@ import logging
 import pathlib
 
 import h5py
+import numpy as np
 
 from .gleamdef import GleamDef
 
@@ -9,17 +10,24 @@ log = logging.getLogger(__name__)
 
 
 class Simulation:
-    def __init__(self, gleamdef, hdf_file, dir_path=None):
+
+    RESULT_FILE_NAME = "results.h5"
+    REPACKED_FILE_NAME = "results-repacked.h5"
+
+    def __init__(self, gleamdef, hdf_file, dir_path=None, repacked_file=None):
         self.definition = gleamdef
         self.name = self.definition.get_name()
         assert hdf_file is None or isinstance(hdf_file, h5py.File)
         self.hdf = hdf_file
+        assert repacked_file is None or isinstance(repacked_file, h5py.File)
+        # Region-major copy of the result datasets (see `repack`), preferred if present
+        self.repacked = repacked_file
         self.dir = dir_path
 
     @classmethod
     def load_dir(cls, path, skip_unfinished=False):
         path = pathlib.Path(path)
-        h5path = path / "results.h5"
+        h5path = path / cls.RESULT_FILE_NAME
         if skip_unfinished and not h5path.exists():
             log.info("Skipping uncomputed {}".format(path))
             return None
@@ -30,24 +38,103 @@ class Simulation:
         else:
             hf = h5py.File(h5path, "r")
             res_msg = ""
+        rpath = path / cls.REPACKED_FILE_NAME
+        rf = None
+        if (
+            hf is not None
+            and rpath.exists()
+            and rpath.stat().st_mtime >= h5path.stat().st_mtime
+        ):
+            rf = h5py.File(rpath, "r")
+            res_msg = "(repacked)"
         gd = GleamDef(path / "definition.xml")
         log.debug(f".. loaded Gleam info {gd.get_name()} {res_msg}")
-        return cls(gd, hf, path)
+        return cls(gd, hf, path, repacked_file=rf)
 
     def __repr__(self):
         return "<Simulation {!r}>".format(self.name)
 
-    def get_seq(self, num, kind, cumulative=True, sub="median"):
+    @staticmethod
+    def _seq_path(kind, cumulative=True, sub="median"):
         if kind == "city":
             kind = "basin"
-        p = "population/{}/{}/{}/dset".format(
+        return "population/{}/{}/{}/dset".format(
             ["new", "cumulative"][cumulative], kind, sub
         )
+
+    def get_seq(self, num, kind, cumulative=True, sub="median"):
+        p = self._seq_path(kind, cumulative, sub)
+        if self.repacked is not None and p in self.repacked:
+            # Layout (basin, compartment, day)
+            return self.repacked[p][num, :, :]
+        # Layout (compartment, run, basin, day)
         return self.hdf[p][:, 0, num, :]
 
+    def get_seqs(self, nums, kind, cumulative=True, sub="median"):
+        """
+        Return the series of several basins (or regions of `kind`) as array
+        (num, compartment, day), with a single read of the dataset (`nums` must
+        not be empty).
+        """
+        nums = np.asarray(nums, dtype=int)
+        uniq, inv = np.unique(nums, return_inverse=True)
+        p = self._seq_path(kind, cumulative, sub)
+        if self.repacked is not None and p in self.repacked:
+            res = self.repacked[p][uniq, :, :]
+        else:
+            res = self.hdf[p][:, 0, uniq, :].transpose(1, 0, 2)
+        return res[inv]
+
+    def get_basin_seqs(self, cumulative=True, sub="median"):
+        """Return all basin series as array (basin, compartment, day)."""
+        p = self._seq_path("basin", cumulative, sub)
+        if self.repacked is not None and p in self.repacked:
+            return self.repacked[p][...]
+        return self.hdf[p][:, 0, :, :].transpose(1, 0, 2)
+
     def has_result(self):
         return self.hdf is not None
 
+    def repack(self, subs=("median",), compression="gzip"):
+        """
+        Write the `subs` result datasets into a region-major file next to `results.h5`.
+
+        GLEAM stores the datasets as (compartment, run, basin, day), so reading one
+        region touches many chunks. The repacked datasets are (basin, compartment, day)
+        for the first run, chunked by basin, so that `get_seq` reads a single chunk.
+        The repacked file is written atomically and opened for reading.
+        """
+        assert self.has_result()
+        assert self.dir is not None
+        paths = []
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset) and name.split("/")[-2] in subs:
+                paths.append(name)
+
+        self.hdf["population"].visititems(visit)
+
+        rpath = pathlib.Path(self.dir) / self.REPACKED_FILE_NAME
+        tmp_path = rpath.with_suffix(".tmp")
+        if self.repacked is not None:
+            self.repacked.close()
+            self.repacked = None
+        with h5py.File(tmp_path, "w") as f:
+            for name in paths:
+                src = self.hdf["population"][name]
+                data = src[:, 0, :, :].transpose(1, 0, 2)
+                f.create_dataset(
+                    f"population/{name}",
+                    data=data,
+                    chunks=(1,) + data.shape[1:],
+                    compression=compression,
+                    shuffle=True,
+                )
+        tmp_path.replace(rpath)
+        self.repacked = h5py.File(rpath, "r")
+        log.info(f"Repacked {len(paths)} datasets of {self!r} into {rpath}")
+        return rpath
+
 
 class SimSet:
     def __init__(self):
@@ -0,0 +1,96 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stage outputs.
+
+    Every stage has a key hashed from its name, a config subset, the contents of its
+    input files and the keys of the stages it depends on. The stage outputs are stored
+    as files in the directory `{cache_dir}/{name}-{key}/`, so a rerun with unchanged
+    inputs can load them instead of recomputing the stage.
+    """
+
+    # Bump to invalidate all the cached stages on incompatible changes
+    VERSION = 5
+
+    def __init__(self, cache_dir, enabled=True):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.enabled = enabled
+        if enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def stage_key(self, name, config=None, files=(), deps=()):
+        """
+        Compute the key of a stage.
+
+        `config` is a JSON-like dict (with dates allowed), `files` paths of input
+        files (missing files are hashed as missing) and `deps` keys of other stages.
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps([self.VERSION, name, list(deps)]).encode("utf8"))
+        h.update(json.dumps(config, sort_keys=True, default=_json_key).encode("utf8"))
+        for f in files:
+            f = Path(f).expanduser()
+            h.update(str(f).encode("utf8"))
+            if not f.exists():
+                h.update(b"\0missing")
+                continue
+            with open(f, "rb") as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b""):
+                    h.update(chunk)
+        return h.hexdigest()[:32]
+
+    def _dir(self, name, key):
+        return self.cache_dir / f"{name}-{key}"
+
+    def get(self, name, key):
+        "Return the stage output directory, or None if not cached."
+        if not self.enabled:
+            return None
+        d = self._dir(name, key)
+        if d.is_dir():
+            log.info(f"Using cached stage {name!r} from {d}")
+            return d
+        return None
+
+    @contextlib.contextmanager
+    def store(self, name, key):
+        """
+        Context manager yielding a directory to write stage outputs into.
+
+        The outputs are only committed to the cache if the block succeeds.
+        """
+        if not self.enabled:
+            # The outputs are written but not kept
+            with tempfile.TemporaryDirectory() as tmp:
+                yield Path(tmp)
+            return
+        d = self._dir(name, key)
+        tmp = self.cache_dir / f".tmp-{name}-{key}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        try:
+            yield tmp
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if d.exists():
+            shutil.rmtree(d)
+        tmp.rename(d)
+        log.debug(f"Cached stage {name!r} in {d}")
+
+
+def _json_key(o):
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    return str(o)
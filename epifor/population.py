@@ -0,0 +1,239 @@
+"""
+Join population tables to `Regions` and update `regions.yaml`.
+
+Usage: python -m epifor.population data/regions.yaml [-s SOURCE ...] [-o OUT_YAML]
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .common import _n_many
+from .regions import Regions
+
+log = logging.getLogger(__name__)
+
+POPULATION_DIR = Path(__file__).parents[1] / "data" / "population"
+
+# Known population tables: `name` and `population` columns, `country` column or
+# fixed `country_name` (optional), and `kind` of the matched regions
+SOURCES = {
+    "world": dict(
+        path="WorldPopulation.csv", name="Country", population="2016", kind="country"
+    ),
+    "states": dict(
+        path="population_incl_china_states.csv",
+        name="Province/State",
+        population="Population",
+        country="Country",
+        kind="state",
+    ),
+    "us_states": dict(
+        path="us_state_populations.csv",
+        name="State",
+        population="2018 Population",
+        country_name="united states",
+        kind="state",
+    ),
+    "worldcities": dict(
+        path="worldcities.csv",
+        name="city_ascii",
+        population="population",
+        country="country",
+        kind="city",
+    ),
+    "india500": dict(
+        path="india_top500_cities_r2.csv",
+        name="name_of_city",
+        population="population_total",
+        country_name="india",
+        kind="city",
+    ),
+}
+
+
+def load_source(spec, data_dir=POPULATION_DIR):
+    """
+    Load a population table as a DataFrame with normalized `name`, `country` (name,
+    or NaN) and `population` columns (rows without population are dropped).
+    """
+    if isinstance(spec, str):
+        spec = SOURCES[spec]
+    df = pd.read_csv(Path(data_dir) / spec["path"], encoding="utf-8-sig")
+    res = pd.DataFrame(
+        {
+            "name": _n_many(df[spec["name"]].astype(str).str.strip()).values,
+            "population": pd.to_numeric(df[spec["population"]], errors="coerce"),
+        }
+    )
+    if "country" in spec:
+        res["country"] = _n_many(df[spec["country"]]).values
+    else:
+        res["country"] = spec.get("country_name", np.nan)
+    return res[res["population"] > 0]
+
+
+def region_table(regions: Regions):
+    """
+    DataFrame of all the region names with columns `name` (normalized), `kind`,
+    `key`, `country` (key of the enclosing country, NaN above countries) and
+    `population`, one row per (name, region).
+    """
+    cols = {k: [] for k in ("name", "kind", "key", "country", "population")}
+
+    def rec(reg, country):
+        if reg.kind == "country":
+            country = reg.key
+        for n in reg.names:
+            for k, v in zip(cols, (n, reg.kind, reg.key, country, reg.population)):
+                cols[k].append(v)
+        for r in reg.sub:
+            rec(r, country)
+
+    rec(regions.root, np.nan)
+    df = pd.DataFrame(cols)
+    df["name"] = _n_many(df["name"]).values
+    df["population"] = pd.to_numeric(df["population"])
+    return df.drop_duplicates(["name", "key"])
+
+
+def _country_keys(regions: Regions, names):
+    "Map a Series of normalized country names to country keys (NaN if not unique)"
+    uniq = names.dropna().unique()
+    keys = {}
+    for n in uniq:
+        r = regions.find_names(n, kinds="country")
+        if len(r) == 1:
+            keys[n] = r[0].key
+    missing = sorted(set(uniq) - set(keys))
+    if missing:
+        log.info(f"{len(missing)} source countries not matched: {missing[:10]!r} ...")
+    return names.map(keys)
+
+
+def join_source(regions: Regions, src, kind, table=None):
+    """
+    Hash-join the rows of a loaded source to the regions of given `kind`.
+
+    Rows are matched on the normalized name, and on the country if the source has
+    one. Returns `(matches, conflicts)`: `matches` is a Series of population by
+    region key (max of the rows matching a region), `conflicts` a DataFrame of the
+    rows matching several regions (`ambiguous`, not used) or of regions matched
+    by rows with different populations (`duplicate`).
+    """
+    if table is None:
+        table = region_table(regions)
+    table = table[table["kind"] == kind]
+    src = src.reset_index(drop=True).rename_axis("row").reset_index()
+    src["country"] = _country_keys(regions, src["country"])
+    if src["country"].notna().any():
+        on = ["name", "country"]
+    else:
+        on = ["name"]
+    # Unresolved countries must not match each other (merge joins NaN keys)
+    src = src.dropna(subset=on)
+    m = src.merge(table[on + ["key"]].dropna(subset=on), on=on, how="inner")
+
+    n_keys = m.groupby("row")["key"].transform("nunique")
+    ambiguous = m[n_keys > 1]
+    m = m[n_keys == 1]
+    n_pops = m.groupby("key")["population"].transform("nunique")
+    duplicate = m[n_pops > 1]
+    conflicts = pd.concat(
+        [ambiguous.assign(conflict="ambiguous"), duplicate.assign(conflict="duplicate")]
+    )[["conflict", "name", "country", "key", "population"]]
+    return m.groupby("key")["population"].max(), conflicts.reset_index(drop=True)
+
+
+def join_populations(
+    regions: Regions, sources, overwrite=False, data_dir=POPULATION_DIR
+):
+    """
+    Join the given sources (names of `SOURCES` or specs) in order.
+
+    By default only fills missing populations (earlier sources take precedence),
+    with `overwrite` every matched population is updated (later sources win).
+    Returns `(updates, conflicts)` DataFrames; `updates` has columns `key`,
+    `population`, `old` and `source`.
+    """
+    table = region_table(regions)
+    pops = table.drop_duplicates("key").set_index("key")["population"]
+    new = pd.Series(np.nan, index=pops.index)
+    source = pd.Series(None, index=pops.index, dtype=object)
+    all_conflicts = []
+    for s in sources:
+        spec = SOURCES[s] if isinstance(s, str) else s
+        sname = s if isinstance(s, str) else spec["path"]
+        matches, conflicts = join_source(
+            regions, load_source(spec, data_dir), spec["kind"], table=table
+        )
+        if overwrite:
+            upd = matches.index
+        else:
+            cur = new.combine_first(pops)
+            upd = matches.index[cur[matches.index].isna().values]
+        new[upd] = matches[upd]
+        source[upd] = sname
+        all_conflicts.append(conflicts.assign(source=sname))
+        log.info(
+            f"Source {sname!r}: {len(matches)} regions matched, {len(upd)} updated,"
+            f" {len(conflicts)} conflicting rows"
+        )
+    upd = new.notna() & (new != pops)
+    updates = pd.DataFrame(
+        {"population": new[upd], "old": pops[upd], "source": source[upd]}
+    ).rename_axis("key")
+    conflicts = pd.concat(all_conflicts, ignore_index=True)
+    return updates.reset_index(), conflicts
+
+
+def apply_populations(regions: Regions, updates):
+    "Write the populations from `join_populations` updates into the regions"
+    for key, pop in zip(updates["key"].values, updates["population"].values):
+        regions[key].population = int(pop)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    ap = argparse.ArgumentParser(description="Update region populations")
+    ap.add_argument("REGIONS_YAML", help="Regions file to update.")
+    ap.add_argument(
+        "-s",
+        "--source",
+        action="append",
+        choices=list(SOURCES),
+        help="Population source (can be repeated, default: all in order).",
+    )
+    ap.add_argument("-o", "--output", help="Output YAML (default: overwrite input).")
+    ap.add_argument(
+        "--overwrite", action="store_true", help="Also update known populations."
+    )
+    ap.add_argument("--conflicts", help="Write conflicting rows to this CSV.")
+    ap.add_argument("--updates", help="Write the updates to this CSV.")
+    ap.add_argument(
+        "-n", "--dry-run", action="store_true", help="Do not write the regions."
+    )
+    args = ap.parse_args()
+
+    rs = Regions.load_from_yaml(args.REGIONS_YAML)
+    updates, conflicts = join_populations(
+        rs, args.source or list(SOURCES), overwrite=args.overwrite
+    )
+    log.info(f"{len(updates)} population updates, {len(conflicts)} conflicting rows")
+    if args.updates:
+        updates.to_csv(args.updates, index=False)
+    if args.conflicts:
+        conflicts.to_csv(args.conflicts, index=False)
+    if not args.dry_run:
+        apply_populations(rs, updates)
+        out = args.output or args.REGIONS_YAML
+        with open(out, "wt") as f:
+            rs.write_yaml(f)
+        log.info(f"Written {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,244 @@
+import hashlib
+import json
 import logging
+from collections.abc import MutableMapping
+
 import numpy as np
 
 from .common import _fs, _n, yaml
+from .fuzzy import TrigramIndex
+from .regions_yaml import RegionsYamlIndex, write_regions_yaml
 
 log = logging.getLogger(__name__)
 
 
+class EstimateStore:
+    """
+    Columnar store of region estimates.
+
+    Every estimate name has a float64 array indexed by row (one row per region key,
+    in order of `add_row`), with NaN for missing or None values. A mask per name
+    records which entries are set at all, so that the `Region.est` views keep the
+    dict semantics. `version` (and `versions[name]`) increase with every write.
+    Column writes of `ESTIMATE_INPUT_KEYS` are reported to `on_change` with the
+    written row keys (see `EstimateDict`).
+    """
+
+    on_change = None
+
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+        # {name: array (capacity,)}
+        self.values = {}
+        self.present = {}
+        self.version = 0
+        self.versions = {}
+        self._capacity = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_row(self, key):
+        "Add a row for region `key`, returns the row index"
+        assert key not in self.index
+        row = len(self.keys)
+        if row >= self._capacity:
+            self._capacity = max(2 * self._capacity, 64)
+            for name in self.values:
+                self.values[name] = self._grow(self.values[name], np.nan)
+                self.present[name] = self._grow(self.present[name], False)
+        self.keys.append(key)
+        self.index[key] = row
+        return row
+
+    def _grow(self, a, fill):
+        res = np.full(self._capacity, fill, dtype=a.dtype)
+        res[: len(a)] = a
+        return res
+
+    def _touch(self, name):
+        self.version += 1
+        self.versions[name] = self.version
+
+    def get(self, name, row, default=None):
+        p = self.present.get(name)
+        if p is None or not p[row]:
+            return default
+        v = self.values[name][row]
+        return None if v != v else float(v)
+
+    def contains(self, name, row):
+        p = self.present.get(name)
+        return p is not None and bool(p[row])
+
+    def set(self, name, row, value):
+        if name not in self.values:
+            self.values[name] = np.full(self._capacity, np.nan)
+            self.present[name] = np.zeros(self._capacity, dtype=bool)
+        self.values[name][row] = np.nan if value is None else value
+        self.present[name][row] = True
+        self._touch(name)
+
+    def delete(self, name, row):
+        if not self.contains(name, row):
+            raise KeyError(name)
+        self.values[name][row] = np.nan
+        self.present[name][row] = False
+        self._touch(name)
+
+    def names(self, row=None):
+        "Estimate names (set for the given row)"
+        if row is None:
+            return list(self.values)
+        return [n for n, p in self.present.items() if p[row]]
+
+    def column(self, name, keys=None):
+        "Copy of the estimate as an array over all rows (or given keys), NaN if missing"
+        if name not in self.values:
+            v = np.full(len(self), np.nan)
+        else:
+            v = self.values[name][: len(self)].copy()
+        if keys is not None:
+            v = v[[self.index[k] for k in keys]]
+        return v
+
+    def set_column(self, name, values, keys=None):
+        "Set the estimate for all rows (or given keys), NaN values are set to None"
+        rows = slice(0, len(self)) if keys is None else [self.index[k] for k in keys]
+        if name not in self.values:
+            self.values[name] = np.full(self._capacity, np.nan)
+            self.present[name] = np.zeros(self._capacity, dtype=bool)
+        self.values[name][rows] = values
+        self.present[name][rows] = True
+        self._touch(name)
+        if self.on_change is not None and name in ESTIMATE_INPUT_KEYS:
+            self.on_change(self.keys if keys is None else list(keys))
+
+    def snapshot(self, names=None):
+        """
+        Return a copy of the (given) estimates as `{name: array}` with the row keys
+        as `"keys"` and the `"version"`, e.g. for `save_snapshot` or `diff`.
+        """
+        res = {n: self.column(n) for n in (names or self.values)}
+        res["keys"] = np.array(self.keys, dtype=str)
+        res["version"] = np.array(self.version)
+        return res
+
+    @staticmethod
+    def save_snapshot(snapshot, path):
+        np.savez_compressed(path, **snapshot)
+
+    @staticmethod
+    def load_snapshot(path):
+        with np.load(path, allow_pickle=False) as f:
+            return {n: f[n] for n in f.files}
+
+    @staticmethod
+    def diff(old, new, rtol=1e-9):
+        """
+        Compare two snapshots, returns `[(key, name, old, new)]` of changed values
+        (None for missing), over the keys and names present in either.
+        """
+        res = []
+        okeys, nkeys = list(old["keys"]), list(new["keys"])
+        keys = okeys + sorted(set(nkeys) - set(okeys))
+        names = [n for n in old if n not in ("keys", "version")]
+        names += [n for n in new if n not in old and n not in ("keys", "version")]
+
+        def aligned(snap, skeys, name):
+            v = np.full(len(keys), np.nan)
+            if name in snap:
+                idx = {k: i for i, k in enumerate(skeys)}
+                rows = np.array([idx.get(k, -1) for k in keys])
+                sel = rows >= 0
+                v[sel] = snap[name][rows[sel]]
+            return v
+
+        for name in names:
+            a, b = aligned(old, okeys, name), aligned(new, nkeys, name)
+            same = np.isclose(a, b, rtol=rtol, atol=0.0) | (np.isnan(a) & np.isnan(b))
+            for i in np.flatnonzero(~same):
+                res.append((keys[i], name, _none(a[i]), _none(b[i])))
+        return res
+
+
+def _none(v):
+    return None if np.isnan(v) else float(v)
+
+
+class EstimateDict(MutableMapping):
+    """
+    The `Region.est` dict, a view of the region row in an `EstimateStore`.
+
+    A Region not (yet) in a `Regions` has its own single-row store. Reports writes
+    of `ESTIMATE_INPUT_KEYS` to `on_change`, used by `Regions` to track regions
+    with changed estimation inputs.
+    """
+
+    on_change = None
+
+    def __init__(self, region, *args, **kwargs):
+        self.region = region
+        self._store = EstimateStore()
+        self._row = self._store.add_row(region.key)
+        self.update(*args, **kwargs)
+
+    def attach(self, store, row):
+        "Move the values into the given store row and use it from now on"
+        for name in self._store.names(self._row):
+            store.set(name, row, self._store.get(name, self._row))
+        self._store, self._row = store, row
+
+    def __getitem__(self, key):
+        if not self._store.contains(key, self._row):
+            raise KeyError(key)
+        return self._store.get(key, self._row)
+
+    def get(self, key, default=None):
+        return self._store.get(key, self._row, default)
+
+    def __contains__(self, key):
+        return self._store.contains(key, self._row)
+
+    def __iter__(self):
+        return iter(self._store.names(self._row))
+
+    def __len__(self):
+        return len(self._store.names(self._row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __setitem__(self, key, value):
+        self._store.set(key, self._row, value)
+        if self.on_change is not None and key in ESTIMATE_INPUT_KEYS:
+            self.on_change(self.region)
+
+    def __delitem__(self, key):
+        self._store.delete(key, self._row)
+        if self.on_change is not None and key in ESTIMATE_INPUT_KEYS:
+            self.on_change(self.region)
+
+
+# Estimates read by `Regions.estimate_active`
+ESTIMATE_INPUT_KEYS = ("ft_mean", "csse_active")
+
+# Region attributes stored in the YAML (and hashed by `Region.content_hash`)
+REGION_FIELDS = (
+    "key",
+    "names",
+    "kind",
+    "population",
+    "lat",
+    "lon",
+    "gleam_id",
+    "iana",
+    "iso_alpha_3",
+    "max_percentage_of_infected_to_fill_icu_beds",
+)
+
+
 class Region:
     def __init__(
         self,
@@ -21,6 +254,12 @@ class Region:
         iso_alpha_3=None,
         max_percentage_of_infected_to_fill_icu_beds=None,
     ):
+        # Cached `content_hash`, None when invalidated
+        self._hash = None
+        # Hierarchy, root.parent=None
+        self.parent = None
+        self.sub = []
+
         if isinstance(names, str):
             names = [names]
         if key is None:
@@ -38,12 +277,8 @@ class Region:
         self.iso_alpha_3 = iso_alpha_3
         self.max_percentage_of_infected_to_fill_icu_beds = None
 
-        # Hierarchy, root.parent=None
-        self.sub = []
-        self.parent = None
-
         # Estimate variables dict
-        self.est = {}
+        self.est = EstimateDict(self)
 
     def __eq__(self, other):
         if not isinstance(other, Region):
@@ -57,6 +292,42 @@ class Region:
                 return False
         return True
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in REGION_FIELDS:
+            self.invalidate_hash()
+
+    def invalidate_hash(self):
+        """
+        Drop the cached hashes of the region and its ancestors.
+
+        Called on setting any of `REGION_FIELDS` and on adding subregions, call it
+        after in-place changes (e.g. of `names`).
+        """
+        r = self
+        # A region with a hash implies hashed subtree, so stop at the first unhashed
+        while r is not None and r._hash is not None:
+            r._hash = None
+            r = r.parent
+
+    def content_hash(self):
+        """
+        Hash of the region fields and the subtree (independent of subregion order).
+
+        Computed bottom-up and cached until the subtree changes.
+        """
+        if self._hash is None:
+            h = hashlib.sha256()
+            h.update(json.dumps(self.fields(), default=str).encode("utf8"))
+            for hs in sorted((r.key, r.content_hash()) for r in self.sub):
+                h.update(json.dumps(hs).encode("utf8"))
+            self._hash = h.hexdigest()[:32]
+        return self._hash
+
+    def fields(self):
+        "Return `{field: value}` of `REGION_FIELDS`"
+        return {f: getattr(self, f) for f in REGION_FIELDS}
+
     def __repr__(self):
         return f"<Region {self.name!r} [{self.key}, {self.kind}] ({self.parent})>"
 
@@ -73,21 +344,7 @@ class Region:
 
     def to_json_rec(self, nones=False):
         s = [s.to_json_rec(nones=nones) for s in self.sub] if self.sub else None
-        return _fs(
-            self,
-            "key",
-            "names",
-            "kind",
-            "population",
-            "lat",
-            "lon",
-            "gleam_id",
-            "iana",
-            "iso_alpha_3",
-            "max_percentage_of_infected_to_fill_icu_beds",
-            _n=nones,
-            subregions=s,
-        )
+        return _fs(self, *REGION_FIELDS, _n=nones, subregions=s)
 
     @classmethod
     def _from_yaml(cls, regions, y, parent=None):
@@ -107,6 +364,14 @@ class Regions:
         # _n(name): [Region]
         self.all_names_index = {}
         self.root = None
+        # Estimates of all the regions, viewed by `Region.est`
+        self.estimates = EstimateStore()
+        self.estimates.on_change = self._est_keys_changed
+        # Lazily built TrigramIndex, see `find_names_fuzzy`
+        self._fuzzy_index = None
+        # State of the last `estimate_active` run, and regions with changed inputs
+        self._est_state = None
+        self._est_dirty = set()
 
     @classmethod
     def load_from_yaml(cls, path):
@@ -115,6 +380,41 @@ class Regions:
             s.read_yaml(f)
         return s
 
+    @classmethod
+    def load_subtrees_from_yaml(cls, path, keys, index=None):
+        """
+        Load only the subtrees of the given region keys and their ancestors.
+
+        The ancestors have only the subregions on the paths to the loaded
+        subtrees. Uses `RegionsYamlIndex` (built if not given) to parse only the
+        needed parts of the file. Unknown keys raise `KeyError`.
+        """
+        if index is None:
+            index = RegionsYamlIndex.build(path)
+        s = cls()
+        keys = set(keys)
+        for k in keys:
+            if k not in index:
+                raise KeyError(k)
+        with open(path, "rb") as f:
+            # In file order, so that the siblings keep their order
+            for k in index.entries:
+                if k not in keys:
+                    continue
+                ancestors = index.ancestors(k)
+                if any(a in keys for a in ancestors):
+                    continue
+                for a in ancestors:
+                    if a not in s:
+                        y = index.read_fields(f, a)
+                        y.pop("subregions", None)
+                        parent = s[index.parent(a)] if index.parent(a) else None
+                        Region._from_yaml(s, y, parent=parent)
+                parent = s[ancestors[-1]] if ancestors else None
+                Region._from_yaml(s, index.read_subtree(f, k), parent=parent)
+        log.info(f"Read {len(s.key_index)} regions of {len(keys)} subtrees")
+        return s
+
     def __getitem__(self, key):
         "Returns a single Region by key"
         return self.key_index[key]
@@ -139,14 +439,33 @@ class Regions:
             t = (p for p in t if p.kind in kinds)
         return tuple(t)
 
+    def get_fuzzy_index(self):
+        "Return the TrigramIndex over all the names (built on first use)"
+        if self._fuzzy_index is None:
+            self._fuzzy_index = TrigramIndex(self)
+        return self._fuzzy_index
+
+    def find_names_fuzzy(self, name, kinds=None, limit=5, min_score=0.3):
+        """
+        Fuzzy variant of `find_names`, returning ranked `[(score, Region)]`.
+
+        See `TrigramIndex.lookup_many` for resolving many names at once.
+        """
+        return self.get_fuzzy_index().lookup(
+            name, kinds=kinds, limit=limit, min_score=min_score
+        )
+
     def add_region(self, reg, parent):
         assert isinstance(reg, Region)
         assert reg.key
+        self._fuzzy_index = None
         if reg.key in self.key_index:
             raise Exception(
                 f"Region {reg!r}'s key already indexed as {self[reg.key]!r}"
             )
         self.key_index[reg.key] = reg
+        reg.est.attach(self.estimates, self.estimates.add_row(reg.key))
+        reg.est.on_change = self._est_changed
         for n in reg.names:
             self.all_names_index.setdefault(_n(n), list()).append(reg)
         if parent is not None:
@@ -154,12 +473,61 @@ class Regions:
             assert reg.parent is None
             reg.parent = parent
             parent.sub.append(reg)
+            parent.invalidate_hash()
         else:
             assert self.root is None
             self.root = reg
 
+    def content_hash(self):
+        "Hash of the whole region tree, see `Region.content_hash`"
+        return self.root.content_hash()
+
+    def diff(self, other):
+        """
+        Structural diff from `self` to `other`, returns `(added, removed, changed)`.
+
+        `added` and `removed` are lists of region keys, `changed` is
+        `{key: {field: (old, new)}}` for regions in both trees, with `"parent"`
+        (key) as a field for moved regions. Only descends into subtrees with
+        different `content_hash`.
+        """
+        added, removed, changed = {}, {}, {}
+
+        def subtree(reg, res):
+            for r in self._subtree(reg):
+                res[r.key] = r
+
+        def rec(ra, rb):
+            if ra.content_hash() == rb.content_hash():
+                return
+            fa, fb = ra.fields(), rb.fields()
+            ch = {f: (fa[f], fb[f]) for f in REGION_FIELDS if fa[f] != fb[f]}
+            if ch:
+                changed[ra.key] = ch
+            subs_b = {r.key: r for r in rb.sub}
+            for r in ra.sub:
+                if r.key in subs_b:
+                    rec(r, subs_b.pop(r.key))
+                else:
+                    subtree(r, removed)
+            for r in subs_b.values():
+                subtree(r, added)
+
+        rec(self.root, other.root)
+        # Regions moved within the tree
+        for k in [k for k in removed if k in added]:
+            ra, rb = removed.pop(k), added.pop(k)
+            fa, fb = ra.fields(), rb.fields()
+            fa["parent"] = ra.parent.key
+            fb["parent"] = rb.parent.key
+            ch = {f: (fa[f], fb[f]) for f in fa if fa[f] != fb[f]}
+            if ch:
+                changed[k] = ch
+        return list(added), list(removed), changed
+
     def write_yaml(self, stream):
-        yaml.dump(self.root.to_json_rec(nones=False), stream)
+        "Write the regions YAML, streaming the regions in pre-order"
+        write_regions_yaml(self.root, stream, REGION_FIELDS)
 
     def read_yaml(self, stream):
         y = yaml.load(stream)
@@ -189,10 +557,8 @@ class Regions:
 
     def check_missing_estimates(self, name):
         """Find cities that do not have any value for given estimate."""
-        miss_c = []
-        for r in self.regions:
-            if r.est.get(name) is None and r.kind == "city":
-                miss_c.append(r)
+        miss = np.isnan(self.estimates.column(name))
+        miss_c = [r for r, m in zip(self.regions, miss) if m and r.kind == "city"]
         log.info(
             "Cities missing {} estmate: {} (total pop {:.3f} milion)".format(
                 name, len(miss_c), sum(r.pop for r in miss_c) / 1e6
@@ -241,30 +607,42 @@ class Regions:
         """
 
         def rec(reg):
-            if minimum_from is not None:
-                mfv = reg.est.get(minimum_from)
-                if mfv is not None:
-                    namev = reg.est.get(name, 0.0)
-                    if namev < mfv * minimum_mult:
-                        reg.est[name] = mfv * minimum_mult
-
             vs = [rec(r) for r in reg.sub]
-            vs = [v for v in vs if v is not None]
-            if vs or (reg.est.get(name) is not None) or (not keep_nones):
-                e = reg.est.get(name, 0.0)
-                mv = max(sum(vs), e if e is not None else 0.0)
-            else:
-                mv = None
-            reg.est[name] = mv
-            return mv
+            return self._fix_min_est_node(
+                reg, name, vs, minimum_from, minimum_mult, keep_nones
+            )
 
         rec(self.root)
 
-    def propagate_down(self):
+    @staticmethod
+    def _fix_min_est_node(reg, name, vs, minimum_from, minimum_mult, keep_nones):
+        "Single region step of `fix_min_est` given the children values `vs`."
+        if minimum_from is not None:
+            mfv = reg.est.get(minimum_from)
+            if mfv is not None:
+                namev = reg.est.get(name, 0.0)
+                if namev < mfv * minimum_mult:
+                    reg.est[name] = mfv * minimum_mult
+
+        vs = [v for v in vs if v is not None]
+        if vs or (reg.est.get(name) is not None) or (not keep_nones):
+            e = reg.est.get(name, 0.0)
+            mv = max(sum(vs), e if e is not None else 0.0)
+        else:
+            mv = None
+        reg.est[name] = mv
+        return mv
+
+    def propagate_down(self, root=None, _entry=None):
         """
         A rater hacky way to propagate `ft_mean` estimates down to city level.
+
+        Optionally only propagates within the subtree of `root`.
         """
+
         def rec(reg):
+            if _entry is not None:
+                _entry[reg.key] = reg.est.get("est_active")
             # Prefer ft_mean for estimate, or passed-down one
             est0 = reg.est.setdefault("est_active", None)
             est = reg.est.get("ft_mean", est0)
@@ -332,4 +710,130 @@ class Regions:
             for p in reg.sub:
                 rec(p)
 
+        rec(self.root if root is None else root)
+
+    ############## Incremental estimation #########################################
+
+    def _est_changed(self, reg):
+        self._est_keys_changed([reg.key])
+
+    def _est_keys_changed(self, keys):
+        if self._est_state is not None and not self._est_state["running"]:
+            self._est_dirty.update(keys)
+
+    def estimate_active(self, minimum_mult=2.0):
+        """
+        Compute `est_active` from `ft_mean` and `csse_active` for all regions.
+
+        Runs `propagate_down` and two passes of `fix_min_est` (the first with
+        `keep_nones` and minimum of `minimum_mult * csse_active`). Records the inputs
+        and intermediate values so that after any changes of `ft_mean` or
+        `csse_active`, `reestimate_active` recomputes only the affected regions.
+        """
+        state = {
+            "running": True,
+            "minimum_mult": minimum_mult,
+            # Inputs: {key: est_active before estimation}
+            "base": {r.key: r.est.get("est_active") for r in self.regions},
+        }
+        self._est_state = state
+        # {key: est_active on entering the node in propagate_down}
+        state["entry"] = {}
+        self.propagate_down(_entry=state["entry"])
+        # {key: est_active after propagate_down}
+        state["down"] = {r.key: r.est.get("est_active") for r in self.regions}
+        self.fix_min_est(
+            "est_active",
+            keep_nones=True,
+            minimum_from="csse_active",
+            minimum_mult=minimum_mult,
+        )
+        # {key: value after first fix pass}
+        state["fix1"] = {r.key: r.est.get("est_active") for r in self.regions}
+        self.check_missing_estimates("est_active")
+        self.fix_min_est("est_active")
+        state["running"] = False
+        self._est_dirty = set()
+
+    def reestimate_active(self):
+        """
+        Incrementally recompute `est_active` after changes of `ft_mean` or `csse_active`.
+
+        Gives the same result as `estimate_active` run on the original inputs with
+        the changes applied, but only recomputes the subtrees below the parents of
+        the changed regions and their ancestors. Returns the set of recomputed keys.
+        """
+        state = self._est_state
+        if state is None:
+            self.estimate_active()
+            return set(self.key_index)
+        dirty = set(self._est_dirty)
+        if not dirty:
+            return set()
+        state["running"] = True
+
+        # Changed region affects its siblings' shares: recompute from the parents
+        root_keys = set()
+        for k in dirty:
+            r = self[k]
+            root_keys.add(r.parent.key if r.parent is not None else r.key)
+        # Keep only the topmost roots
+        roots = [
+            self[k]
+            for k in root_keys
+            if not any(a.key in root_keys for a in self._ancestors(self[k]))
+        ]
+
+        # Re-propagate down within the subtrees, from their original entry values
+        recomputed = set()
+        for root in roots:
+            sub = self._subtree(root)
+            for r in sub:
+                r.est["est_active"] = state["base"][r.key]
+            root.est["est_active"] = state["entry"][root.key]
+            self.propagate_down(root=root, _entry=state["entry"])
+            for r in sub:
+                state["down"][r.key] = r.est.get("est_active")
+                recomputed.add(r.key)
+        for root in roots:
+            recomputed.update(a.key for a in self._ancestors(root))
+
+        # Both fix passes bottom-up over the recomputed regions, reusing the rest
+        def rec(reg):
+            if reg.key not in recomputed:
+                return state["fix1"][reg.key], reg.est.get("est_active")
+            vs = [rec(r) for r in reg.sub]
+            reg.est["est_active"] = state["down"][reg.key]
+            v1 = self._fix_min_est_node(
+                reg,
+                "est_active",
+                [v[0] for v in vs],
+                "csse_active",
+                state["minimum_mult"],
+                True,
+            )
+            state["fix1"][reg.key] = v1
+            v2 = self._fix_min_est_node(
+                reg, "est_active", [v[1] for v in vs], None, 1.0, False
+            )
+            return v1, v2
+
         rec(self.root)
+        state["running"] = False
+        self._est_dirty = set()
+        log.debug(f"Re-estimated {len(recomputed)} regions after {len(dirty)} changes")
+        return recomputed
+
+    @staticmethod
+    def _ancestors(reg):
+        r = reg.parent
+        while r is not None:
+            yield r
+            r = r.parent
+
+    @staticmethod
+    def _subtree(reg):
+        res = [reg]
+        for r in reg.sub:
+            res.extend(Regions._subtree(r))
+        return res
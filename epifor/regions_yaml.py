@@ -0,0 +1,222 @@
+import io
+import json
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+
+from .common import yaml
+
+log = logging.getLogger(__name__)
+
+# Region list item of `subregions` as written by `Regions.write_yaml` (indent 4)
+_ITEM = "-   "
+_KEY_RE = re.compile(r"key: *(.*?) *$")
+
+# Strings and floats written as-is by `write_regions_yaml`, others go via ruamel
+_PLAIN_INDICATORS = set("-?:,[]{}#&*!|<>='\"%@`~.+0123456789 ")
+_PLAIN_RESERVED = {"true", "false", "null", "yes", "no", "on", "off", "y", "n"}
+_PLAIN_FLOAT_RE = re.compile(r"-?[0-9]+\.[0-9]+$")
+
+
+class RegionsYamlIndex:
+    """
+    Byte offsets of the regions in a `regions.yaml` file.
+
+    Built by a single line scan (no YAML parsing) of the block format written by
+    `Regions.write_yaml`. For every region key stores `(start, fields_end, end,
+    indent, parent)`: the region mapping spans `[start, end)`, its own fields
+    `[start, fields_end)` (before `subregions`), `indent` is the mapping indent
+    and `parent` the parent key (None for the root). Use `read_fields` and
+    `read_subtree` to parse only parts of the file.
+    """
+
+    def __init__(self, path, entries):
+        self.path = Path(path)
+        # {key: [start, fields_end, end, indent, parent]}, in file order
+        self.entries = entries
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, path):
+        entries = {}
+        # Open regions: [indent, start, fields_end, key, parent_key]
+        stack = []
+
+        def close(indent, offset):
+            while stack and stack[-1][0] > indent:
+                ind, start, fend, key, parent = stack.pop()
+                if key is None:
+                    raise ValueError(f"Region without key at byte {start} of {path}")
+                entries[key][1:3] = [fend if fend is not None else offset, offset]
+
+        def open_region(indent, offset):
+            parent = stack[-1][3] if stack else None
+            stack.append([indent, offset, None, None, parent])
+
+        offset = 0
+        with open(path, "rb") as f:
+            for raw in f:
+                line = raw.decode("utf8")
+                stripped = line.lstrip(" ")
+                if stripped and stripped[0] not in "\n#":
+                    col = len(line) - len(stripped)
+                    close(col, offset)
+                    top = stack[-1] if stack else None
+                    if not entries and top is None:
+                        open_region(col, offset)
+                    elif (
+                        stripped.startswith(_ITEM)
+                        and top is not None
+                        and top[0] == col
+                        and top[2] is not None
+                    ):
+                        # Item of the `subregions` list of the region on top
+                        col, stripped = col + len(_ITEM), stripped[len(_ITEM) :]
+                        open_region(col, offset)
+                    top = stack[-1] if stack else None
+                    if top is not None and top[0] == col:
+                        if stripped.startswith("subregions:") and top[2] is None:
+                            top[2] = offset
+                        elif stripped.startswith("key:") and top[3] is None:
+                            top[3] = _parse_key(stripped)
+                            entries[top[3]] = [top[1], None, None, top[0], top[4]]
+                offset += len(raw)
+        close(-1, offset)
+        log.debug(f"Indexed {len(entries)} regions in {path}")
+        return cls(path, entries)
+
+    @classmethod
+    def load(cls, path, cache=None):
+        "Build the index, or load it from `StageCache` if available"
+        if cache is None:
+            return cls.build(path)
+        key = cache.stage_key("regions-index", files=[path])
+        d = cache.get("regions-index", key)
+        if d is not None:
+            with open(d / "index.json", "rt") as f:
+                return cls(path, json.load(f))
+        idx = cls.build(path)
+        with cache.store("regions-index", key) as d:
+            with open(d / "index.json", "wt") as f:
+                json.dump(idx.entries, f)
+        return idx
+
+    def parent(self, key):
+        return self.entries[key][4]
+
+    def ancestors(self, key):
+        "Keys of the ancestors of `key`, root first"
+        res = []
+        p = self.parent(key)
+        while p is not None:
+            res.append(p)
+            p = self.parent(p)
+        return res[::-1]
+
+    def _read(self, f, key, end_field):
+        start, fields_end, end, indent, _p = self.entries[key]
+        f.seek(start)
+        text = f.read((fields_end if end_field else end) - start).decode("utf8")
+        if indent > 0:
+            # Dedent, dropping the list item dash of the first line
+            text = "".join(l[indent:] for l in text.splitlines(keepends=True))
+        return yaml.load(text)
+
+    def read_fields(self, f, key):
+        "Parse the fields of a region without `subregions` (`f` opened in binary)"
+        return self._read(f, key, True)
+
+    def read_subtree(self, f, key):
+        "Parse the region with all its subregions (`f` opened in binary)"
+        return self._read(f, key, False)
+
+
+def _parse_key(s):
+    v = _KEY_RE.match(s).group(1)
+    if v[:1] in "'\"":
+        v = yaml.load(v)
+    return v
+
+
+def write_regions_yaml(root, stream, fields):
+    """
+    Write the region tree in pre-order to `stream`, as `yaml.dump` of
+    `Region.to_json_rec(nones=False)` would (mapping keys sorted, sequence indent 4).
+
+    `fields` are the region attributes to write, None values are skipped.
+    """
+    fields = sorted(fields)
+    scalars = {}
+    w = stream.write
+
+    def scalar(v):
+        # Keyed by type, as e.g. 8 == 8.0
+        k = (type(v), v)
+        res = scalars.get(k)
+        if res is None:
+            res = scalars[k] = _scalar(v)
+        return res
+
+    def rec(reg, indent, item):
+        pad = " " * indent
+        first = " " * (indent - len(_ITEM)) + _ITEM if item else pad
+        for f in fields:
+            v = getattr(reg, f)
+            if v is None:
+                continue
+            if isinstance(v, (list, tuple)):
+                if not v:
+                    w(f"{first}{f}: []\n")
+                else:
+                    w(f"{first}{f}:\n")
+                    for x in v:
+                        w(f"{pad}{_ITEM}{scalar(x)}\n")
+            else:
+                w(f"{first}{f}: {scalar(v)}\n")
+            first = pad
+        if reg.sub:
+            w(f"{first}subregions:\n")
+            for r in reg.sub:
+                rec(r, indent + len(_ITEM), True)
+
+    rec(root, 0, False)
+
+
+def _scalar(v):
+    "Format a scalar as ruamel's safe dumper in a block sequence or mapping"
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, str):
+        if (
+            v
+            and v[0] not in _PLAIN_INDICATORS
+            and v[-1] != " "
+            and v.isprintable()
+            and ":" not in v
+            and "#" not in v
+            and v.lower() not in _PLAIN_RESERVED
+            and len(v) < 64
+        ):
+            return v
+    elif isinstance(v, bool):
+        return "true" if v else "false"
+    elif isinstance(v, int):
+        return str(v)
+    elif isinstance(v, float):
+        r = repr(v)
+        if _PLAIN_FLOAT_RE.match(r):
+            return r
+    s = io.StringIO()
+    yaml.dump([v], s)
+    lines = s.getvalue().splitlines()
+    if len(lines) == 1 and lines[0].startswith(_ITEM):
+        return lines[0][len(_ITEM) :]
+    # Folded long strings; JSON strings are valid YAML
+    return json.dumps(v, ensure_ascii=False)
@@ -0,0 +1,170 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+class EstimateSampler:
+    """
+    Monte Carlo propagation of estimate uncertainty through the region tree.
+
+    Estimate inputs are arrays of shape (region, sample) with NaN for a missing
+    value, rows ordered as `self.keys` (pre-order). `propagate` applies the rules of
+    `Regions.estimate_active` (`propagate_down` and both `fix_min_est` passes) to all
+    samples at once, so the cost grows with the tree size, not the sample count.
+    """
+
+    def __init__(self, regions, n_samples=1000, seed=None):
+        self.regions = regions
+        self.n_samples = n_samples
+        self.rng = np.random.default_rng(seed)
+        regs = []
+
+        def rec(reg):
+            regs.append(reg)
+            for r in reg.sub:
+                rec(r)
+
+        rec(regions.root)
+        self.keys = [r.key for r in regs]
+        self.kinds = np.array([r.kind for r in regs], dtype=object)
+        self.index = {k: i for i, k in enumerate(self.keys)}
+        self.children = [
+            np.array([self.index[c.key] for c in r.sub], dtype=int) for r in regs
+        ]
+        self.pops = np.array(
+            [r.pop if r.pop is not None else np.nan for r in regs], dtype=float
+        )
+
+    def point_inputs(self, name):
+        "Broadcast a point estimate `Region.est[name]` to all samples"
+        v = self.regions.estimates.column(name, self.keys)
+        return np.repeat(v[:, None], self.n_samples, axis=1)
+
+    def sample_ft(self, predictions):
+        """
+        Sample from Foretold CDFs given as `{region_key: FTPrediction}`.
+
+        Uses inverse transform sampling on the (xs, cdf) pairs, other regions are NaN.
+        """
+        res = np.full((len(self.keys), self.n_samples), np.nan)
+        for k, p in predictions.items():
+            u = self.rng.random(self.n_samples)
+            ys, xs = np.maximum.accumulate(p.pred_ys), p.pred_xs
+            res[self.index[k]] = np.interp(u, ys, xs)
+        return res
+
+    def sample_lognormal(self, name, sigma=0.3):
+        """
+        Sample around point estimates `Region.est[name]` with lognormal noise.
+
+        The samples have the point estimate as the mean and `sigma` as the log-stdev,
+        missing estimates stay NaN.
+        """
+        v = self.point_inputs(name)
+        z = self.rng.standard_normal(v.shape)
+        return v * np.exp(sigma * z - sigma**2 / 2)
+
+    def sample_inputs(self, predictions=None, overrides=None, csse_sigma=0.3):
+        """
+        Return `(ft, csse)` input samples for `propagate`.
+
+        Regions with `predictions` (`{region_key: FTPrediction}`, e.g.
+        `FTData.applied`) are sampled from the Foretold CDFs, `overrides`
+        (`{region_key: est}`) and other `ft_mean` values are point estimates and
+        `csse_active` gets lognormal noise (see `sample_lognormal`).
+        """
+        ft = self.point_inputs("ft_mean")
+        if predictions:
+            rows = [self.index[k] for k in predictions]
+            ft[rows] = self.sample_ft(predictions)[rows]
+        for key, est in (overrides or {}).items():
+            ft[self.index[key]] = est
+        return ft, self.sample_lognormal("csse_active", sigma=csse_sigma)
+
+    def propagate(self, ft, csse, minimum_mult=2.0, est0=None):
+        """
+        Compute `est_active` samples from `ft_mean` and `csse_active` samples.
+
+        Vectorized equivalent of `Regions.estimate_active`; returns (region, sample).
+        """
+        est = np.full(ft.shape, np.nan) if est0 is None else est0.copy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._propagate_down(est, ft, csse)
+        self._fix_min_est(est, csse, minimum_mult, keep_nones=True)
+        self._fix_min_est(est, None, 1.0, keep_nones=False)
+        return est
+
+    def _propagate_down(self, est, ft, csse):
+        # Pre-order rows, parents are always processed before their children
+        for i in range(len(self.keys)):
+            e = np.where(np.isnan(ft[i]), est[i], ft[i])
+            valid = ~np.isnan(e)
+            est[i] = np.where(valid, e, est[i])
+            ch = self.children[i]
+            if len(ch) and valid.any():
+                pops = self.pops[ch][:, None]
+                csses = csse[ch]
+                fts = ft[ch]
+                ftnan = np.isnan(fts)
+                csse_ps = csses / pops
+                # Mean infection rate in children with CSSE but no FT
+                sel = ~np.isnan(csse_ps) & ftnan
+                cnt = sel.sum(axis=0)
+                mean_pss = np.where(
+                    cnt > 0, np.where(sel, csse_ps, 0.0).sum(axis=0) / cnt, 0.01
+                )
+                mean_pss = np.maximum(mean_pss, 0.0)
+                csses = np.where(np.isnan(csses), pops * mean_pss, csses)
+                rem_est = np.maximum(e - np.nansum(fts, axis=0), 0.0)
+                tot = np.maximum(np.where(ftnan, csses, 0.0).sum(axis=0), 0.0)
+                est[ch] = np.where(ftnan & valid, rem_est * csses / tot, est[ch])
+            c = csse[i]
+            cvalid = ~np.isnan(c)
+            est[i] = np.where(cvalid & (np.isnan(est[i]) | (est[i] < c)), c, est[i])
+
+    def _fix_min_est(self, est, minimum, minimum_mult, keep_nones):
+        # Reversed pre-order rows, children are always processed before parents
+        for i in reversed(range(len(self.keys))):
+            v = est[i]
+            if minimum is not None:
+                m = minimum[i] * minimum_mult
+                v = np.where(~np.isnan(m) & (np.nan_to_num(v) < m), m, v)
+            ch = self.children[i]
+            if len(ch):
+                cv = est[ch]
+                any_child = (~np.isnan(cv)).any(axis=0)
+                s = np.nansum(cv, axis=0)
+            else:
+                any_child = np.zeros(v.shape, dtype=bool)
+                s = np.zeros(v.shape)
+            mv = np.maximum(s, np.nan_to_num(v))
+            if keep_nones:
+                mv = np.where(any_child | ~np.isnan(v), mv, np.nan)
+            est[i] = mv
+
+    def quantiles(self, est, qs=(0.05, 0.5, 0.95), kinds=("city",), seeds=False):
+        """
+        Return DataFrame of `est` quantiles indexed by region key (for given kinds).
+
+        With `seeds`, the samples are first converted to seed numbers as in
+        `GleamDef.add_seeds` (0 for no seed).
+        """
+        rows = np.flatnonzero(np.isin(self.kinds, list(kinds)))
+        v = est[rows]
+        if seeds:
+            pops = self.pops[rows][:, None]
+            seeded = np.maximum(np.minimum(v, pops - 1), 1).astype(int)
+            v = np.where(v > 1, seeded, 0)
+        q = np.nanquantile(v, qs, axis=1).T
+        return pd.DataFrame(
+            q,
+            index=pd.Index([self.keys[i] for i in rows], name="key"),
+            columns=[f"q{int(round(x * 100)):02d}" for x in qs],
+        )
+
+
+def _nan(v):
+    return np.nan if v is None else v
@@ -0,0 +1,152 @@
+import datetime
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .common import die
+from .sampling import EstimateSampler
+
+log = logging.getLogger(__name__)
+
+
+def resolve_overrides(regions, region_estimates=None, country_estimates=None):
+    """
+    Return `{region_key: est}` for `region_active_estimates` and
+    `country_active_estimates`-style overrides (by key and by country name).
+    """
+    res = {}
+    if region_estimates:
+        log.info(f"Overriding 'ft_mean' for {len(region_estimates)} regions ...")
+        for key, est in region_estimates.items():
+            res[regions[key].key] = est
+    misses = []
+    if country_estimates:
+        log.info(
+            f"Overriding 'ft_mean' for {len(country_estimates)} name-spec countries ..."
+        )
+        for key, est in country_estimates.items():
+            r = regions.find_names(key, kinds="country")
+            if not r:
+                misses.append(key)
+                continue
+            if len(r) > 1:
+                die(f"Name {key} matches multiple countries: {r!r}")
+            res[r[0].key] = est
+    if misses:
+        log.warning(f"The following countries were not found: {misses!r}")
+    return res
+
+
+class WhatIf:
+    """
+    Estimate `est_active` for K variants of the estimate inputs at once.
+
+    Each variant is a dict with optional `name`, `region_active_estimates`,
+    `country_active_estimates` (as in the config) and `start_date`. The base inputs
+    are `ft_mean` and `csse_active` already in the regions (without overrides);
+    a `start_date` replaces them with the CSSE (and Foretold, if given) data of that
+    date. The variants are the sample columns of an `EstimateSampler`, so all of
+    them are propagated in one pass over the region tree.
+    """
+
+    def __init__(self, regions, variants, csse=None, ft=None):
+        self.regions = regions
+        self.variants = list(variants)
+        self.names = [
+            v.get("name") or f"variant-{i}" for i, v in enumerate(self.variants)
+        ]
+        if len(set(self.names)) < len(self.names):
+            die(f"Duplicate variant names in {self.names!r}")
+        self.csse = csse
+        self.ft = ft
+        self.sampler = EstimateSampler(regions, n_samples=len(self.variants))
+
+    def inputs(self):
+        "Return the `(ft, csse)` input matrices of shape (region, variant)"
+        s = self.sampler
+        ft = s.point_inputs("ft_mean")
+        csse = s.point_inputs("csse_active")
+        by_date = {}
+        for k, v in enumerate(self.variants):
+            date = v.get("start_date")
+            if date is not None:
+                if date not in by_date:
+                    by_date[date] = self._date_inputs(date, ft[:, k], csse[:, k])
+                ft[:, k], csse[:, k] = by_date[date]
+            overrides = resolve_overrides(
+                self.regions,
+                v.get("region_active_estimates"),
+                v.get("country_active_estimates"),
+            )
+            for key, est in overrides.items():
+                ft[s.index[key], k] = est
+        return ft, csse
+
+    def _date_inputs(self, date, ft, csse):
+        s = self.sampler
+        ft, csse = ft.copy(), csse.copy()
+        if self.csse is None:
+            die("Variant `start_date` requires CSSE data")
+        csse[:] = np.nan
+        for key, v in self.csse.active_by_date(self.regions, date).items():
+            csse[s.index[key]] = v
+        if self.ft is not None:
+            before = datetime.datetime.combine(
+                date, datetime.time(23, 59, 59)
+            ).astimezone()
+            # Clear the values from the applied predictions, then use those of the date
+            for key in self.ft.applied:
+                ft[s.index[key]] = np.nan
+            for key, v in self.ft.means_before(self.regions, before).items():
+                ft[s.index[key]] = v
+        return ft, csse
+
+    def estimate(self, minimum_mult=2.0):
+        "Return the `est_active` matrix of shape (region, variant)"
+        ft, csse = self.inputs()
+        return self.sampler.propagate(ft, csse, minimum_mult=minimum_mult)
+
+    def apply(self, est, k, est_key="est_active"):
+        "Write the estimates of variant `k` to `est[est_key]` of the regions"
+        for i, key in enumerate(self.sampler.keys):
+            e = self.regions[key].est
+            if np.isnan(est[i, k]):
+                e.pop(est_key, None)
+            else:
+                e[est_key] = float(est[i, k])
+
+    def seeds(self, est):
+        "Return DataFrame of city seed numbers (as in `GleamDef.add_seeds`) per variant"
+        s = self.sampler
+        rows = np.flatnonzero(s.kinds == "city")
+        v = est[rows]
+        pops = s.pops[rows][:, None]
+        with np.errstate(invalid="ignore"):
+            seeded = np.maximum(np.minimum(np.nan_to_num(v), pops - 1), 1).astype(int)
+            v = np.where(v > 1, seeded, 0)
+        return pd.DataFrame(
+            v,
+            index=pd.Index([s.keys[i] for i in rows], name="key"),
+            columns=self.names,
+        )
+
+    def gleamdefs(self, est, gv, start_date, compartments_mult, top=None):
+        """
+        Yield `(name, GleamDef)` seeded with the estimates of each variant.
+
+        The GleamDefs are copies of `gv`, leaves the last variant in the regions.
+        """
+        for k, (name, v) in enumerate(zip(self.names, self.variants)):
+            self.apply(est, k)
+            gv2 = gv.copy()
+            gv2.set_start_date(v.get("start_date") or start_date)
+            gv2.clear_seeds()
+            for comp, coef in compartments_mult.items():
+                gv2.add_seeds(
+                    self.regions,
+                    est_key="est_active",
+                    compartments={comp: coef},
+                    top=top,
+                )
+            yield name, gv2
@@ -3,7 +3,9 @@
 import argparse
 import datetime
 import logging
+import pickle
 import random
+import shutil
 import subprocess
 import sys
 import time
@@ -11,14 +13,23 @@ import urllib.parse
 from pathlib import Path
 from urllib.request import urlopen
 
+import pandas as pd
+
 import epifor
 from epifor import Regions
 from epifor.common import die, log_level, run_command, yaml
-from epifor.data.batch import Batch
+from epifor.data.batch import SIM_DEF_DIR, Batch, EstimatesTable
 from epifor.data.csse import CSSEData
+from epifor.data.export_diff import DIFF_THRESHOLDS, ExportDiff
 from epifor.data.fetch_foretold import fetch_foretold
 from epifor.data.foretold import FTData
-from epifor.gleam import GleamDef, Simulation
+from epifor.data.server import RegionServer
+from epifor.data.watch import BatchWatcher
+from epifor.gleam import BasinAggregator, BasinTable, GleamDef, Simulation
+from epifor.gleam.metapop import MetapopSimulator, load_basins
+from epifor.pipeline import StageCache
+from epifor.sampling import EstimateSampler
+from epifor.whatif import WhatIf, resolve_overrides
 
 log = logging.getLogger("gleambatch")
 
@@ -61,11 +72,11 @@ def update_data(args):
             f.write(result)
 
 
-def estimate(batch, rs: Regions):
+def load_inputs(config, rs: Regions):
     """
-    Create estimates and write them to `est` of all the regions.
+    Fix region pops, load CSSE and Foretold data and apply them to the regions.
 
-    Returns an updated GleamDef object.
+    Returns `(CSSEData, FTData or None)`.
     """
 
     # Fix any missing / inconsistent pops
@@ -75,59 +86,50 @@ def estimate(batch, rs: Regions):
     # Load and apply CSSE
     csse = CSSEData()
     csse.load(
-        batch.config["CSSE_dir"] + "/time_series_covid19_{}_global.csv",
-        batch.config["start_date"],
+        config["CSSE_dir"] + "/time_series_covid19_{}_global.csv",
+        config["start_date"],
     )
     csse.apply_to_regions(rs)
-    csse.convert_region_names(rs)
-    csse.save_hist_data(batch.get_out_dir(create=True))
 
-    if batch.config["use_foretold"]:
+    ft = None
+    if config["use_foretold"]:
         log.info("Loading and applying Foretold data")
         # Load and apply FT
         ft = FTData()
-        ft.load(batch.config["foretold_file"])
+        ft.load(config["foretold_file"])
         ft_before = datetime.datetime.combine(
-            batch.config["start_date"], datetime.time(23, 59, 59)
+            config["start_date"], datetime.time(23, 59, 59)
         ).astimezone()
         ft.apply_to_regions(rs, before=ft_before)
 
+    return csse, ft
+
+
+def estimate(batch, rs: Regions):
+    """
+    Create estimates and write them to `est` of all the regions.
+
+    Returns an updated GleamDef object.
+    """
+
+    csse, _ft = load_inputs(batch.config, rs)
+    csse.convert_region_names(rs)
+    csse.save_hist_data(batch.get_out_dir(create=True))
+
     # TODO: This is asking for a good refactor of the redistribution code ...
-    override = batch.config.get("region_active_estimates")
-    if override is not None:
-        log.info(f"Overriding 'ft_mean' for {len(override)} regions ...")
-        for key, est in override.items():
-            rs[key].est["ft_mean"] = est
-
-    override_countries = batch.config.get("country_active_estimates")
-    misses = []
-    if override_countries is not None:
-        log.info(
-            f"Overriding 'ft_mean' for {len(override_countries)} name-spec countries ..."
-        )
-        for key, est in override_countries.items():
-            r = rs.find_names(key, kinds="country")
-            if not r:
-                misses.append(key)
-                continue
-            if len(r) > 1:
-                die(f"Name {key} matches multiple countries: {r!r}")
-            r[0].est["ft_mean"] = est
-    if misses:
-        log.warning(f"The following countries were not found: {misses!r}")
-
-    # Main computation: propagate estimates and fix for consistency with CSSE
-    rs.propagate_down()
-
-    # Propagate estimates upwards to super-regions
-    rs.fix_min_est(
-        "est_active", keep_nones=True, minimum_from="csse_active", minimum_mult=2.0
-    )  ## TODO: param for mult
-
-    rs.check_missing_estimates("est_active")
+    overrides = resolve_overrides(
+        rs,
+        batch.config.get("region_active_estimates"),
+        batch.config.get("country_active_estimates"),
+    )
+    for key, est in overrides.items():
+        rs[key].est["ft_mean"] = est
+
+    # Main computation: propagate estimates down, fix for consistency with CSSE
+    # and propagate upwards to super-regions
+    rs.estimate_active(minimum_mult=2.0)  ## TODO: param for mult
 
     # Store the initial estimates in batch data
-    rs.fix_min_est("est_active")
     batch.store_region_estimates(rs, "est_active", "FT_Infected")
     # Finally, propagate csse upwards and also store
     for loc_key, rem_key in [
@@ -150,6 +152,78 @@ def estimate(batch, rs: Regions):
         batch.store_region_estimates(rs, loc_key, rem_key)
 
 
+# Config entries (and files) the estimate stage depends on
+ESTIMATE_CONFIG_KEYS = [
+    "start_date",
+    "CSSE_dir",
+    "use_foretold",
+    "foretold_file",
+    "region_active_estimates",
+    "country_active_estimates",
+    "regions",
+]
+
+
+def get_stage_cache(config, args):
+    cache_dir = config.get("cache_dir", Path(config["output_dir"]) / "cache")
+    return StageCache(cache_dir, enabled=not args.no_cache)
+
+
+def load_regions(path, cache: StageCache):
+    """
+    Load Regions from YAML, cached by the file contents.
+
+    Returns `(regions, key)`, the key for the dependent stages is the
+    `content_hash` of the region tree (unchanged by formatting-only edits).
+    """
+    key = cache.stage_key("regions", files=[path])
+    d = cache.get("regions", key)
+    if d is not None:
+        with open(d / "regions.pickle", "rb") as f:
+            rs = pickle.load(f)
+        return rs, rs.content_hash()
+    log.info(f"Reading regions from {path} ...")
+    rs = Regions.load_from_yaml(path)
+    # Persist the fuzzy name index along with the regions
+    rs.get_fuzzy_index()
+    with cache.store("regions", key) as d:
+        with open(d / "regions.pickle", "wb") as f:
+            pickle.dump(rs, f)
+    return rs, rs.content_hash()
+
+
+def cached_estimate(batch, rs: Regions, regions_key, cache: StageCache):
+    """
+    Run `estimate` unless cached for the same inputs.
+
+    Returns `(regions, stage_key)` with the estimated regions; the batch region data
+    and history file are also restored from the cache.
+    """
+    config = {k: batch.config.get(k) for k in ESTIMATE_CONFIG_KEYS}
+    files = [
+        batch.config["CSSE_dir"] + f"/time_series_covid19_{name}_global.csv"
+        for name in ["confirmed", "deaths", "recovered"]
+    ]
+    if batch.config["use_foretold"]:
+        files.append(batch.config["foretold_file"])
+    key = cache.stage_key("estimate", config, files, deps=[regions_key])
+    hist_path = batch.get_out_dir() / batch.HIST_FILE_NAME
+
+    d = cache.get("estimate", key)
+    if d is not None:
+        with open(d / "estimate.pickle", "rb") as f:
+            rs, batch.region_data = pickle.load(f)
+        shutil.copy(d / batch.HIST_FILE_NAME, hist_path)
+        return rs, key
+
+    estimate(batch, rs)
+    with cache.store("estimate", key) as d:
+        with open(d / "estimate.pickle", "wb") as f:
+            pickle.dump((rs, batch.to_json()["region_data"]), f)
+        shutil.copy(hist_path, d / batch.HIST_FILE_NAME)
+    return rs, key
+
+
 def estimates_to_gleamdef(batch, rs: Regions, input_xml_path, top_seeds=None):
     gv = GleamDef(input_xml_path)
     gv.set_start_date(batch.config["start_date"])
@@ -160,6 +234,28 @@ def estimates_to_gleamdef(batch, rs: Regions, input_xml_path, top_seeds=None):
     return gv
 
 
+def cached_estimates_to_gleamdef(
+    batch, rs: Regions, estimate_key, input_xml_path, cache: StageCache, top_seeds=None
+):
+    """Run `estimates_to_gleamdef` unless cached for the same inputs."""
+    config = {
+        "start_date": batch.config["start_date"],
+        "compartments_mult": batch.config["compartments_mult"],
+        "top_seeds": top_seeds,
+    }
+    key = cache.stage_key(
+        "gleamdef", config, files=[input_xml_path], deps=[estimate_key]
+    )
+    d = cache.get("gleamdef", key)
+    if d is not None:
+        return GleamDef(d / "definition.xml")
+    gv = estimates_to_gleamdef(batch, rs, input_xml_path, top_seeds=top_seeds)
+    with cache.store("gleamdef", key) as d:
+        with log_level(epifor.gleam.gleamdef.log, logging.WARNING):
+            gv.save(d / "definition.xml")
+    return gv
+
+
 def parameterize(batch, gv):
     last_ts = 0
     for mit in batch.config["mitigations"]:
@@ -186,9 +282,6 @@ def parameterize(batch, gv):
             )
 
 
-SIM_DEF_DIR = "simulation-defs"
-
-
 def generate(args):
     """The 'generate' subcommand"""
 
@@ -196,13 +289,16 @@ def generate(args):
         config = yaml.load(f)
     out_dir = Path(config["output_dir"]).expanduser().mkdir(exist_ok=True, parents=True)
     batch = Batch.new(config, suffix=args.comment.replace(" ", "-"))
+    cache = get_stage_cache(config, args)
 
-    log.info(f"Reading regions from {batch.config['regions_file']} ...")
-    rs = Regions.load_from_yaml(batch.config["regions_file"])
+    rs, regions_key = load_regions(batch.config["regions_file"], cache)
 
-    estimate(batch, rs)
+    rs, estimate_key = cached_estimate(batch, rs, regions_key, cache)
+    batch.save_estimates(rs)
 
-    gv = estimates_to_gleamdef(batch, rs, args.GLEAM_XML, top_seeds=args.top_seeds)
+    gv = cached_estimates_to_gleamdef(
+        batch, rs, estimate_key, args.GLEAM_XML, cache, top_seeds=args.top_seeds
+    )
 
     parameterize(batch, gv)
 
@@ -223,6 +319,68 @@ def generate(args):
     )
 
 
+def whatif(args):
+    """The 'whatif' subcommand"""
+
+    with open(args.CONFIG_YAML, "rt") as f:
+        config = yaml.load(f)
+    with open(args.VARIANTS_YAML, "rt") as f:
+        variants = yaml.load(f)
+    cache = get_stage_cache(config, args)
+    rs, _regions_key = load_regions(config["regions_file"], cache)
+    csse, ft = load_inputs(config, rs)
+
+    # Config overrides apply to all variants (variant entries take precedence)
+    for v in variants:
+        for k in ["region_active_estimates", "country_active_estimates"]:
+            v[k] = {**(config.get(k) or {}), **(v.get(k) or {})}
+
+    wi = WhatIf(rs, variants, csse=csse, ft=ft)
+    log.info(f"Estimating {len(wi.names)} variants ...")
+    est = wi.estimate(minimum_mult=2.0)
+
+    out_dir = Path(args.output_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    wi.seeds(est).to_csv(out_dir / "seeds.csv")
+    gv = GleamDef(args.GLEAM_XML)
+    with log_level(epifor.gleam.gleamdef.log, logging.WARNING):
+        for name, gv2 in wi.gleamdefs(
+            est,
+            gv,
+            config["start_date"],
+            config["compartments_mult"],
+            top=args.top_seeds,
+        ):
+            gv2.set_name(f"{gv2.get_name()} {name}")
+            gv2.save(out_dir / f"{name}.xml")
+    log.info(f"Wrote {len(wi.names)} definitions and seeds.csv to {out_dir}")
+
+
+def sample(args):
+    """The 'sample' subcommand"""
+
+    with open(args.CONFIG_YAML, "rt") as f:
+        config = yaml.load(f)
+    cache = get_stage_cache(config, args)
+    rs, _regions_key = load_regions(config["regions_file"], cache)
+    csse, ft = load_inputs(config, rs)
+    overrides = resolve_overrides(
+        rs,
+        config.get("region_active_estimates"),
+        config.get("country_active_estimates"),
+    )
+
+    smp = EstimateSampler(rs, n_samples=args.samples, seed=args.seed)
+    ft_s, csse_s = smp.sample_inputs(
+        ft.applied if ft is not None else None, overrides, csse_sigma=args.csse_sigma
+    )
+    log.info(f"Propagating {args.samples} samples of {len(smp.keys)} regions ...")
+    est = smp.propagate(ft_s, csse_s, minimum_mult=2.0)
+    q = smp.quantiles(est, qs=args.quantiles, seeds=True)
+    q.to_csv(args.output)
+    log.info(f"Wrote seed quantiles of {len(q)} cities to {args.output}")
+
+
 def upload_data(args):
     """The 'upload' subcommand"""
 
@@ -275,15 +433,98 @@ def process(args):
     if args.override_config is not None:
         with open(args.override_config, "rt") as f:
             batch.config = yaml.load(f)
-    log.info(f"Reading regions from {batch.config['regions_file']} ...")
-    rs = Regions.load_from_yaml(batch.config["regions_file"])
+    cache = get_stage_cache(batch.config, args)
+    rs, _regions_key = load_regions(batch.config["regions_file"], cache)
     batch.load_sims(allow_unfinished=args.allow_missing, sims_dir=args.sims_dir)
-    export_dir = batch.write_export_data(rs)
+    if args.aggregate:
+        batch.set_aggregator(BasinAggregator(rs, BasinTable.load(cache)))
+    export_dir = batch.write_export_data(rs, compress=args.precompress)
+    log.info(
+        f"To upload, run '{sys.argv[0]} upload {batch.get_batch_file_path()} {export_dir} -C CHANNEL'."
+    )
+
+
+def watch(args):
+    """The 'watch' subcommand"""
+
+    batch = Batch.load(args.BATCH_YAML)
+    cache = get_stage_cache(batch.config, args)
+    rs, _regions_key = load_regions(batch.config["regions_file"], cache)
+    if args.aggregate:
+        batch.set_aggregator(BasinAggregator(rs, BasinTable.load(cache)))
+    watcher = BatchWatcher(batch, rs, sims_dir=args.sims_dir, compress=args.precompress)
+    export_dir = watcher.run(interval=args.interval)
     log.info(
         f"To upload, run '{sys.argv[0]} upload {batch.get_batch_file_path()} {export_dir} -C CHANNEL'."
     )
 
 
+def serve(args):
+    """The 'serve' subcommand (local server of region data computed on demand)"""
+
+    batch = Batch.load(args.BATCH_YAML)
+    cache = get_stage_cache(batch.config, args)
+    rs, _regions_key = load_regions(batch.config["regions_file"], cache)
+    batch.load_sims(allow_unfinished=True, sims_dir=args.sims_dir)
+    if args.aggregate:
+        batch.set_aggregator(BasinAggregator(rs, BasinTable.load(cache)))
+    hist = batch.get_out_dir() / batch.HIST_FILE_NAME
+    if hist.exists():
+        table = EstimatesTable(pd.read_hdf(hist))
+    else:
+        log.warning(f"{hist} not found, serving regions without estimates")
+        table = None
+    server = RegionServer(batch, rs, table, cache_size=args.cache_size)
+    server.run(args.host, args.port)
+
+
+def simulate(args):
+    """The 'simulate' subcommand (local stand-in for running GleamViz)"""
+
+    batch = Batch.load(args.BATCH_YAML)
+    cache = get_stage_cache(batch.config, args)
+    rs, _regions_key = load_regions(batch.config["regions_file"], cache)
+    rs.heuristic_set_pops()
+    if args.sims_dir is None:
+        sims_dir = batch.get_out_dir() / SIM_DEF_DIR
+    else:
+        sims_dir = Path(args.sims_dir)
+    sim = MetapopSimulator(load_basins(rs, BasinTable.load(cache)))
+    sim.simulate_dirs([sims_dir / f"{bs.id}.gvh5" for bs in batch.sims])
+    log.info(
+        f"Run '{sys.argv[0]} process {batch.get_batch_file_path()} -S {sims_dir}' to process the results."
+    )
+
+
+def diff_exports(args):
+    """The 'diff' subcommand (pre-publish check of an export against the previous one)"""
+
+    d = ExportDiff.load(args.OLD_JSON, args.NEW_JSON)
+    thresholds = {
+        k: (args.rel_threshold, atol) for k, (_rtol, atol) in DIFF_THRESHOLDS.items()
+    }
+    out = d.outliers(thresholds)
+    log.info(
+        f"Compared {len(d.keys)} regions over {len(d.days)} days and {len(d.groups)}"
+        f" groups ({len(d.added)} added, {len(d.removed)} removed regions)"
+    )
+    if args.output:
+        out.to_csv(args.output, index=False)
+        log.info(f"Wrote {len(out)} outliers to {args.output}")
+    if len(out) > 0:
+        log.warning(f"Largest changes:\n{out.head(args.show).to_string()}")
+        die(f"{len(out)} changes above the thresholds")
+    log.info("No changes above the thresholds")
+
+
+def repack(args):
+    """The 'repack' subcommand"""
+
+    batch = Batch.load(args.BATCH_YAML)
+    batch.load_sims(allow_unfinished=args.allow_missing, sims_dir=args.sims_dir)
+    batch.repack_sims()
+
+
 def create_parser():
     ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     ap.add_argument(
@@ -305,8 +546,63 @@ def create_parser():
         type=int,
         help="Limit the number of seed cities (Gleam seems to fail if too many, ~2000?).",
     )
+    genp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
     genp.set_defaults(func=generate)
 
+    wifp = sp.add_parser(
+        "whatif", help="Estimate and seed GLEAM configs for several input variants",
+    )
+    wifp.add_argument("CONFIG_YAML", help="YAML config to use.")
+    wifp.add_argument("GLEAM_XML", help="Use given XML as GLEAM def template.")
+    wifp.add_argument(
+        "VARIANTS_YAML",
+        help="YAML list of variants (name, region_active_estimates,"
+        " country_active_estimates, start_date).",
+    )
+    wifp.add_argument("-o", "--output-dir", default="whatif", help="Output directory.")
+    wifp.add_argument(
+        "--top-seeds",
+        default=1800,
+        type=int,
+        help="Limit the number of seed cities (Gleam seems to fail if too many, ~2000?).",
+    )
+    wifp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
+    wifp.set_defaults(func=whatif)
+
+    smpp = sp.add_parser(
+        "sample", help="Sample the estimate inputs and write city seed quantiles"
+    )
+    smpp.add_argument("CONFIG_YAML", help="YAML config to use.")
+    smpp.add_argument(
+        "-o", "--output", default="seed-quantiles.csv", help="Output CSV file."
+    )
+    smpp.add_argument(
+        "-n", "--samples", default=1000, type=int, help="Number of samples."
+    )
+    smpp.add_argument(
+        "-q",
+        "--quantiles",
+        default=[0.05, 0.5, 0.95],
+        type=float,
+        nargs="+",
+        help="Quantiles to write (default: 0.05 0.5 0.95).",
+    )
+    smpp.add_argument(
+        "--csse-sigma",
+        default=0.3,
+        type=float,
+        help="Log-stdev of the lognormal noise of CSSE counts.",
+    )
+    smpp.add_argument("--seed", type=int, help="Random seed.")
+    smpp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
+    smpp.set_defaults(func=sample)
+
     procp = sp.add_parser(
         "process", help="Process finished simulations from a batch, generate graphs.",
     )
@@ -319,10 +615,118 @@ def create_parser():
         help="Allow missing simulation results.",
     )
     procp.add_argument("-S", "--sims-dir", help="Explicit sims/ dir.")
+    procp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
     procp.add_argument("-C", "--override-config", help="Override batch config.")
     procp.add_argument(
         "-G", "--override-sims", help="Override simulation data from another batch."
     )
+    procp.add_argument(
+        "-Z",
+        "--precompress",
+        action="append",
+        choices=["gz", "br"],
+        default=[],
+        help="Also write precompressed main data file (can be repeated).",
+    )
+    procp.add_argument(
+        "-A",
+        "--aggregate",
+        action="store_true",
+        help="Aggregate basin results for regions without GLEAM results (e.g. states).",
+    )
+
+    watchp = sp.add_parser(
+        "watch", help="Process simulations of a batch as they finish.",
+    )
+    watchp.add_argument("BATCH_YAML", help="Batch config to use.")
+    watchp.set_defaults(func=watch)
+    watchp.add_argument(
+        "-i", "--interval", default=30.0, type=float, help="Polling interval (seconds)."
+    )
+    watchp.add_argument("-S", "--sims-dir", help="Explicit sims/ dir.")
+    watchp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
+    watchp.add_argument(
+        "-Z",
+        "--precompress",
+        action="append",
+        choices=["gz", "br"],
+        default=[],
+        help="Also write precompressed main data file (can be repeated).",
+    )
+    watchp.add_argument(
+        "-A",
+        "--aggregate",
+        action="store_true",
+        help="Aggregate basin results for regions without GLEAM results (e.g. states).",
+    )
+
+    servp = sp.add_parser(
+        "serve", help="Serve traces and stats of any region, computed on demand."
+    )
+    servp.add_argument("BATCH_YAML", help="Batch config to use.")
+    servp.set_defaults(func=serve)
+    servp.add_argument("-S", "--sims-dir", help="Explicit sims/ dir.")
+    servp.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    servp.add_argument("-p", "--port", type=int, default=8000, help="Port to use.")
+    servp.add_argument(
+        "--cache-size", type=int, default=256, help="Number of regions to cache."
+    )
+    servp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
+    servp.add_argument(
+        "-A",
+        "--aggregate",
+        action="store_true",
+        help="Aggregate basin results for regions without GLEAM results (e.g. states).",
+    )
+
+    simp = sp.add_parser(
+        "simulate", help="Run batch simulations locally (quick metapopulation model).",
+    )
+    simp.add_argument("BATCH_YAML", help="Batch config to use.")
+    simp.set_defaults(func=simulate)
+    simp.add_argument(
+        "-S", "--sims-dir", help="Explicit sims/ dir (default: batch simulation-defs)."
+    )
+    simp.add_argument(
+        "--no-cache", action="store_true", help="Do not use or update stage cache."
+    )
+
+    diffp = sp.add_parser(
+        "diff", help="Compare an export with a previous one, fail on large changes."
+    )
+    diffp.add_argument("OLD_JSON", help="Previous export data file.")
+    diffp.add_argument("NEW_JSON", help="New export data file.")
+    diffp.add_argument(
+        "-r",
+        "--rel-threshold",
+        type=float,
+        default=0.25,
+        help="Relative change threshold (default 0.25).",
+    )
+    diffp.add_argument("-o", "--output", help="Write all the outliers to this CSV.")
+    diffp.add_argument(
+        "--show", type=int, default=20, help="Number of outliers to log."
+    )
+    diffp.set_defaults(func=diff_exports)
+
+    repp = sp.add_parser(
+        "repack", help="Repack finished simulation results for faster processing.",
+    )
+    repp.add_argument("BATCH_YAML", help="Batch config to use.")
+    repp.set_defaults(func=repack)
+    repp.add_argument(
+        "-M",
+        "--allow-missing",
+        action="store_true",
+        help="Allow (and skip) missing simulation results.",
+    )
+    repp.add_argument("-S", "--sims-dir", help="Explicit sims/ dir.")
 
     uplp = sp.add_parser("upload", help="Upload data to the configured GCS bucket")
     uplp.add_argument("BATCH_YAML", help="Batch config to use.")
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+from epifor import Regions
+from epifor.data.batch import Batch
+from epifor.gleam import BasinAggregator, BasinTable, GleamDef, Simulation
+from epifor.pipeline import StageCache
+from test_simulation import make_sim_dir
+
+
+def test_basin_aggregation():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    agg = BasinAggregator(rs)
+    md = pd.read_csv("data/gleam/md_cities.tsv", sep="\t")
+    data = np.random.rand(agg.n_basins, 2, 3)
+    res = agg.aggregate(data)
+    assert res.shape == (len(rs.key_index), 2, 3)
+
+    assert np.allclose(res[agg.index["earth"]], data.sum(axis=0))
+    city = rs["menongue"]
+    assert np.allclose(res[agg.index["menongue"]], data[city.gleam_id])
+    angola = rs["angola"]
+    sel = md["Country ID"].values == angola.gleam_id
+    assert np.allclose(res[agg.index["angola"]], data[sel].sum(axis=0))
+    # States have no GLEAM id, but are sums of their cities
+    state = next(r for r in rs.regions if r.kind == "state")
+    assert np.allclose(
+        res[agg.index[state.key]], sum(data[c.gleam_id] for c in state.sub)
+    )
+
+
+def test_basin_aggregation_cache(tmp_path):
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    agg = BasinAggregator(rs, cache_size=2)
+    sims = []
+    for i in range(3):
+        d = make_sim_dir(tmp_path / f"{i}.gvh5", basins=agg.n_basins, seed=i)
+        gv = GleamDef(d / "definition.xml")
+        gv.set_id(str(i))
+        gv.save(d / "definition.xml")
+        sims.append(Simulation.load_dir(d))
+    a0 = agg.aggregate_sim(sims[0])
+    assert np.allclose(a0, agg.aggregate(sims[0].get_basin_seqs()))
+    agg.aggregate_sim(sims[1])
+    assert agg.aggregate_sim(sims[0]) is a0
+    agg.aggregate_sim(sims[2])
+    # Least recently used evicted, no references to the Simulations kept
+    assert list(agg._cache) == [("0", True, "median"), ("2", True, "median")]
+
+    # Grown to hold all the sims of a batch
+    b = Batch.new({})
+    for i, sim in enumerate(sims):
+        b.add_simulation_info(sim, f"s{i}", "None")
+    b.set_aggregator(agg)
+    assert b.aggregator is agg and agg.cache_size == 3
+
+
+def test_basin_table(tmp_path):
+    cache = StageCache(tmp_path)
+    t = BasinTable.load(cache)
+    t2 = BasinTable.load(cache)
+    assert len(list(tmp_path.glob("basins-*/basins.npz"))) == 1
+    md = pd.read_csv("data/gleam/md_cities.tsv", sep="\t")
+    assert len(t) == len(t2) == len(md)
+    for c in BasinTable.COLUMNS:
+        a, b = getattr(t, c), getattr(t2, c)
+        assert a.dtype == b.dtype and np.array_equal(
+            a, b, equal_nan=a.dtype.kind == "f"
+        )
+
+    i = t2.by_iata("SPP")
+    assert t2.name[i] == "Menongue" and t2.row(t2.gleam_id[i]) == i
+    assert t2.tz[i] == "Africa/Luanda" and abs(t2.lat[i] + 14.66) < 0.1
+    assert t2.by_iata("XXX") is None
+    angola = md["Country ID"].values[i]
+    assert np.array_equal(
+        t2.by_country(angola), np.flatnonzero(md["Country ID"].values == angola)
+    )
@@ -0,0 +1,121 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from epifor import Region
+from epifor.data.batch import (
+    INTERPOLATION_QS,
+    Batch,
+    EstimatesTable,
+    lttb_indices,
+    normal_stats,
+)
+from epifor.data.export import ExportRegion
+from epifor.gleam import GleamDef, Simulation
+from test_simulation import make_sim_dir
+
+
+def test_normal_stats():
+    rnd = np.random.RandomState(1)
+    data = rnd.rand(5, 3, 6) * 0.1
+    data[0, 0, :] = 0.01  # zero variance
+    data[1, 1, :] = 0.99  # q95 clipped
+    data[2, 2, 4:] = np.nan  # padding
+    st = normal_stats(data)
+    for i in range(5):
+        for j in range(3):
+            d = data[i, j][~np.isnan(data[i, j])]
+            m, v = norm.fit(d)
+            dist = norm(m, max(v, 3e-5))
+            assert np.isclose(st["mean"][i, j], dist.mean() * 1000)
+            assert np.isclose(st["q05"][i, j], max(dist.ppf(0.05), 0.0) * 1000)
+            assert np.isclose(st["q95"][i, j], min(dist.ppf(0.95), 1.0) * 1000)
+
+
+def test_lttb_indices():
+    x = np.arange(200)
+    ys = np.stack([np.sin(x / 10.0), np.where(x == 77, 5.0, 0.0), x * 0.5])
+    idx = lttb_indices(ys, 20)
+    assert idx.shape == (3, 20)
+    assert (idx[:, 0] == 0).all() and (idx[:, -1] == 199).all()
+    assert (np.diff(idx, axis=1) > 0).all()
+    # The spike is kept
+    assert 77 in idx[1]
+    assert np.array_equal(lttb_indices(ys, 300), np.tile(x, (3, 1)))
+
+
+def test_generate_regions_traces(tmp_path):
+    regions = [
+        Region("A", kind="country", gleam_id=1),
+        Region("B", kind="city", gleam_id=3),
+        Region("C", kind="city", gleam_id=4),
+    ]
+    b = Batch.new({"output_dir": str(tmp_path)})
+    params = [(s, t) for s in [0.85, 0.6, 1.0] for t in [20, 70]]
+    for j, (seasonality, traffic) in enumerate(params):
+        d = make_sim_dir(tmp_path / f"{j}.gvh5", seed=j)
+        gv = GleamDef(d / "definition.xml")
+        gv.set_seasonality(seasonality)
+        gv.set_traffic_occupancy(traffic)
+        gv.save(d / "definition.xml")
+        group = ["None", "High"][j % 3 == 0]
+        b.add_simulation_info(Simulation.load_dir(d), f"s{j}", group, color="#ff0000")
+
+    inums = [b.get_initial_number(r) for r in regions]
+    res = b.generate_regions_traces(regions, inums, skip_days=2)
+    for r, inum in zip(regions, inums):
+        assert res[r.key] == b.generate_region_traces(r, inum)
+        # Interpolations as computed pair by pair
+        sims = [bs for bs in b.sims if bs.group == "None"]
+        expected = []
+        for t in dict.fromkeys(
+            bs.sim.definition.get_traffic_occupancy() for bs in sims
+        ):
+            ss = [bs for bs in sims if bs.sim.definition.get_traffic_occupancy() == t]
+            ss.sort(key=lambda bs: bs.sim.definition.get_seasonality())
+            for bs1, bs2 in zip(ss[:-1], ss[1:]):
+                y1, y2 = [b._active_series(bs, r, inum) for bs in (bs1, bs2)]
+                for q in INTERPOLATION_QS:
+                    expected.append(((q * y1 + (1.0 - q) * y2) * 1000)[2:])
+        traces = res[r.key]["None"]
+        assert len(traces) == len(expected) + len(sims)
+        for tr, y in zip(traces, expected):
+            assert np.allclose(tr["y"], y)
+
+
+def test_export_region_estimates():
+    df = pd.DataFrame(
+        {
+            "active_20200320": [1, 2],
+            "confirmed_20200320": [3.5, 4],
+            "deaths_20200321": [5, 6],
+            "active_20200319": [7, 8],
+            "recovered_20200319": [9, 10],
+        },
+        index=["a", "b"],
+    )
+    b = Batch.new({"start_date": datetime.date(2020, 3, 20)})
+    b.region_data = {"a": {"FT_Infected": 42.0}}
+    table = EstimatesTable(df)
+    assert table.iso_dates == ["2020-03-19", "2020-03-20", "2020-03-21"]
+    assert table.get("c") is None
+    for key in ["a", "b", "c"]:
+        er = ExportRegion(Region(key.upper()))
+        b.export_region_estimates(er, table)
+        # Row-wise from the DataFrame, zeros for missing regions and dates
+        row = df.loc[key] if key in df.index else {}
+        days = {}
+        for d in ["20200319", "20200320", "20200321"]:
+            ests = {
+                "JH_Deaths": row.get(f"deaths_{d}", 0),
+                "JH_Confirmed": row.get(f"confirmed_{d}", 0),
+                "JH_Recovered": row.get(f"recovered_{d}", 0),
+                "JH_Infected": row.get(f"active_{d}", 0),
+            }
+            date = datetime.datetime.strptime(d, "%Y%m%d").date()
+            if date == b.config["start_date"]:
+                ests["FT_Infected"] = b.region_data.get(key, {}).get("FT_Infected")
+            days[date.isoformat()] = ests
+        assert er.data["estimates"] == {"days": days}
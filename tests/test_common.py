@@ -1,7 +1,19 @@
-from epifor.common import mix_html_colors
+import numpy as np
+import pandas as pd
+
+from epifor.common import _n, _n_cache_info, _n_many, mix_html_colors
 
 
 def test_colors():
     assert mix_html_colors() == "#000000"
     assert mix_html_colors(("#023AFF", 1.0)) == "#023AFF"
     assert mix_html_colors(("00FFFF", 0.5), ("FF0000", 0.5)) == "#7F7F7F"
+
+
+def test_n_many():
+    s = pd.Series(["Côte-d'Ivoire", np.nan, "Praha", "Praha"], index=[5, 6, 7, 8])
+    r = _n_many(s)
+    assert list(r.index) == [5, 6, 7, 8]
+    assert list(r) == [_n(x) for x in s]
+    assert list(_n_many(["A-b", "A-b"])) == ["a b", "a b"]
+    assert _n_cache_info().currsize > 0
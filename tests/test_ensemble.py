@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+
+from epifor import Region
+from epifor.data.batch import SIM_DEF_DIR, Batch
+from epifor.data.ensemble import BatchEnsemble
+from epifor.gleam import GleamDef, Simulation
+from test_simulation import make_sim_dir
+
+
+def test_batch_ensemble(tmp_path):
+    regions = [
+        Region("A", kind="country", gleam_id=1),
+        Region("B", kind="city", gleam_id=3),
+    ]
+    for i, start in enumerate([datetime.date(2020, 4, 1), datetime.date(2020, 4, 3)]):
+        b = Batch.new({"output_dir": str(tmp_path), "gleamviz_dir": str(tmp_path)})
+        b.name = f"batch-{i}"
+        (b.get_out_dir() / SIM_DEF_DIR).mkdir()
+        for j, group in enumerate(["None", "High"]):
+            gid = f"{i}{j}.574"
+            d = make_sim_dir(b.get_out_dir() / SIM_DEF_DIR / f"{gid}.gvh5", seed=j)
+            gv = GleamDef(d / "definition.xml")
+            gv.set_id(gid)
+            gv.set_start_date(start)
+            gv.save(d / "definition.xml")
+            b.add_simulation_info(Simulation(gv, None), name="s", group=group)
+        b.save()
+
+    ens = BatchEnsemble.index(tmp_path)
+    ens.load_sims()
+    days, values = ens.active(regions)
+    assert ens.groups == ["None", "High"] and ens.scenarios == ["s"]
+    assert values.shape == (2, 2, 1, 2, 12) and len(days) == 12
+    b = ens.batches[1]
+    sq = b.sims[1].sim.get_seq(3, "city")
+    init = b.get_initial_number(regions[1])
+    assert np.allclose(values[1, 1, 0, 1, 2:], (sq[2] - sq[3] + init) * 1000)
+    assert np.isnan(values[1, :, :, :, :2]).all()
+    assert ens.deltas(values).shape == (1, 2, 1, 2, 12)
+    q = ens.consensus(values)
+    assert q.shape == (3, 2, 1, 2, 12)
+    # Only the first batch covers the first two days
+    assert np.allclose(q[1, ..., :2], values[0, ..., :2])
+    ens.close()
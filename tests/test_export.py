@@ -0,0 +1,74 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+from epifor import Regions
+from epifor.data.export import ExportDoc, ExportDocWriter
+from epifor.data.export_diff import ExportDiff
+
+
+def test_export_doc_writer(tmp_path):
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    ed = ExportDoc(comment="test")
+    path = tmp_path / "data.json"
+    with ExportDocWriter(path, comment="test", compress=["gz"]) as edw:
+        ed.created = edw.created
+        for i, k in enumerate(["czech republic", "angola", "africa"]):
+            for doc in [ed, edw]:
+                er = doc.add_region(rs[k])
+                er.data["x"] = {"a": np.float64(i / 3), "b": [1, 2.5, None]}
+                if doc is edw:
+                    edw.write_region(er, toweb=True)
+    expected = json.loads(json.dumps(ed.to_json(toweb=True)))
+    with open(path, "rt") as f:
+        assert json.load(f) == expected
+    with gzip.open(f"{path}.gz", "rt") as f:
+        assert json.load(f) == expected
+
+
+def test_export_doc_writer_exception(tmp_path):
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    path = tmp_path / "data.json"
+    path.write_text("{}")
+    with pytest.raises(RuntimeError):
+        with ExportDocWriter(path, compress=["gz"]) as edw:
+            edw.write_region(edw.add_region(rs["angola"]))
+            raise RuntimeError("export failed")
+    # The previous document is kept, no partial files are left
+    assert path.read_text() == "{}"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["data.json"]
+
+
+def test_export_load_and_diff(tmp_path):
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    out_dir = tmp_path / "export"
+    out_dir.mkdir()
+    paths = []
+    for v, keys in [(1.0, ["czech republic", "angola"]), (1.1, ["angola", "africa"])]:
+        path = out_dir / f"data-{v}.json"
+        with ExportDocWriter(path, compress=["gz"]) as edw:
+            for k in keys:
+                er = edw.add_region(rs[k])
+                days = {"2020-04-01": {"JH_Infected": 100.0, "FT_Infected": None}}
+                days["2020-04-02"] = {"JH_Infected": 200.0 * v}
+                er.data["estimates"] = {"days": days}
+                er.data["mitigation_stats"] = {"WEAK": {"TotalInfected_mean": 10.0}}
+                er.data["infected_per_1000"] = {"traces_url": "export/t.json"}
+                edw.write_region(er)
+        paths.append(path)
+    (out_dir / "t.json").write_text('{"WEAK": []}')
+
+    ed = ExportDoc.load(f"{paths[0]}.gz")
+    assert list(ed.regions) == ["czech republic", "angola"]
+    assert ed["angola"].kind == "country" and ed["angola"].name == "Angola"
+    assert ed.load_traces("angola") == {"WEAK": []}
+
+    d = ExportDiff.load(*paths)
+    assert d.keys == ["angola"] and d.added == ["africa"]
+    assert d.days == ["2020-04-01", "2020-04-02"]
+    assert np.allclose(d.rel_est[0, :, d.metrics.index("JH_Infected")], [0.0, 0.1])
+    assert len(d.outliers()) == 2
+    out = d.outliers({"estimates": (0.05, 1.0)})
+    assert list(out["kind"]) == ["added", "removed", "estimates"]
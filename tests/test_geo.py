@@ -0,0 +1,32 @@
+import numpy as np
+
+from epifor import Regions
+from epifor.common import geo_dist
+from epifor.geo import SpatialIndex, haversine, pairwise_distances
+
+
+def test_haversine():
+    lat = np.array([50.08, -33.87, 0.0, 89.0])
+    lon = np.array([14.42, 151.21, -179.0, 10.0])
+    m = pairwise_distances(lat, lon)
+    for i in range(4):
+        for j in range(4):
+            assert np.isclose(m[i, j], geo_dist(lat[i], lat[j], lon[i] - lon[j]))
+    assert np.isclose(haversine(lat[0], lon[0], lat[1], lon[1]), m[0, 1])
+
+
+def test_spatial_index():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    idx = SpatialIndex.from_regions(rs, kinds="city")
+    lat, lon = 50.1, 14.3  # Prague-ish
+    d, r = idx.nearest(lat, lon)[0]
+    dists = idx.distances_from(lat, lon)
+    assert np.isclose(d, dists.min())
+    assert r is idx.items[int(np.argmin(dists))]
+
+    near = idx.query_radius(lat, lon, 500.0)
+    assert near == list(np.flatnonzero(dists <= 500.0))
+    near2 = idx.query_radius([lat, lat], [lon, lon], 500.0)
+    assert near2.shape == (2,) and near2[1] == near
+    ds, ii = idx.query([lat, 0.0], [lon, 0.0], k=3)
+    assert ds.shape == ii.shape == (2, 3)
@@ -0,0 +1,30 @@
+import datetime
+
+import pytest
+
+from epifor.pipeline import StageCache
+
+
+def test_stage_cache(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    f = tmp_path / "input.txt"
+    f.write_text("a")
+    conf = {"start_date": datetime.date(2020, 3, 20), "x": [1, 2]}
+    k1 = cache.stage_key("s", conf, files=[f])
+    assert k1 == cache.stage_key("s", dict(reversed(list(conf.items()))), files=[f])
+    assert k1 != cache.stage_key("s2", conf, files=[f])
+    assert k1 != cache.stage_key("s", conf, files=[f], deps=["abc"])
+    assert cache.get("s", k1) is None
+
+    with pytest.raises(ValueError):
+        with cache.store("s", k1) as d:
+            (d / "out").write_text("partial")
+            raise ValueError()
+    assert cache.get("s", k1) is None
+
+    with cache.store("s", k1) as d:
+        (d / "out").write_text("result")
+    assert (cache.get("s", k1) / "out").read_text() == "result"
+
+    f.write_text("b")
+    assert cache.stage_key("s", conf, files=[f]) != k1
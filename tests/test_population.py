@@ -0,0 +1,33 @@
+import pandas as pd
+
+from epifor import Region, Regions
+from epifor.population import apply_populations, join_populations
+
+
+def test_join_populations(tmp_path):
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    pd.DataFrame(
+        {
+            "City": ["Menongue", "menongue ", "Huambo", "Soyo", "Nowhere", "Lonely"],
+            "Country": ["Angola", "Angola", "Czechia", "Angola", "Angola", "Atlantis"],
+            "Pop": [1000, 2000, 5, 7000, 1, 3],
+        }
+    ).to_csv(tmp_path / "cities.csv", index=False)
+    spec = dict(
+        path="cities.csv", name="City", population="Pop", country="Country", kind="city"
+    )
+    rs["soyo"].population = None
+    # A city outside of any country does not match an unknown country
+    rs.add_region(Region("Lonely", kind="city"), rs["africa"])
+
+    updates, conflicts = join_populations(rs, [spec], data_dir=tmp_path)
+    assert list(updates["key"]) == ["soyo"]
+    assert list(conflicts["conflict"]) == ["duplicate", "duplicate"]
+    assert set(conflicts["key"]) == {"menongue"}
+
+    updates, _ = join_populations(rs, [spec], overwrite=True, data_dir=tmp_path)
+    upd = updates.set_index("key")["population"]
+    assert upd["menongue"] == 2000 and upd["soyo"] == 7000
+    assert "huambo" not in upd and "lonely" not in upd
+    apply_populations(rs, updates)
+    assert rs["menongue"].population == 2000
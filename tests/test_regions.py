@@ -1,6 +1,14 @@
+import io
+import pickle
+import random
 from pathlib import Path
 
+import numpy as np
+
 from epifor import Regions
+from epifor.common import yaml
+from epifor.regions import EstimateStore, Region
+from epifor.regions_yaml import RegionsYamlIndex, _scalar
 
 
 def test_region_yaml(tmp_path):
@@ -11,3 +19,113 @@ def test_region_yaml(tmp_path):
         rs.write_yaml(f)
     rs2 = Regions.load_from_yaml(p2)
     assert rs.root == rs2.root
+    assert rs.content_hash() == rs2.content_hash()
+    # Same output as dumping the whole tree with ruamel
+    s = io.StringIO()
+    yaml.dump(rs.root.to_json_rec(nones=False), s)
+    assert p2.read_text() == s.getvalue()
+
+
+def test_find_names_fuzzy():
+    rs = Regions.load_from_yaml(Path("data/regions.yaml"))
+    assert rs.find_names_fuzzy("Czechia", "country")[0][1] is rs["czech republic"]
+    assert rs.find_names_fuzzy("Korea, South")[0][1] is rs["south korea"]
+    res = rs.get_fuzzy_index().lookup_many(["pragu", "Bosnia", "xqzxqz"], kinds="city")
+    assert res[0][0][1] is rs["prague"]
+    assert all(r.kind == "city" for _s, r in res[1])
+    assert res[2] == []
+
+
+def test_reestimate_active():
+    rs = Regions.load_from_yaml(Path("data/regions.yaml"))
+    rs.heuristic_set_pops()
+    rs.fix_min_pops()
+    rnd = random.Random(1)
+    for r in rs.regions:
+        if r.kind in ("city", "state") and rnd.random() < 0.3:
+            r.est["csse_active"] = float(rnd.randint(0, 1000))
+        if r.kind in ("country", "state") and rnd.random() < 0.1:
+            r.est["ft_mean"] = float(rnd.randint(100, 100000))
+    ref = pickle.loads(pickle.dumps(rs))
+    rs.estimate_active()
+
+    changes = [("czech republic", "ft_mean", 5000.0), ("prague", "csse_active", 300.0)]
+    for k, name, v in changes:
+        rs[k].est[name] = v
+        ref[k].est[name] = v
+    recomputed = rs.reestimate_active()
+    assert "czech republic" in recomputed and "china" not in recomputed
+    ref2 = pickle.loads(pickle.dumps(ref))
+    ref.estimate_active()
+    for r in rs.regions:
+        assert r.est.get("est_active") == ref[r.key].est.get("est_active")
+
+    # Column-wise changes
+    keys = ["germany", "france"]
+    for regs in (rs, ref2):
+        regs.estimates.set_column("ft_mean", [20000.0, np.nan], keys)
+    assert rs.reestimate_active() >= set(keys)
+    ref2.estimate_active()
+    for r in rs.regions:
+        assert r.est.get("est_active") == ref2[r.key].est.get("est_active")
+
+
+def test_estimate_store(tmp_path):
+    rs = Regions.load_from_yaml(Path("data/regions.yaml"))
+    rs["prague"].est["csse_active"] = 10.0
+    rs["czech republic"].est["csse_active"] = 20.0
+    assert "csse_active" in rs["prague"].est and "csse_active" not in rs["china"].est
+    col = rs.estimates.column("csse_active", ["prague", "china"])
+    assert col[0] == 10.0 and np.isnan(col[1])
+    old = rs.estimates.snapshot()
+    EstimateStore.save_snapshot(old, tmp_path / "est.npz")
+    old = EstimateStore.load_snapshot(tmp_path / "est.npz")
+    del rs["prague"].est["csse_active"]
+    rs.estimates.set_column("csse_active", [30.0], keys=["china"])
+    assert rs["china"].est["csse_active"] == 30.0
+    diff = EstimateStore.diff(old, rs.estimates.snapshot())
+    assert sorted(diff) == [
+        ("china", "csse_active", None, 30.0),
+        ("prague", "csse_active", 10.0, None),
+    ]
+
+
+def test_regions_diff():
+    rs = Regions.load_from_yaml(Path("data/regions.yaml"))
+    rs2 = Regions.load_from_yaml(Path("data/regions.yaml"))
+    h = rs.content_hash()
+    assert rs2.content_hash() == h and rs.diff(rs2) == ([], [], {})
+    rs2["prague"].population = 5
+    rs2.add_region(Region("Foo", kind="city"), rs2["czech republic"])
+    assert rs2.content_hash() != h
+    added, removed, changed = rs.diff(rs2)
+    assert added == ["foo"] and removed == []
+    assert changed == {"prague": {"population": (rs["prague"].population, 5)}}
+    assert rs2.diff(rs)[:2] == ([], ["foo"])
+
+
+def test_load_subtrees_from_yaml():
+    p = Path("data/regions.yaml")
+    rs = Regions.load_from_yaml(p)
+    index = RegionsYamlIndex.build(p)
+    assert list(index.entries) == list(rs.key_index)
+    ss = Regions.load_subtrees_from_yaml(
+        p, ["czech republic", "prague", "japan"], index
+    )
+    for k in ["czech republic", "japan"]:
+        assert ss[k].content_hash() == rs[k].content_hash()
+        assert ss[k].parent.key == rs[k].parent.key
+    assert "germany" not in ss and ss.find_names("prague") == (ss["prague"],)
+    assert ss["europe"].population == rs["europe"].population
+
+
+def test_regions_yaml_scalar():
+    cases = ["=", "<<", "=x", "<x", "a=b", "null", "Yes", "~", "1e3", ".inf", "12:30"]
+    cases += ["2020-01-01", "- a", "a: b", "a #b", "", " a", "a ", "!x", "%x", "@x"]
+    cases += ["`x", "a'b", 'a"b', "x,y", "&a", "*a", "|", "> x", "017", "nan", "café"]
+    cases += ["a\tb", "plain text", 1, 1.5, 1e20, -0.0, float("nan"), True, None]
+    for v in cases:
+        s = io.StringIO()
+        yaml.dump([v], s)
+        assert _scalar(v) == s.getvalue()[4:-1]
+        assert yaml.load(f"x: {_scalar(v)}\n")["x"] == v or v != v
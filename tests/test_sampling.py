@@ -0,0 +1,145 @@
+import datetime
+import random
+
+import numpy as np
+
+from epifor import Regions
+from epifor.data.foretold import FTData, FTPrediction
+from epifor.sampling import EstimateSampler, _nan
+from epifor.whatif import WhatIf, resolve_overrides
+
+
+def test_point_propagation():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    rs.heuristic_set_pops()
+    rs.fix_min_pops()
+    rnd = random.Random(1)
+    for r in rs.regions:
+        if r.kind in ("city", "state") and rnd.random() < 0.3:
+            r.est["csse_active"] = float(rnd.randint(0, 1000))
+        if r.kind in ("country", "state") and rnd.random() < 0.1:
+            r.est["ft_mean"] = float(rnd.randint(100, 100000))
+    smp = EstimateSampler(rs, n_samples=3, seed=0)
+    est = smp.propagate(smp.point_inputs("ft_mean"), smp.point_inputs("csse_active"))
+    rs.estimate_active()
+    expected = np.array([rs[k].est["est_active"] for k in smp.keys])
+    for s in range(3):
+        assert np.allclose(est[:, s], expected)
+
+    csse = smp.sample_lognormal("csse_active", sigma=0.5)
+    est = smp.propagate(smp.point_inputs("ft_mean"), csse)
+    q = smp.quantiles(est, seeds=True)
+    assert (q["q05"] <= q["q50"]).all() and (q["q50"] <= q["q95"]).all()
+    assert set(q.index) == set(r.key for r in rs.regions if r.kind == "city")
+
+
+def test_whatif():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    rs.heuristic_set_pops()
+    rs.fix_min_pops()
+    rnd = random.Random(2)
+    for r in rs.regions:
+        if r.kind in ("city", "state") and rnd.random() < 0.3:
+            r.est["csse_active"] = float(rnd.randint(0, 1000))
+    variants = [
+        {"name": "base"},
+        {"name": "cz", "country_active_estimates": {"czechia": 5000}},
+        {"name": "na", "region_active_estimates": {"north america": 100000}},
+    ]
+    wi = WhatIf(rs, variants)
+    est = wi.estimate()
+    seeds = wi.seeds(est)
+    assert list(seeds.columns) == ["base", "cz", "na"]
+
+    for k, v in enumerate(variants):
+        rs2 = Regions.load_from_yaml("data/regions.yaml")
+        rs2.heuristic_set_pops()
+        rs2.fix_min_pops()
+        for r in rs.regions:
+            if "csse_active" in r.est:
+                rs2[r.key].est["csse_active"] = r.est["csse_active"]
+        overrides = resolve_overrides(
+            rs2,
+            v.get("region_active_estimates"),
+            v.get("country_active_estimates"),
+        )
+        for key, e in overrides.items():
+            rs2[key].est["ft_mean"] = e
+        rs2.estimate_active()
+        expected = np.array(
+            [_nan(rs2[key].est.get("est_active")) for key in wi.sampler.keys]
+        )
+        assert np.allclose(est[:, k], expected, equal_nan=True)
+
+
+def ft_prediction(name, date, xs, ys):
+    node = {
+        "labelOnDate": date,
+        "labelSubject": f"@locations/n-{name}",
+        "previousAggregate": {"value": {"floatCdf": {"xs": xs, "ys": ys}}},
+    }
+    return FTPrediction.from_ft_node(node)
+
+
+def test_whatif_start_date():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    rs.heuristic_set_pops()
+    rs.fix_min_pops()
+    ft = FTData()
+    # Different sets of predictions at the three dates
+    for name, date, x in [
+        ("czechia", "2020-03-10T12:00:00Z", 100.0),
+        ("czechia", "2020-03-20T12:00:00Z", 300.0),
+        ("germany", "2020-03-20T12:00:00Z", 5000.0),
+        ("france", "2020-03-22T12:00:00Z", 2000.0),
+    ]:
+        ft.predictions.append(ft_prediction(name, date, [x, x + 1.0], [0.0, 1.0]))
+    ft._sort()
+    ft.apply_to_regions(rs, datetime.datetime(2020, 3, 21).astimezone())
+    assert set(ft.applied) == {"czech republic", "germany"}
+
+    class CSSE:
+        def active_by_date(self, regions, date):
+            return {"czech republic": 10.0}
+
+    variants = [
+        {"name": "base"},
+        {"name": "early", "start_date": datetime.date(2020, 3, 12)},
+        {"name": "late", "start_date": datetime.date(2020, 3, 25)},
+    ]
+    wi = WhatIf(rs, variants, csse=CSSE(), ft=ft)
+    fts, csse = wi.inputs()
+    for key, expected in [
+        ("czech republic", [300.0, 100.0, 300.0]),
+        ("germany", [5000.0, np.nan, 5000.0]),
+        ("france", [np.nan, np.nan, 2000.0]),
+    ]:
+        assert np.allclose(fts[wi.sampler.index[key]], expected, equal_nan=True)
+    assert csse[wi.sampler.index["czech republic"], 1] == 10.0
+    assert np.isnan(csse[wi.sampler.index["germany"], 1])
+
+
+def test_sample_ft():
+    rs = Regions.load_from_yaml("data/regions.yaml")
+    rs.heuristic_set_pops()
+    rs.fix_min_pops()
+    xs, cdf = [0.0, 10.0, 20.0, 30.0], [0.0, 0.2, 0.7, 1.0]
+    p = ft_prediction("czechia", "2020-03-20T12:00:00Z", xs, cdf)
+    smp = EstimateSampler(rs, n_samples=20000, seed=0)
+    s = smp.sample_ft({"czech republic": p})
+    v = s[smp.index["czech republic"]]
+    assert np.isnan(s[smp.index["germany"]]).all()
+    assert v.min() >= 0.0 and v.max() <= 30.0
+    # Empirical CDF at the input points
+    for x, c in zip(xs, cdf):
+        assert abs(np.mean(v <= x) - c) < 0.01
+    assert np.allclose(np.quantile(v, [0.2, 0.7]), [10.0, 20.0], atol=0.3)
+
+    rs["germany"].est["ft_mean"] = 5000.0
+    ft, csse = smp.sample_inputs({"czech republic": p}, {"france": 100.0})
+    assert ft.shape == csse.shape == (len(smp.keys), 20000)
+    assert np.allclose(ft[smp.index["czech republic"]].mean(), v.mean(), rtol=0.05)
+    assert (ft[smp.index["germany"]] == 5000.0).all()
+    assert (ft[smp.index["france"]] == 100.0).all()
+    q = smp.quantiles(smp.propagate(ft, csse), seeds=True)
+    assert (q["q05"] <= q["q95"]).all()
@@ -0,0 +1,58 @@
+import asyncio
+import gzip
+import json
+
+from epifor import Region, Regions
+from epifor.data.batch import Batch
+from epifor.data.server import RegionServer
+from epifor.gleam import Simulation
+from test_simulation import make_sim_dir
+
+
+def test_region_server(tmp_path):
+    rs = Regions()
+    rs.add_region(Region("Earth", kind="world"), None)
+    rs.add_region(Region("A", kind="country", gleam_id=1), rs["earth"])
+    rs.add_region(Region("B", kind="city", gleam_id=3), rs["a"])
+    rs.add_region(Region("C", kind="state"), rs["a"])
+    b = Batch.new({"output_dir": str(tmp_path)})
+    for j, group in enumerate(["None", "None", "High"]):
+        d = make_sim_dir(tmp_path / f"{j}.gvh5", seed=j)
+        sim = Simulation.load_dir(d)
+        b.add_simulation_info(sim, name=f"s{j}", group=group, color="#ff0000")
+        b.sims[-1].id = str(j)
+    server = RegionServer(b, rs)
+
+    async def get(port, path, gzip_ok=False):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        enc = "Accept-Encoding: gzip\r\n" if gzip_ok else ""
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n{enc}\r\n".encode())
+        head, body = (await reader.read()).split(b"\r\n\r\n", 1)
+        writer.close()
+        if b"Content-Encoding: gzip" in head:
+            body = gzip.decompress(body)
+        return int(head.split()[1]), json.loads(body)
+
+    async def main():
+        srv = await server.start(port=0)
+        port = srv.sockets[0].getsockname()[1]
+        res = await asyncio.gather(
+            get(port, "/regions/b", gzip_ok=True),
+            get(port, "/regions/b"),
+        )
+        index = await get(port, "/regions")
+        missing = await get(port, "/regions/c")
+        await server.stop(srv)
+        return res, index, missing
+
+    res, index, missing = asyncio.run(main())
+    traces, stats = b.generate_region_traces_and_stats(rs["b"])
+    for status, payload in res:
+        assert status == 200
+        assert payload["data"]["mitigation_stats"] == stats
+        assert payload["data"]["infected_per_1000"]["traces"] == json.loads(
+            json.dumps(traces)
+        )
+    assert [r["key"] for r in index[1]] == ["a", "b"]
+    assert missing[0] == 404
+    assert list(server.cache) == ["b"]
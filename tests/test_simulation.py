@@ -0,0 +1,106 @@
+import shutil
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from epifor.gleam import GleamDef, Simulation
+from epifor.gleam.metapop import CompartmentModel, MetapopSimulator, mobility_matrix
+
+
+def make_sim_dir(path, basins=5, countries=3, continents=2, days=10, seed=42):
+    path.mkdir()
+    shutil.copy(Path("data/definition-example.xml"), path / "definition.xml")
+    rnd = np.random.RandomState(seed)
+    with h5py.File(path / "results.h5", "w") as f:
+        for cum in ["new", "cumulative"]:
+            for kind, n in [
+                ("basin", basins),
+                ("country", countries),
+                ("continent", continents),
+            ]:
+                for sub in ["median", "mean"]:
+                    f.create_dataset(
+                        f"population/{cum}/{kind}/{sub}/dset",
+                        data=rnd.rand(4, 2, n, days).astype("f4"),
+                    )
+    return path
+
+
+def test_repack(tmp_path):
+    d = make_sim_dir(tmp_path / "sim.gvh5")
+    s = Simulation.load_dir(d)
+    assert s.repacked is None
+    orig = [s.get_seq(i, "city") for i in range(5)]
+    orig_mean = s.get_seq(2, "country", sub="mean")
+    s.repack()
+
+    s2 = Simulation.load_dir(d)
+    assert s2.repacked is not None
+    for i in range(5):
+        assert np.array_equal(s2.get_seq(i, "city"), orig[i])
+    assert np.array_equal(
+        s2.get_seq(1, "country", cumulative=False),
+        s.hdf["population/new/country/median/dset"][:, 0, 1, :],
+    )
+    # Not repacked, falls back to the original file
+    assert np.array_equal(s2.get_seq(2, "country", sub="mean"), orig_mean)
+
+
+def make_basins():
+    return pd.DataFrame(
+        {
+            "lat": [50.0, 50.5, 48.0, -30.0, -33.0, 10.0],
+            "lon": [14.0, 15.0, 16.0, 150.0, 151.0, 0.0],
+            "pop": [1e6, 2e5, 5e5, 3e6, 1e5, 4e5],
+            "country": [0, 0, 1, 2, 2, 3],
+            "region": [0, 0, 0, 1, 1, 2],
+            "continent": [0, 0, 0, 1, 1, 2],
+            "hemisphere": [0, 0, 0, 2, 2, 1],
+        }
+    )
+
+
+def test_metapop_simulator(tmp_path):
+    basins = make_basins()
+    sim = MetapopSimulator(basins, mobility=mobility_matrix(basins, neighbours=2))
+    dirs = []
+    for i, beta in enumerate([0.5, 1.5]):
+        d = tmp_path / f"s{i}.gvh5"
+        d.mkdir()
+        gv = GleamDef("data/definition-example.xml")
+        gv.set_beta(beta)
+        gv.clear_seeds()
+        gv.f1("./gv:definition/gv:exceptions").clear()
+        ET.SubElement(
+            gv.f1("./gv:definition/gv:seeds"),
+            "seed",
+            {"city": "0", "compartment": "Infectious", "number": "100"},
+        )
+        gv.save(d / "definition.xml")
+        dirs.append(d)
+    sim.simulate_dirs(dirs)
+
+    s0, s1 = [Simulation.load_dir(d) for d in dirs]
+    assert s0.get_seq(0, "city").shape == (4, 250)
+    assert s1.get_seq(3, "country").shape == (4, 250)
+    # Infection spreads to other basins, more with higher beta
+    inf0, inf1 = (s.get_basin_seqs()[:, 2, -1] for s in (s0, s1))
+    assert (inf1 > 0).all()
+    assert (inf1 > inf0).all()
+    assert (inf1 <= 0.9 + 1e-6).all()
+
+
+def test_metapop_exceptions(caplog):
+    basins = make_basins()
+    basins.loc[[1, 2], "country"] = 39
+    sim = MetapopSimulator(basins, mobility=mobility_matrix(basins, neighbours=2))
+    # Example exceptions: beta 0.3 in country 39, 0.15 in basin 477 (not present)
+    m = CompartmentModel(GleamDef("data/definition-example.xml"))
+    assert m.exceptions[0][2]["country"] == [39]
+    masks = [[sim._selection(e[2]) for e in m.exceptions]]
+    assert "basin 477" in caplog.text
+    beta = sim._variables([m], masks, 0)["beta"][0]
+    assert list(beta) == [1.285, 0.3, 0.3, 1.285, 1.285, 1.285]
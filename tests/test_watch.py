@@ -0,0 +1,92 @@
+import datetime
+import shutil
+
+import h5py
+import pandas as pd
+
+from epifor import Region, Regions
+from epifor.data.batch import Batch
+from epifor.data.export import ExportDoc
+from epifor.data.watch import BatchWatcher
+from epifor.gleam import GleamDef, Simulation
+from test_simulation import make_sim_dir
+
+
+def make_watch_batch(tmp_path):
+    rs = Regions()
+    rs.add_region(Region("Earth", kind="world"), None)
+    rs.add_region(Region("B", kind="city", gleam_id=3), rs["earth"])
+    config = {
+        "output_dir": str(tmp_path / "out"),
+        "regions": ["b"],
+        "start_date": datetime.date(2020, 4, 1),
+    }
+    b = Batch.new(config)
+    pd.DataFrame({"active_20200401": [1.0]}, index=["b"]).to_hdf(
+        b.get_out_dir() / b.HIST_FILE_NAME, key="data"
+    )
+    sims_dir = tmp_path / "sims"
+    sims_dir.mkdir()
+    for j, group in enumerate(["None", "None", "High", "High"]):
+        d = sims_dir / f"{j}.gvh5"
+        d.mkdir()
+        shutil.copy("data/definition-example.xml", d / "definition.xml")
+        gv = GleamDef(d / "definition.xml")
+        gv.set_id(str(j))
+        gv.save(d / "definition.xml")
+        b.add_simulation_info(Simulation(gv, None), f"s{j}", group, color="#ff0000")
+    return b, rs, sims_dir
+
+
+def finish_sim(sims_dir, j):
+    "Write the results of sim `j`, with no recovered (initial number stays 0)"
+    d = make_sim_dir(sims_dir / f"tmp{j}.gvh5", seed=j)
+    with h5py.File(d / "results.h5", "a") as f:
+        for k in ["new", "cumulative"]:
+            ds = f[f"population/{k}/basin/median/dset"]
+            ds[3] = 0.0
+    (d / "results.h5").replace(sims_dir / f"{j}.gvh5" / "results.h5")
+
+
+def test_watch_poll(tmp_path):
+    b, rs, sims_dir = make_watch_batch(tmp_path)
+    finish_sim(sims_dir, 0)
+    w = BatchWatcher(b, rs, sims_dir=sims_dir)
+    # Results present at startup are not opened before being polled
+    assert not any(bs.sim.has_result() for bs in b.sims)
+    assert w.poll() == []
+    assert w.poll() == [b.sims[0]]
+    finish_sim(sims_dir, 1)
+    assert w.poll() == [b.sims[0]]
+    # Changed between polls: not complete yet
+    with open(w.result_path(b.sims[1]), "ab") as f:
+        f.write(b"\0")
+    assert w.poll() == [b.sims[0]]
+    assert w.poll() == [b.sims[0], b.sims[1]]
+
+
+def test_watch_update(tmp_path):
+    b, rs, sims_dir = make_watch_batch(tmp_path)
+    w = BatchWatcher(b, rs, sims_dir=sims_dir)
+    for j in [0, 1]:
+        finish_sim(sims_dir, j)
+    w.update(b.sims[:2])
+    assert set(w.traces["b"]) == {"None", "High"}
+    assert w.traces["b"]["High"] == [] and "High" not in w.stats["b"]
+    none_traces = w.traces["b"]["None"]
+
+    for j in [2, 3]:
+        finish_sim(sims_dir, j)
+    w.update(b.sims[2:])
+    assert w.finished()
+    # Only the group with new results is recomputed
+    assert w.traces["b"]["None"] is none_traces
+    traces, stats = b.generate_region_traces_and_stats(rs["b"])
+    assert w.traces["b"] == traces
+    assert w.stats["b"] == stats
+    doc = ExportDoc.load(w.out_dir / b.DATA_FILE_NAME)
+    assert doc.load_traces("b") == traces
+    assert sorted(p.name for p in w.out_dir.iterdir()) == [
+        b.DATA_FILE_NAME,
+        "lines-traces-b.json",
+    ]